@@ -0,0 +1,364 @@
+# coding=utf-8
+"""End to end benchmarks of the bridge against a local fake Prusa Connect.
+
+Runs :class:`~octoprint_prusaconnectbridge.PrusaConnectBridgePlugin` with fake
+OctoPrint objects (see ``fakes.py``), the real SDK and a local HTTP server in
+place of connect.prusa3d.com, and measures:
+
+* ``startup``: plugin construction, ``on_after_startup``, the background SDK
+  setup it starts and the time until the first telemetry reaches the server
+* ``telemetry``: latency from an OctoPrint printer callback to the telemetry
+  arriving at the server, and throughput with callbacks pushed back to back
+* ``send_info``: SEND_INFO round trip (command handed out to INFO received)
+  against the size of the file library, first (cold index) and later requests
+* ``commands``: round trip of START_PRINT, PAUSE_PRINT, RESUME_PRINT and
+  STOP_PRINT
+* ``start_print``: START_PRINT round trip against the size of the file
+  library, naming the file by its path and by its name alone
+* ``camera``: webcam snapshots from a file while printing, once with a fast
+  uplink and once with uploads slower than the snapshot interval, counting
+  frames grabbed, skipped and uploaded per stage
+* ``file_sync``: bytes Prusa Connect receives for the whole file list and for
+  one file added to it, against the size of the file library
+
+With ``--async-core`` every scenario runs with the ``sdk_async_core`` setting,
+the telemetry results include the number of threads the plugin runs on.
+
+Usage::
+
+    python benchmarks/bench_bridge.py [--scenarios startup telemetry send_info commands start_print camera file_sync]
+                                      [--sizes 100 1000 10000] [--async-core] [--output results.json]
+
+Results are printed (or written) as JSON, latencies in milliseconds, so runs of
+two plugin versions can be compared.
+"""
+from __future__ import absolute_import
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fakes import FakeConnectServer, make_plugin, synthetic_path  # noqa: E402
+
+SCENARIOS = ("startup", "telemetry", "send_info", "commands", "start_print", "camera", "file_sync")
+# Plugin settings of every scenario, from the command line
+SETTINGS = {}
+
+
+def summarize(samples):
+    """Latency summary in milliseconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))] * 1000.0
+
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered) * 1000.0,
+        "p50": percentile(50),
+        "p95": percentile(95),
+        "p99": percentile(99),
+        "max": ordered[-1] * 1000.0,
+    }
+
+
+def _started_plugin(server, file_count=0):
+    plugin = make_plugin(server.url, file_count=file_count, **SETTINGS)
+    plugin.on_after_startup()
+    # Let the first heartbeat through so it doesn't end up in the measurements
+    server.wait_for_telemetry(1)
+    server.reset()
+    return plugin
+
+
+def _round_trip(server, plugin, command, **kwargs):
+    command_id = server.queue_command(command, **kwargs)
+    # Commands ride on the response to the next telemetry, don't wait for the heartbeat
+    plugin._send_telemetry(force=True)
+    result = server.wait_for_event(command_id)
+    if result is None:
+        return None, "TIMEOUT"
+    arrival, payload = result
+    return arrival - server.issued[command_id], payload
+
+
+##~~ Scenarios
+
+def bench_startup(server, runs=5, **kwargs):
+    construct, after_startup, sdk_ready, first_telemetry = [], [], [], []
+    for _ in range(runs):
+        server.reset()
+        start = time.perf_counter()
+        plugin = make_plugin(server.url, **SETTINGS)
+        constructed = time.perf_counter()
+        plugin.on_after_startup()
+        started = time.perf_counter()
+        plugin._wait_for_startup(plugin.SHUTDOWN_WAIT)
+        sdk_ready.append(time.perf_counter() - constructed)
+        if server.wait_for_telemetry(1):
+            first_telemetry.append(server.telemetry[0][0] - start)
+        construct.append(constructed - start)
+        after_startup.append(started - constructed)
+        plugin.on_shutdown()
+    return {
+        "construct": summarize(construct),
+        "on_after_startup": summarize(after_startup),
+        "sdk_ready": summarize(sdk_ready),
+        "first_telemetry": summarize(first_telemetry),
+    }
+
+
+def bench_telemetry(server, samples=200, **kwargs):
+    threads_before = threading.active_count()
+    plugin = _started_plugin(server)
+    printer = plugin._printer
+    try:
+        threads = threading.active_count() - threads_before
+        # Latency: one callback at a time, each with a temperature change outside the deadband
+        latencies, callbacks = [], []
+        for i in range(samples):
+            nozzle = printer.nozzle = 100.0 + i
+            start = time.perf_counter()
+            printer.push()
+            callbacks.append(time.perf_counter() - start)
+            arrival = server.wait_for_telemetry_matching(lambda payload: payload.get("temp_nozzle") == nozzle,
+                                                         timeout=5.0)
+            if arrival is not None:
+                latencies.append(arrival - start)
+
+        # Throughput: callbacks back to back, until the server has seen the last one
+        server.reset()
+        start = time.perf_counter()
+        for i in range(samples):
+            printer.nozzle = 1000.0 + i
+            printer.push()
+        pushed = time.perf_counter() - start
+        last = printer.nozzle
+        server.wait_for_telemetry_matching(lambda payload: payload.get("temp_nozzle") == last, timeout=30.0)
+        elapsed = time.perf_counter() - start
+        received = sum(1 for _, payload in server.telemetry if payload.get("temp_nozzle", 0) >= 1000.0)
+        return {
+            "threads": threads,
+            "callback": summarize(callbacks),
+            "latency": summarize(latencies),
+            "throughput": {
+                "pushed": samples,
+                "received": received,
+                "push_seconds": pushed,
+                "seconds": elapsed,
+                "per_second": received / elapsed if elapsed else None,
+            },
+        }
+    finally:
+        plugin.on_shutdown()
+
+
+def bench_send_info(server, sizes=(100, 1000, 10000), runs=5, **kwargs):
+    results = []
+    for size in sizes:
+        server.reset()
+        plugin = _started_plugin(server, file_count=size)
+        try:
+            round_trips, payload_bytes, failures = [], 0, 0
+            for _ in range(runs):
+                elapsed, payload = _round_trip(server, plugin, "SEND_INFO")
+                if elapsed is None or payload.get("event") != "INFO":
+                    failures += 1
+                    continue
+                round_trips.append(elapsed)
+                payload_bytes = len(json.dumps(payload))
+            results.append({
+                "files": size,
+                "cold": summarize(round_trips[:1]),
+                "warm": summarize(round_trips[1:]),
+                "payload_bytes": payload_bytes,
+                "failures": failures,
+            })
+        finally:
+            plugin.on_shutdown()
+    return results
+
+
+def bench_commands(server, rounds=20, **kwargs):
+    plugin = _started_plugin(server, file_count=10)
+    sequence = (
+        ("START_PRINT", {"kwargs": {"path": "/" + synthetic_path(0)}}),
+        ("PAUSE_PRINT", {}),
+        ("RESUME_PRINT", {}),
+        ("STOP_PRINT", {}),
+    )
+    samples = {command: [] for command, _ in sequence}
+    failures = {command: 0 for command, _ in sequence}
+    try:
+        for _ in range(rounds):
+            for command, kwargs in sequence:
+                elapsed, payload = _round_trip(server, plugin, command, **kwargs)
+                if elapsed is None or payload.get("event") != "FINISHED":
+                    failures[command] += 1
+                    continue
+                samples[command].append(elapsed)
+        return {command: dict(summarize(samples[command]), failures=failures[command]) for command in samples}
+    finally:
+        plugin.on_shutdown()
+
+
+def bench_start_print(server, sizes=(100, 1000, 10000), runs=5, **kwargs):
+    results = []
+    for size in sizes:
+        server.reset()
+        plugin = _started_plugin(server, file_count=size)
+        try:
+            # The last file of the library, in the last folder
+            path = synthetic_path(size - 1)
+            by = {"path": "/" + path, "name": path.rpartition("/")[2]}
+            result = {"files": size}
+            for key, name in by.items():
+                round_trips, failures = [], 0
+                for _ in range(runs):
+                    elapsed, payload = _round_trip(server, plugin, "START_PRINT", kwargs={"path": name})
+                    if elapsed is None or payload.get("event") != "FINISHED":
+                        failures += 1
+                        continue
+                    round_trips.append(elapsed)
+                    plugin._printer.cancel_print()
+                result[key] = dict(summarize(round_trips), failures=failures)
+            results.append(result)
+        finally:
+            plugin.on_shutdown()
+    return results
+
+
+def bench_camera(server, duration=3.0, **kwargs):
+    import tempfile
+
+    # A JPEG as far as the pipeline can tell, passed through as is without Pillow
+    frame = b"\xff\xd8" + os.urandom(200 * 1024)
+    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as f:
+        f.write(frame)
+    results = {}
+    try:
+        for uplink, delay in (("fast", 0.0), ("slow", 0.25)):
+            server.reset()
+            server.snapshot_delay = delay
+            plugin = make_plugin(server.url, camera_snapshot_url=f.name, camera_interval_printing=0.05,
+                                 **SETTINGS)
+            plugin._printer.printing = True
+            plugin.on_after_startup()
+            plugin._wait_for_startup(plugin.SHUTDOWN_WAIT)
+            time.sleep(duration)
+            metrics = plugin._metrics
+            plugin.on_shutdown()
+            counts = {}
+            for (name, labels), value in metrics._counters.items():
+                if name == "prusaconnect_camera_frames_total":
+                    labels = dict(labels)
+                    counts[f"{labels['stage']}_{labels['result']}"] = value
+            uploads = [arrival for arrival, _ in server.snapshots]
+            intervals = [later - earlier for earlier, later in zip(uploads, uploads[1:])]
+            results[uplink] = dict(upload_delay_ms=delay * 1000.0, frames=counts, uploaded=len(uploads),
+                                   upload_interval=summarize(intervals))
+    finally:
+        server.snapshot_delay = 0.0
+        os.unlink(f.name)
+    return results
+
+
+def bench_file_sync(server, sizes=(100, 1000, 10000), **kwargs):
+    from octoprint.events import Events
+
+    results = []
+    for size in sizes:
+        server.reset()
+        plugin = _started_plugin(server, file_count=size)
+        basedir = plugin._file_manager.get_basedir("local")
+        path = f"bench_added_{size}.gcode"
+        try:
+            # The whole list, as Connect gets it for SEND_INFO, becomes the snapshot changes are sent against
+            plugin._file_sync.resync()
+            full = server.wait_for_event_matching(lambda payload: payload.get("event") == "INFO")
+
+            os.makedirs(basedir, exist_ok=True)
+            with open(os.path.join(basedir, path), "wb") as f:
+                f.write(b"; generated by bench_bridge.py\nG28\n")
+            start = time.perf_counter()
+            plugin.on_event(Events.FILE_ADDED, dict(storage="local", path=path, name=path, type=["machinecode", "gcode"]))
+            plugin.on_event(Events.UPDATED_FILES, dict(type="printables"))
+            added = server.wait_for_event_matching(lambda payload: payload.get("event") == "FILE_CHANGED")
+            results.append(dict(
+                files=size,
+                full_bytes=len(json.dumps(full[1])) if full else None,
+                added_bytes=len(json.dumps(added[1])) if added else None,
+                # Includes the event queue's coalescing window
+                added_ms=(added[0] - start) * 1000.0 if added else None,
+                info_events=sum(1 for _, payload in server.events if payload.get("event") == "INFO"),
+            ))
+        finally:
+            plugin.on_shutdown()
+            os.unlink(os.path.join(basedir, path))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="File library sizes for send_info and start_print")
+    parser.add_argument("--runs", type=int, default=5, help="Repetitions for startup, send_info and start_print")
+    parser.add_argument("--samples", type=int, default=200, help="Telemetry samples")
+    parser.add_argument("--rounds", type=int, default=20, help="START/PAUSE/RESUME/STOP rounds")
+    parser.add_argument("--async-core", action="store_true", help="Run the plugin with the sdk_async_core setting")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="Show plugin and SDK logging")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+    if args.async_core:
+        SETTINGS["sdk_async_core"] = True
+
+    from prusa.connect.printer import __version__ as sdk_version
+    from octoprint_prusaconnectbridge import __plugin_version__
+
+    server = FakeConnectServer().start()
+    benches = {
+        "startup": lambda: bench_startup(server, runs=args.runs),
+        "telemetry": lambda: bench_telemetry(server, samples=args.samples),
+        "send_info": lambda: bench_send_info(server, sizes=args.sizes, runs=args.runs),
+        "commands": lambda: bench_commands(server, rounds=args.rounds),
+        "start_print": lambda: bench_start_print(server, sizes=args.sizes, runs=args.runs),
+        "camera": lambda: bench_camera(server),
+        "file_sync": lambda: bench_file_sync(server, sizes=args.sizes),
+    }
+    results = {
+        "plugin_version": __plugin_version__,
+        "sdk_version": sdk_version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "settings": SETTINGS,
+        "results": {},
+    }
+    try:
+        for name in args.scenarios:
+            results["results"][name] = benches[name]()
+    finally:
+        server.stop()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
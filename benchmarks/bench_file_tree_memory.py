@@ -0,0 +1,136 @@
+# coding=utf-8
+"""Memory benchmark for the SEND_INFO file tree.
+
+Compares the dict builder SEND_INFO used before the file index (one dict per
+node, kept alive on ``prusa_printer.fs.root``) with the compact
+:class:`~octoprint_prusaconnectbridge.files.FileIndex` for synthetic libraries.
+
+Usage::
+
+    python benchmarks/bench_file_tree_memory.py [--sizes 10000 100000 500000] [--json]
+
+For each size it reports the memory retained between requests and the peak
+memory while producing one SEND_INFO tree, as measured by tracemalloc. The
+synthetic OctoPrint listing itself is allocated before tracing starts and is
+not included.
+"""
+from __future__ import absolute_import
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fakes import synthetic_listing  # noqa: E402
+from octoprint_prusaconnectbridge.files import FileIndex  # noqa: E402
+
+def legacy_build(octoprint_files_data):
+    """The dict tree builder SEND_INFO used before the file index."""
+    root = {"name": "/", "path": "/", "type": "DIR", "children": [], "size": 0, "m_timestamp": int(time.time())}
+
+    def build_fs_tree(octo_files_dict, parent_node_dict):
+        for name, item_data in octo_files_dict.items():
+            if item_data["type"] == "folder":
+                node_type_str = "DIR"
+            elif item_data["type"] == "machinecode":
+                node_type_str = "FILE"
+            else:
+                continue
+
+            node_path = os.path.join(parent_node_dict["path"], name).lstrip("/")
+            if parent_node_dict["path"] == "/":
+                node_path = name
+
+            node_dict = {
+                "name": name,
+                "path": node_path,
+                "type": node_type_str,
+                "size": item_data.get("size", 0) if node_type_str == "FILE" else 0,
+                "m_timestamp": int(item_data.get("date", time.time())),
+            }
+            if node_type_str == "DIR":
+                node_dict["children"] = []
+
+            if node_type_str == "FILE" and item_data.get("gcodeAnalysis"):
+                estimated_print_time = item_data["gcodeAnalysis"].get("estimatedPrintTime")
+                if estimated_print_time:
+                    node_dict["print_time"] = int(estimated_print_time)
+
+            parent_node_dict["children"].append(node_dict)
+
+            if node_type_str == "DIR" and "children" in item_data:
+                build_fs_tree(item_data.get("children", {}), node_dict)
+
+    build_fs_tree(octoprint_files_data.get("local", {}), root)
+    return root
+
+
+class _ListingFileManager(object):
+    def __init__(self, listing):
+        self._listing = listing
+
+    def list_files(self, recursive=True, locations=None, path=None):
+        return self._listing
+
+
+def _measure(func):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, peak, elapsed
+
+
+def bench(file_count):
+    listing = synthetic_listing(file_count)
+
+    # Legacy: the whole dict tree is both the retained state and the payload
+    tree, retained, peak, elapsed = _measure(lambda: legacy_build(listing))
+    legacy = {"retained_bytes": retained, "peak_bytes": peak, "build_seconds": elapsed}
+    del tree
+
+    # File index: the compact index is retained, the payload only exists while a request is served
+    index = FileIndex(_ListingFileManager(listing))
+    _, retained, peak, elapsed = _measure(index.rebuild)
+    _, _, payload_peak, payload_elapsed = _measure(index.tree)
+    compact = {
+        "retained_bytes": retained,
+        "peak_bytes": max(peak, retained + payload_peak),
+        "build_seconds": elapsed,
+        "send_info_seconds": payload_elapsed,
+    }
+    del index
+
+    return {"files": file_count, "legacy_dict": legacy, "file_index": compact}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 500000])
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    results = [bench(size) for size in args.sizes]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    mib = 1024.0 * 1024.0
+    print(f"{'files':>8}  {'builder':<10} {'retained MiB':>13} {'peak MiB':>9} {'build s':>8}")
+    for result in results:
+        for name in ("legacy_dict", "file_index"):
+            data = result[name]
+            print(f"{result['files']:>8}  {name:<10} {data['retained_bytes'] / mib:>13.1f} "
+                  f"{data['peak_bytes'] / mib:>9.1f} {data['build_seconds']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+# coding=utf-8
+"""CPU benchmark for building one telemetry snapshot.
+
+Compares the chained ``.get()`` builder and change check telemetry used
+before the field map, which reported ``tool0`` and ``bed`` only, with
+:class:`~octoprint_prusaconnectbridge.telemetry.SnapshotBuilder`, which reports
+every heater, fans, feedrate, flow, print times, Z and layer.
+
+Usage::
+
+    python benchmarks/bench_telemetry_extract.py [--ticks 100000] [--json]
+
+Both builders get the same OctoPrint data of a printing printer, once for a
+single nozzle and bed (``mk3``) and once for two tools, bed, chamber, fan,
+feedrate and flow (``multi_tool``). Each is timed for building the snapshot
+alone and for building it and checking it against the last one sent, as every
+tick does.
+Times are process CPU time per tick, the best of nine interleaved runs.
+"""
+from __future__ import absolute_import
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from prusa.connect.printer import const  # noqa: E402
+from octoprint_prusaconnectbridge.telemetry import (HEATING_MARGIN, MachineState, SnapshotBuilder,  # noqa: E402
+                                                    TelemetryEngine)
+
+
+def legacy_build(printer_data, temperature_data):
+    """The snapshot builder telemetry used before the field map."""
+    octo_state = printer_data["state"]["flags"]
+    prusa_state = const.State.READY
+
+    if octo_state["printing"]:
+        prusa_state = const.State.PRINTING
+    elif octo_state["paused"]:
+        prusa_state = const.State.PAUSED
+    elif octo_state["error"] or octo_state["closedOrError"]:
+        prusa_state = const.State.ERROR
+    elif not octo_state["operational"]:
+        prusa_state = const.State.ATTENTION
+    elif octo_state["ready"]:
+        prusa_state = const.State.READY
+
+    nozzle_actual = temperature_data.get("tool0", {}).get("actual") if temperature_data.get("tool0") else 0.0
+    nozzle_target = temperature_data.get("tool0", {}).get("target") if temperature_data.get("tool0") else 0.0
+    bed_actual = temperature_data.get("bed", {}).get("actual") if temperature_data.get("bed") else 0.0
+    bed_target = temperature_data.get("bed", {}).get("target") if temperature_data.get("bed") else 0.0
+
+    nozzle_actual = float(nozzle_actual) if nozzle_actual is not None else 0.0
+    nozzle_target = float(nozzle_target) if nozzle_target is not None else 0.0
+    bed_actual = float(bed_actual) if bed_actual is not None else 0.0
+    bed_target = float(bed_target) if bed_target is not None else 0.0
+
+    progress = None
+    filename = None
+    if prusa_state == const.State.PRINTING or prusa_state == const.State.PAUSED:
+        if printer_data.get("progress") and printer_data["progress"].get("completion") is not None:
+            progress = round(printer_data["progress"]["completion"])
+        if printer_data.get("job") and printer_data["job"].get("file") and printer_data["job"]["file"].get("name"):
+            filename = printer_data["job"]["file"]["name"]
+
+    snapshot = dict(
+        state=prusa_state,
+        temp_nozzle=nozzle_actual,
+        target_nozzle=nozzle_target,
+        temp_bed=bed_actual,
+        target_bed=bed_target,
+        progress=progress,
+        print_file=filename
+    )
+
+    heating = any(target > 0 and actual < target - HEATING_MARGIN
+                  for actual, target in ((nozzle_actual, nozzle_target), (bed_actual, bed_target)))
+    return snapshot, heating
+
+
+def legacy_has_changed(last, snapshot, deadbands):
+    """The change check telemetry used before the field map."""
+    for key in set(last) | set(snapshot):
+        old = last.get(key)
+        new = snapshot.get(key)
+        if old == new:
+            continue
+        deadband = deadbands.get(key)
+        if deadband and old is not None and new is not None and abs(new - old) < deadband:
+            continue
+        return True
+    return False
+
+
+def sample_data(multi_tool=True):
+    printer_data = {
+        "state": {"flags": {"operational": True, "printing": True, "paused": False,
+                            "error": False, "closedOrError": False, "ready": False}},
+        "job": {"file": {"name": "benchy.gcode"}},
+        "progress": {"completion": 42.7, "printTime": 1834, "printTimeLeft": 2466, "filepos": 1234567},
+        "currentZ": 8.4,
+    }
+    temperature_data = {
+        "tool0": {"actual": 214.8, "target": 215.0, "offset": 0},
+        "bed": {"actual": 59.9, "target": 60.0, "offset": 0},
+    }
+    if multi_tool:
+        temperature_data["tool1"] = {"actual": 150.2, "target": 170.0, "offset": 0}
+        temperature_data["chamber"] = {"actual": 31.5, "target": None, "offset": 0}
+    return printer_data, temperature_data
+
+
+def _cpu_per_tick(funcs, ticks, repeat=9):
+    """Best of ``repeat`` runs per function, like timeit. The functions take turns, so a busy
+    host slows all of them alike."""
+    best = {}
+    for _ in range(repeat):
+        for name, func in funcs.items():
+            start = time.process_time()
+            for _ in range(ticks):
+                func()
+            elapsed = (time.process_time() - start) / ticks
+            best[name] = min(best.get(name, elapsed), elapsed)
+    return best
+
+
+def bench(ticks, multi_tool):
+    printer_data, temperature_data = sample_data(multi_tool)
+
+    machine = MachineState()
+    if multi_tool:
+        machine.on_gcode_sent("M106", "M106 S204")
+        machine.on_gcode_sent("M220", "M220 S100")
+        machine.on_gcode_sent("M221", "M221 S95")
+        machine.on_z_change(0.2)
+    builder = SnapshotBuilder(machine)
+
+    engine = TelemetryEngine(None, None)
+    engine._last_sent = builder.build(printer_data, temperature_data)[0]
+    last = legacy_build(printer_data, temperature_data)[0]
+    deadbands = dict(temp_nozzle=0.5, temp_bed=0.5, progress=1.0)
+
+    build_funcs = {}
+    tick_funcs = {}
+    fields = {}
+    for name, build, has_changed in (
+            ("legacy", legacy_build, lambda snapshot: legacy_has_changed(last, snapshot, deadbands)),
+            ("field_map", builder.build, engine._has_changed)):
+        fields[name] = len(build(printer_data, temperature_data)[0]) # Also compiles the field map
+        build_funcs[name] = lambda build=build: build(printer_data, temperature_data)
+        tick_funcs[name] = lambda build=build, has_changed=has_changed: has_changed(build(printer_data, temperature_data)[0])
+
+    build_us = _cpu_per_tick(build_funcs, ticks)
+    tick_us = _cpu_per_tick(tick_funcs, ticks)
+    return {name: {"fields": fields[name], "build_us": build_us[name] * 1e6, "tick_us": tick_us[name] * 1e6}
+            for name in fields}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ticks", type=int, default=100000)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    results = {printer: bench(args.ticks, printer == "multi_tool") for printer in ("mk3", "multi_tool")}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'printer':<11} {'builder':<10} {'fields':>6} {'build us':>9} {'tick us':>8}")
+    for printer, builders in results.items():
+        for name, data in builders.items():
+            print(f"{printer:<11} {name:<10} {data['fields']:>6} {data['build_us']:>9.2f} {data['tick_us']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
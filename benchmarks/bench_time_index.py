@@ -0,0 +1,116 @@
+# coding=utf-8
+"""Benchmark for the G-code time index behind the time remaining.
+
+Writes synthetic G-code files of ``--sizes`` MB in the three flavours the
+index understands: PrusaSlicer (``M73 ... R`` markers), Cura
+(``;TIME_ELAPSED`` per layer) and plain moves. For each it reports the time
+to build the index (once per file, on the worker thread), its markers and
+bytes, and the time of one lookup at a random file position, which is what
+every telemetry tick of a print costs.
+
+Usage::
+
+    python benchmarks/bench_time_index.py [--sizes 1 10 50] [--lookups 100000] [--json]
+
+Build times are wall time of one build, lookups the best of five runs.
+"""
+from __future__ import absolute_import
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from octoprint_prusaconnectbridge.timeindex import build  # noqa: E402
+
+FLAVOURS = ("m73", "cura", "moves")
+
+
+def _layer(layer):
+    lines = [f"G1 Z{layer * 0.2:.2f} F720\n"]
+    for row in range(400):
+        x = 10.0 if row % 2 else 200.0
+        lines.append(f"G1 X{x:.3f} Y{10.0 + row * 0.45:.3f} E{random.uniform(4.0, 6.0):.5f} F2400\n")
+    return "".join(lines).encode()
+
+
+def write_gcode(f, size, flavour):
+    """Writes about ``size`` bytes of a layered zig-zag print, with the flavour's time markers."""
+    # The markers are what the moves take, so every flavour describes the same print
+    layer_seconds = 400 * math.hypot(190.0, 0.45) / 40.0 + 0.2 / 12.0
+    layers = max(size // len(_layer(1)), 1)
+    total_seconds = layers * layer_seconds
+    if flavour == "cura":
+        f.write(f";FLAVOR:Marlin\n;TIME:{total_seconds:.0f}\n".encode())
+    f.write(b"G90\nM83\nG1 Z0.2 F720\n")
+    percent = -1
+    for layer in range(1, layers + 1):
+        done = (layer - 1) / layers
+        if flavour == "m73" and int(done * 100) != percent:
+            percent = int(done * 100)
+            f.write(f"M73 P{percent} R{(1.0 - done) * total_seconds / 60.0:.0f}\n".encode())
+        f.write(_layer(layer))
+        if flavour == "cura":
+            f.write(f";TIME_ELAPSED:{layer * layer_seconds:.3f}\n".encode())
+    if flavour == "m73":
+        f.write(b"M73 P100 R0\n")
+
+
+def bench(size_mb, flavour, lookups):
+    with tempfile.NamedTemporaryFile(suffix=".gcode", delete=False) as f:
+        write_gcode(f, int(size_mb * 1024 * 1024), flavour)
+    try:
+        size = os.path.getsize(f.name)
+        start = time.perf_counter()
+        index = build(f.name, "bench.gcode")
+        build_seconds = time.perf_counter() - start
+    finally:
+        os.unlink(f.name)
+
+    positions = [random.randrange(size) for _ in range(lookups)]
+    best = None
+    for _ in range(5):
+        start = time.perf_counter()
+        for position in positions:
+            index.remaining(position)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return dict(
+        size_mb=round(size / 1048576.0, 1),
+        flavour=flavour,
+        source=index.source,
+        total_seconds=round(index.total),
+        build_seconds=round(build_seconds, 3),
+        build_mb_per_second=round(size / 1048576.0 / build_seconds, 1),
+        markers=len(index.offsets),
+        index_bytes=len(index.offsets.tobytes()) + len(index.seconds.tobytes()),
+        lookup_us=round(best / lookups * 1e6, 3),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 10, 50], help="File sizes in MB")
+    parser.add_argument("--lookups", type=int, default=100000)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    random.seed(0)
+    results = [bench(size, flavour, args.lookups) for size in args.sizes for flavour in FLAVOURS]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'MB':>6} {'flavour':>7} {'total s':>8} {'build s':>8} {'MB/s':>6} {'markers':>8} {'bytes':>8} {'lookup us':>10}")
+    for r in results:
+        print(f"{r['size_mb']:>6} {r['flavour']:>7} {r['total_seconds']:>8} {r['build_seconds']:>8} "
+              f"{r['build_mb_per_second']:>6} {r['markers']:>8} {r['index_bytes']:>8} {r['lookup_us']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,430 @@
+# coding=utf-8
+"""Fakes for running the bridge outside of OctoPrint.
+
+Stand-ins for the objects OctoPrint injects into the plugin (``_settings``,
+``_printer``, ``_file_manager``, ``_plugin_manager``) and a local HTTP server
+playing connect.prusa3d.com, so benchmarks exercise the real plugin code, the
+real SDK and real HTTP requests without a printer or network.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+FILES_PER_FOLDER = 200
+FOLDERS_PER_PARENT = 20
+
+
+def synthetic_listing(file_count):
+    """Builds a ``list_files`` style listing with ``file_count`` gcodes spread over nested folders."""
+    root = {}
+    folder_count = max(1, file_count // FILES_PER_FOLDER)
+    created = 0
+    for folder_number in range(folder_count):
+        parent = root.setdefault(f"batch_{folder_number // FOLDERS_PER_PARENT:04d}",
+                                 {"type": "folder", "date": 1700000000, "children": {}})
+        folder = parent["children"].setdefault(f"job_{folder_number:05d}",
+                                               {"type": "folder", "date": 1700000000, "children": {}})
+        for _ in range(min(FILES_PER_FOLDER, file_count - created)):
+            folder["children"][f"part_{created:07d}_0.2mm_PLA_MK3S_1h2m.gcode"] = {
+                "type": "machinecode",
+                "size": 1024 * 1024 + created,
+                "date": 1700000000 + created,
+                "gcodeAnalysis": {"estimatedPrintTime": 3600.0 + created},
+            }
+            created += 1
+    return {"local": root}
+
+
+def synthetic_path(number):
+    """Path of the ``number``-th file of a :func:`synthetic_listing`."""
+    folder_number = number // FILES_PER_FOLDER
+    return (f"batch_{folder_number // FOLDERS_PER_PARENT:04d}/job_{folder_number:05d}/"
+            f"part_{number:07d}_0.2mm_PLA_MK3S_1h2m.gcode")
+
+
+##~~ OctoPrint fakes
+
+class FakeSettings(object):
+    """Plugin settings backed by a dict, with the plugin's defaults underneath."""
+
+    def __init__(self, defaults, **overrides):
+        self._values = dict(defaults)
+        self._values.update(overrides)
+        self.saves = 0
+
+    def get(self, path, **kwargs):
+        return self._values.get(path[0])
+
+    def get_float(self, path, **kwargs):
+        value = self.get(path)
+        return float(value) if value is not None else None
+
+    def get_int(self, path, **kwargs):
+        value = self.get(path)
+        return int(value) if value is not None else None
+
+    def get_boolean(self, path, **kwargs):
+        return bool(self.get(path))
+
+    def global_get(self, path, **kwargs):
+        return None # No webcam configured in OctoPrint
+
+    def set(self, path, value, **kwargs):
+        self._values[path[0]] = value
+
+    def save(self, **kwargs):
+        self.saves += 1
+
+
+class FakePrinter(object):
+    """Printer with OctoPrint's current data layout. :meth:`push` plays OctoPrint's callbacks."""
+
+    def __init__(self):
+        self._callbacks = []
+        self.printing = False
+        self.paused = False
+        self.selected = None
+        self.nozzle = 25.0
+        self.bed = 25.0
+        self.completion = None
+
+    def register_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def unregister_callback(self, callback):
+        if callback in self._callbacks:
+            self._callbacks.remove(callback)
+
+    def get_printer_profile(self):
+        return {"serial": None}
+
+    def get_current_data(self):
+        return {
+            "state": {"flags": {
+                "operational": True, "printing": self.printing, "paused": self.paused,
+                "error": False, "closedOrError": False, "ready": not self.printing and not self.paused,
+            }},
+            "job": {"file": {"name": self.selected}},
+            "progress": {"completion": self.completion},
+        }
+
+    def get_current_temperatures(self):
+        return {"tool0": {"actual": self.nozzle, "target": 0.0}, "bed": {"actual": self.bed, "target": 0.0}}
+
+    def push(self):
+        """Calls the callbacks with the current data. Returns the temperatures they got."""
+        data = self.get_current_data()
+        temperatures = self.get_current_temperatures()
+        for callback in list(self._callbacks):
+            callback.on_printer_add_temperature(temperatures)
+            callback.on_printer_send_current_data(data)
+        return temperatures
+
+    def is_printing(self):
+        return self.printing
+
+    def is_paused(self):
+        return self.paused
+
+    def select_file(self, path, sd, printAfterSelect=False, **kwargs):
+        self.selected = os.path.basename(path)
+        self.printing = printAfterSelect
+        self.paused = False
+
+    def cancel_print(self, **kwargs):
+        self.printing = self.paused = False
+
+    def pause_print(self, **kwargs):
+        self.paused = True
+
+    def resume_print(self, **kwargs):
+        self.paused = False
+
+
+class FakeFileManager(object):
+    """File manager serving a synthetic listing, see :func:`synthetic_listing`."""
+
+    def __init__(self, file_count=0, basedir="/tmp/octoprint-bench-uploads"):
+        self._listing = synthetic_listing(file_count) if file_count else {"local": {}}
+        self._basedir = basedir
+        self.list_calls = 0
+
+    def list_files(self, recursive=True, locations=None, path=None):
+        self.list_calls += 1
+        return self._listing
+
+    def file_exists(self, storage, path):
+        return True
+
+    def path_on_disk(self, storage, path):
+        return os.path.join(self._basedir, path.lstrip("/"))
+
+    def get_basedir(self, storage):
+        return self._basedir
+
+    def get_metadata(self, storage, path):
+        return {}
+
+
+class FakePluginManager(object):
+    def __init__(self):
+        self.messages = 0
+
+    def send_plugin_message(self, identifier, data):
+        self.messages += 1
+
+
+def make_plugin(server_url, file_count=0, **settings):
+    """Creates the plugin wired up to the fakes, as OctoPrint would before ``on_after_startup``."""
+    from octoprint_prusaconnectbridge import PrusaConnectBridgePlugin
+
+    plugin = PrusaConnectBridgePlugin()
+    plugin._identifier = "prusaconnectbridge"
+    plugin._data_folder = tempfile.mkdtemp(prefix="prusaconnectbridge-data-")
+    plugin._settings = FakeSettings(plugin.get_settings_defaults(), prusa_server_url=server_url,
+                                    prusa_connect_token="bench-token", **settings)
+    plugin._printer = FakePrinter()
+    plugin._file_manager = FakeFileManager(file_count)
+    plugin._plugin_manager = FakePluginManager()
+    plugin.on_settings_initialized()
+    return plugin
+
+
+##~~ Prusa Connect fake
+
+class Faults(object):
+    """Network faults :class:`FakeConnectServer` plays. Can be changed while it runs.
+
+    Every request is delayed by ``latency`` seconds, answered with a 503 at
+    ``error_rate`` and has its connection closed without an answer at
+    ``drop_rate``. During ``outages``, ``(start, duration)`` pairs in seconds
+    since the server started, every connection is closed without an answer.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, drop_rate=0.0, outages=(), seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.outages = list(outages)
+        self._random = random.Random(seed)
+
+    def pick(self, elapsed):
+        """The fault for a request ``elapsed`` seconds after the start: None, "error" or "drop"."""
+        if any(start <= elapsed < start + duration for start, duration in self.outages):
+            return "drop"
+        roll = self._random.random()
+        if roll < self.drop_rate:
+            return "drop"
+        if roll < self.drop_rate + self.error_rate:
+            return "error"
+        return None
+
+
+class FakeConnectServer(object):
+    """Local stand-in for connect.prusa3d.com.
+
+    Records every telemetry and event request with its arrival time and hands
+    out queued commands in telemetry responses, like Connect does. Every
+    request is also logged in :attr:`requests` with its wall clock arrival
+    and the printer's fingerprint, for comparisons across processes.
+    ``faults`` (see :class:`Faults`) makes it misbehave.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, faults=None):
+        self.faults = faults or Faults()
+        self._started_at = None
+        self._lock = threading.Condition()
+        self._commands = deque()
+        self._next_command_id = 1
+        self.telemetry = [] # (arrival, payload)
+        self.events = [] # (arrival, payload)
+        self.snapshots = [] # (arrival, size)
+        self.snapshot_delay = 0.0 # Seconds each snapshot upload takes, to play a slow uplink
+        self.requests = [] # (time.time(), fingerprint, path, telemetry payload or None)
+        self.faulted = {"error": 0, "drop": 0}
+        # command_id -> time the command was handed to the printer
+        self.issued = {}
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, like Connect
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                # Headers and body go out in separate writes, don't let Nagle hold the body back
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                if not server._fault(self):
+                    server._handle(self, json.loads(body or b"null"))
+
+            def do_PUT(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                if not server._fault(self):
+                    server._handle_snapshot(self, body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True, name="FakeConnectServer")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def queue_command(self, command, args=None, kwargs=None):
+        """Queues a command for the next telemetry response. Returns its command id."""
+        with self._lock:
+            command_id = self._next_command_id
+            self._next_command_id += 1
+            self._commands.append((command_id, {"command": command, "args": args or [], "kwargs": kwargs or {}}))
+            return command_id
+
+    def wait_for_event(self, command_id, events=("FINISHED", "FAILED", "REJECTED", "INFO"), timeout=10.0):
+        """Waits for a final event of ``command_id``. Returns (arrival, payload) or None."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                for arrival, payload in self.events:
+                    if payload.get("command_id") == command_id and payload.get("event") in events:
+                        return arrival, payload
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._lock.wait(remaining)
+
+    def wait_for_event_matching(self, match, timeout=10.0):
+        """Waits for an event whose payload satisfies ``match(payload)``. Returns (arrival, payload) or None."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                for arrival, payload in self.events:
+                    if match(payload):
+                        return arrival, payload
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._lock.wait(remaining)
+
+    def wait_for_telemetry(self, count, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while len(self.telemetry) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+            return True
+
+    def wait_for_telemetry_matching(self, match, timeout=10.0):
+        """Waits for a telemetry whose payload satisfies ``match(payload)``. Returns its arrival or None."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                for arrival, payload in self.telemetry:
+                    if match(payload):
+                        return arrival
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._lock.wait(remaining)
+
+    def reset(self):
+        with self._lock:
+            self.telemetry = []
+            self.events = []
+            self.snapshots = []
+            self.requests = []
+            self.issued = {}
+
+    def _fault(self, request):
+        """Plays the fault picked for this request, if any. Returns True if the request got one."""
+        faults = self.faults
+        if faults.latency:
+            time.sleep(faults.latency)
+        fault = faults.pick(time.monotonic() - self._started_at)
+        if fault is None:
+            return False
+        with self._lock:
+            self.faulted[fault] += 1
+        if fault == "error":
+            request.send_response(503)
+            request.send_header("Content-Length", "0")
+            request.end_headers()
+        else:
+            # No answer at all, the client sees the connection reset
+            request.close_connection = True
+            request.request.shutdown(socket.SHUT_RDWR)
+        return True
+
+    def _handle(self, request, payload):
+        arrival = time.perf_counter()
+        command = None
+        with self._lock:
+            self.requests.append((time.time(), request.headers.get("Fingerprint"), request.path,
+                                  payload if request.path == "/p/telemetry" else None))
+            if request.path == "/p/telemetry":
+                self.telemetry.append((arrival, payload))
+                if self._commands:
+                    command_id, command = self._commands.popleft()
+                    self.issued[command_id] = time.perf_counter()
+            elif request.path == "/p/events":
+                self.events.append((arrival, payload))
+            self._lock.notify_all()
+
+        if request.path == "/p/camera":
+            request.send_response(200)
+            request.send_header("Token", "bench-camera-token")
+            request.send_header("Content-Length", "0")
+            request.end_headers()
+            return
+        if command is None:
+            request.send_response(204)
+            request.end_headers()
+            return
+        body = json.dumps(command).encode("utf-8")
+        request.send_response(200)
+        request.send_header("Command-Id", str(command_id))
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _handle_snapshot(self, request, body):
+        if self.snapshot_delay:
+            time.sleep(self.snapshot_delay)
+        with self._lock:
+            self.requests.append((time.time(), request.headers.get("Fingerprint"), request.path, None))
+            self.snapshots.append((time.perf_counter(), len(body)))
+            self._lock.notify_all()
+        request.send_response(204)
+        request.end_headers()
@@ -0,0 +1,367 @@
+# coding=utf-8
+"""Fleet load simulator: many bridges against one local fake Prusa Connect.
+
+Starts ``--instances`` worker processes, each running one
+:class:`~octoprint_prusaconnectbridge.PrusaConnectBridgePlugin` with a
+:class:`SimulatedPrinter` and a fake file library of ``--files`` G-codes, all
+sending to one :class:`~fakes.FakeConnectServer` in this process. The
+simulated printers heat up, print and cool down on their own clock, with
+sensor noise, so telemetry goes out at the rate real printers cause.
+
+Reported per instance, over the ``--duration`` after its startup:
+
+* CPU in percent of one core, RSS and peak RSS, most threads seen
+* requests per second received from it, telemetry per second
+* telemetry latency (p50/p99), from the printer callback that caused a send
+  to its arrival at the server
+
+and for the fleet the totals, the server's own CPU and the faults it played.
+Faults are injected by the server: ``--latency-ms`` on every request,
+``--error-rate`` (503 answers), ``--drop-rate`` (connections closed without
+an answer) and ``--outage START:DURATION`` (everything dropped for a while,
+seconds since the server started, repeatable).
+
+Usage::
+
+    python benchmarks/fleet.py [--instances 10] [--duration 60] [--files 1000]
+                               [--latency-ms 50] [--error-rate 0.01] [--drop-rate 0.01]
+                               [--outage 20:10] [--camera] [--async-core] [--output fleet.json]
+
+The fake server is a threaded Python HTTP server, with large fleets its own
+CPU (reported as ``server_cpu_percent``) can become the limit first.
+"""
+from __future__ import absolute_import
+
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_bridge import summarize  # noqa: E402
+from fakes import FakeConnectServer, FakePrinter, Faults, make_plugin, synthetic_path  # noqa: E402
+
+
+class SimulatedPrinter(FakePrinter):
+    """Printer running print jobs on a clock: idle, heat up, print, cool down, again.
+
+    Temperatures approach their targets (or the ambient temperature) on
+    first-order curves, the bed slower than the nozzle, and are read with
+    sensor noise. A job starts heating after ``idle_seconds``, prints once the
+    nozzle and bed are up to temperature and takes ``job_seconds``.
+    """
+
+    AMBIENT = 25.0
+    NOZZLE_TARGET = 215.0
+    BED_TARGET = 60.0
+    # Time constants in seconds of (heating, cooling)
+    NOZZLE_TAU = (25.0, 90.0)
+    BED_TAU = (90.0, 300.0)
+    NOISE = 0.1
+
+    def __init__(self, file_count, job_seconds=600.0, idle_seconds=60.0, seed=None):
+        FakePrinter.__init__(self)
+        self._random = random.Random(seed)
+        self._file_count = file_count
+        self.job_seconds = job_seconds
+        self.idle_seconds = idle_seconds
+        self.target_nozzle = self.target_bed = 0.0
+        self.phase = "idle"
+        # Instances start somewhere into their idle time, so they don't all heat up together
+        self._phase_started = time.monotonic() - self._random.uniform(0.0, idle_seconds)
+        self._last = time.monotonic()
+
+    def step(self):
+        now = time.monotonic()
+        dt, self._last = now - self._last, now
+        self.nozzle = self._approach(self.nozzle, self.target_nozzle, self.NOZZLE_TAU, dt)
+        self.bed = self._approach(self.bed, self.target_bed, self.BED_TAU, dt)
+        elapsed = now - self._phase_started
+
+        if self.phase == "idle" and elapsed >= self.idle_seconds:
+            if self._file_count:
+                self.selected = os.path.basename(synthetic_path(self._random.randrange(self._file_count)))
+            self.target_nozzle, self.target_bed = self.NOZZLE_TARGET, self.BED_TARGET
+            self.printing = True
+            self.completion = 0.0
+            self._enter("heating", now)
+        elif self.phase == "heating" and self.nozzle >= self.target_nozzle - 2.0 and self.bed >= self.target_bed - 1.0:
+            self._enter("printing", now)
+        elif self.phase == "printing":
+            self.completion = min(elapsed / self.job_seconds * 100.0, 100.0)
+            if self.completion >= 100.0:
+                self.target_nozzle = self.target_bed = 0.0
+                self.printing = False
+                self._enter("cooling", now)
+        elif self.phase == "cooling" and self.nozzle < 50.0:
+            self.completion = None
+            self._enter("idle", now)
+
+    def _enter(self, phase, now):
+        self.phase = phase
+        self._phase_started = now
+
+    def _approach(self, value, target, tau, dt):
+        goal = target or self.AMBIENT
+        return goal + (value - goal) * math.exp(-dt / (tau[0] if goal > value else tau[1]))
+
+    def get_current_temperatures(self):
+        return {
+            "tool0": {"actual": round(self.nozzle + self._random.gauss(0.0, self.NOISE), 2),
+                      "target": self.target_nozzle},
+            "bed": {"actual": round(self.bed + self._random.gauss(0.0, self.NOISE), 2), "target": self.target_bed},
+        }
+
+
+##~~ Worker
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _emitted(metrics):
+    return sum(value for (name, _), value in list(metrics._counters.items())
+               if name == "prusaconnect_telemetry_emitted_total")
+
+
+def run_worker(args):
+    """Runs one simulated bridge and prints its measurements as one line of JSON."""
+    settings = dict(prusa_connect_sn=f"FLEET{args.index:05d}", telemetry_replay_jitter=1.0)
+    if args.async_core:
+        settings["sdk_async_core"] = True
+    frame_path = None
+    if args.camera:
+        # A JPEG as far as the pipeline can tell, uploaded as is without Pillow
+        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as f:
+            f.write(b"\xff\xd8" + os.urandom(100 * 1024))
+        frame_path = f.name
+        settings.update(camera_snapshot_url=frame_path)
+
+    plugin = make_plugin(args.server, file_count=args.files, **settings)
+    printer = plugin._printer = SimulatedPrinter(args.files, job_seconds=args.job_seconds,
+                                                 idle_seconds=args.idle_seconds, seed=args.index)
+    plugin.on_after_startup()
+    plugin._wait_for_startup(plugin.SHUTDOWN_WAIT)
+
+    # (time.time() of the callback, nozzle, bed) of the callbacks that sent telemetry
+    sends = []
+    threads = threading.active_count()
+    started, cpu_started = time.time(), _cpu_seconds()
+    deadline = time.monotonic() + args.duration
+    # OctoPrint's callbacks come about every two seconds, not in step across printers
+    next_push = time.monotonic() + random.Random(args.index).uniform(0.0, args.push_interval)
+    try:
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            time.sleep(max(next_push - now, 0.0))
+            next_push += args.push_interval
+            printer.step()
+            emitted = _emitted(plugin._metrics)
+            pushed_at = time.time()
+            temperatures = printer.push()
+            if _emitted(plugin._metrics) > emitted:
+                sends.append((pushed_at, temperatures["tool0"]["actual"], temperatures["bed"]["actual"]))
+            threads = max(threads, threading.active_count())
+        ended, cpu_ended = time.time(), _cpu_seconds()
+        rss = _rss_bytes()
+        result = dict(
+            index=args.index,
+            sn=plugin._config.prusa_connect_sn,
+            fingerprints=[plugin.prusa_printer.fingerprint] + ([plugin._camera.fingerprint] if plugin._camera else []),
+            started=started,
+            ended=ended,
+            cpu_seconds=cpu_ended - cpu_started,
+            rss_bytes=rss,
+            rss_peak_bytes=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            threads=threads,
+            sends=sends,
+        )
+    finally:
+        plugin.on_shutdown()
+        if frame_path:
+            os.unlink(frame_path)
+    sys.stdout.write(json.dumps(result) + "\n")
+    sys.stdout.flush()
+
+
+##~~ Fleet
+
+def _instance_report(worker, requests):
+    """Measurements of one instance, with the server's log of its requests."""
+    window = worker["ended"] - worker["started"]
+    fingerprints = set(worker["fingerprints"])
+    mine = [(arrival, path, payload) for arrival, fingerprint, path, payload in requests
+            if fingerprint in fingerprints and worker["started"] <= arrival <= worker["ended"] + 1.0]
+    # Arrivals of each telemetry by its temperatures, to find the callback that caused it
+    arrivals = {}
+    for arrival, path, payload in mine:
+        if path == "/p/telemetry" and payload:
+            arrivals.setdefault((payload.get("temp_nozzle"), payload.get("temp_bed")), []).append(arrival)
+    latencies = []
+    for pushed_at, nozzle, bed in worker["sends"]:
+        arrived = [arrival for arrival in arrivals.get((nozzle, bed), ()) if arrival >= pushed_at]
+        if arrived:
+            latencies.append(arrived[0] - pushed_at)
+    latency = summarize(latencies)
+    in_window = [path for arrival, path, _ in mine if arrival <= worker["ended"]]
+    return dict(
+        sn=worker["sn"],
+        cpu_percent=worker["cpu_seconds"] / window * 100.0 if window else None,
+        rss_mb=worker["rss_bytes"] / 1048576.0 if worker["rss_bytes"] else None,
+        rss_peak_mb=worker["rss_peak_bytes"] / 1048576.0,
+        threads=worker["threads"],
+        requests_per_second=len(in_window) / window if window else None,
+        telemetry_per_second=sum(1 for path in in_window if path == "/p/telemetry") / window if window else None,
+        telemetry_sent=len(worker["sends"]),
+        telemetry_lost=len(worker["sends"]) - len(latencies),
+        latency_p50_ms=latency.get("p50"),
+        latency_p99_ms=latency.get("p99"),
+    )
+
+
+def _fleet_summary(instances, key, total=True):
+    values = sorted(instance[key] for instance in instances if instance[key] is not None)
+    if not values:
+        return None
+    summary = dict(mean=sum(values) / len(values), max=values[-1])
+    if total:
+        summary["total"] = sum(values)
+    return summary
+
+
+def run_fleet(args):
+    outages = []
+    for outage in args.outage:
+        start, _, duration = outage.partition(":")
+        outages.append((float(start), float(duration)))
+    faults = Faults(latency=args.latency_ms / 1000.0, error_rate=args.error_rate, drop_rate=args.drop_rate,
+                    outages=outages, seed=0)
+    server = FakeConnectServer(faults=faults).start()
+    cpu_started = _cpu_seconds()
+    started = time.time()
+
+    command = [sys.executable, os.path.abspath(__file__), "--worker", "--server", server.url,
+               "--duration", str(args.duration), "--files", str(args.files),
+               "--push-interval", str(args.push_interval), "--job-seconds", str(args.job_seconds),
+               "--idle-seconds", str(args.idle_seconds)]
+    if args.camera:
+        command.append("--camera")
+    if args.async_core:
+        command.append("--async-core")
+    if args.verbose:
+        command.append("--verbose")
+    processes = []
+    try:
+        for index in range(args.instances):
+            processes.append(subprocess.Popen(command + ["--index", str(index)], stdout=subprocess.PIPE))
+            # Spread the startups, a host restarting all bridges at once is a scenario of its own
+            time.sleep(args.ramp / max(args.instances, 1))
+        workers, failed = [], 0
+        for process in processes:
+            try:
+                output, _ = process.communicate(timeout=args.duration + 120.0)
+                workers.append(json.loads(output.decode("utf-8").strip().splitlines()[-1]))
+            except Exception as e:
+                failed += 1
+                logging.getLogger("fleet").error(f"Worker {process.args[-1]} failed: {e}")
+                process.kill()
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+        server.stop()
+    elapsed = time.time() - started
+    server_cpu = _cpu_seconds() - cpu_started
+
+    with server._lock:
+        requests = list(server.requests)
+    instances = [_instance_report(worker, requests) for worker in workers]
+    return dict(
+        instances=len(instances),
+        failed=failed,
+        cpu_count=os.cpu_count(),
+        server_cpu_percent=server_cpu / elapsed * 100.0 if elapsed else None,
+        faults=dict(latency_ms=args.latency_ms, error_rate=args.error_rate, drop_rate=args.drop_rate,
+                    outages=outages, played=dict(server.faulted)),
+        fleet=dict(
+            {key: _fleet_summary(instances, key) for key in
+             ("cpu_percent", "rss_mb", "threads", "requests_per_second", "telemetry_per_second",
+              "telemetry_sent", "telemetry_lost")},
+            **{key: _fleet_summary(instances, key, total=False) for key in ("latency_p50_ms", "latency_p99_ms")}),
+        per_instance=instances,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--instances", type=int, default=10, help="Simulated bridges, one process each")
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds measured per instance, after its startup")
+    parser.add_argument("--files", type=int, default=1000, help="G-codes in each fake library")
+    parser.add_argument("--push-interval", type=float, default=2.0, help="Seconds between printer callbacks")
+    parser.add_argument("--job-seconds", type=float, default=600.0, help="Print time of a simulated job")
+    parser.add_argument("--idle-seconds", type=float, default=30.0, help="Idle time before the next job")
+    parser.add_argument("--ramp", type=float, default=5.0, help="Seconds over which the instances are started")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Delay the server adds to every request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 503")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="Share of connections closed without an answer")
+    parser.add_argument("--outage", action="append", default=[], metavar="START:DURATION",
+                        help="Drop every connection for DURATION seconds, START seconds after the server started")
+    parser.add_argument("--camera", action="store_true", help="Send camera snapshots too")
+    parser.add_argument("--async-core", action="store_true", help="Run the bridges with the sdk_async_core setting")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="Show plugin and SDK logging")
+    # Internal, how the fleet starts its workers
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--server", help=argparse.SUPPRESS)
+    parser.add_argument("--index", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR, stream=sys.stderr)
+    if args.worker:
+        run_worker(args)
+        return
+
+    from prusa.connect.printer import __version__ as sdk_version
+    from octoprint_prusaconnectbridge import __plugin_version__
+
+    results = {
+        "plugin_version": __plugin_version__,
+        "sdk_version": sdk_version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "settings": dict(async_core=args.async_core, camera=args.camera, files=args.files,
+                         duration=args.duration, push_interval=args.push_interval),
+        "results": run_fleet(args),
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
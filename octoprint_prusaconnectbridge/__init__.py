@@ -1,30 +1,33 @@
 # coding=utf-8
 from __future__ import absolute_import
 
+import time
+_IMPORT_STARTED = time.perf_counter() # Plugin import time is reported with the startup timings
+
+# Only what OctoPrint has loaded anyway and the plugin's light modules are imported here. The Prusa
+# Connect SDK, flask and everything built on the SDK (bridge, commands, connection, telemetry) are
+# imported where they are used, by then in the background after startup.
 import octoprint.plugin
 import logging # Import the logging module
-import re # Import the regular expression module
-from prusa.connect.printer import Printer, const
-import threading
-import uuid
-import hashlib
-import time
 import os
-import flask # Added for API command response
-# Ensure threading is imported if not already (it was from previous steps)
-# import threading
-from octoprint.util import RepeatedTimer
+import threading
 ### from prusa.connect.printer.filesystem import FileSystemNode, NodeType  # SDK <= 0.7.0
-# octoprint.plugin required for SettingsPlugin.on_settings_save
-import octoprint.plugin
 from octoprint.plugin import WizardPlugin # Import WizardPlugin
 from octoprint.events import Events # Added for EventHandlerPlugin
+from .config import Config, settings_defaults
+from .events import EventQueue
+from .files import AmbiguousFile, FileIndex
+from .lifecycle import SdkLifecycle
+from .metrics import Metrics
+from .status import ConnectStatus
+from .storage import StorageMonitor
 
 
 class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
                              octoprint.plugin.AssetPlugin,
                              octoprint.plugin.TemplatePlugin,
                              octoprint.plugin.StartupPlugin,
+                             octoprint.plugin.ShutdownPlugin,
                              octoprint.plugin.SimpleApiPlugin,
                              octoprint.plugin.EventHandlerPlugin, # Added EventHandlerPlugin
                              WizardPlugin): # Add WizardPlugin
@@ -33,50 +36,116 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
         # Initialize the logger
         self._logger = logging.getLogger("octoprint.plugins.PrusaConnectBridge")
         self._logger.info("PrusaConnectBridgePlugin: Initializing...")
-        self.prusa_printer = None
-        # self.prusa_printer_thread = None # Unused, sdk_thread is used
-        self.sdk_thread = None
+        # Hot path timings and counters, exported by on_api_get
+        self._metrics = Metrics()
+        # Registration status for the UI, updated on transitions and pushed debounced
+        self._status = ConnectStatus(self._push_status, logger=logging.getLogger("octoprint.plugins.PrusaConnectBridge.status"))
+        # Owns the SDK Printer object (self.prusa_printer) and its loop thread (self.sdk_thread)
+        self._sdk = SdkLifecycle(logger=logging.getLogger("octoprint.plugins.PrusaConnectBridge.lifecycle"),
+                                 metrics=self._metrics,
+                                 on_alive_change=lambda alive: self._status.update(sdk_alive=alive))
         self.prusa_server = "https://connect.prusa3d.com" # Default, will be overridden by settings
         self.token_retrieval_timer = None
         self.temp_code_displayed = False
-        self.telemetry_timer = None
-        self.last_status_sent_to_ui = ""
-        self._registration_error_message = None # For wizard error reporting
+        self._telemetry_engine = None # Change-driven telemetry, created in _start_telemetry_timer
+        self._telemetry_buffer = None # Telemetry kept while Prusa Connect is unreachable, replayed afterwards
+        self._machine = None # Fans, feedrate, flow and layer from the G-codes sent, created in _setup_sdk
+        self._snapshots = None # Compiled telemetry field map, created in _setup_sdk
+        self._file_index = None # Machinecode file index for SEND_INFO, created in on_after_startup
+        self._file_sync = None # Sends Prusa Connect the file index's changes, created with the SDK
+        self._storage = None # Cached free space of the upload folder, created in on_after_startup
+        self._metadata = None # Slicer metadata and thumbnails per file, parsed once, created in _setup_sdk
+        self._times = None # Print time by file position per G-code, for the time remaining, see timeindex.py
+        self._command_executor = None # Runs Prusa Connect commands off the SDK loop thread
+        self._downloads = None # Files Prusa Connect sends to the printer, see downloads.py
+        self._bridge = None # Other OctoPrint instances bridged from this process, see bridge.py
+        self._camera = None # Webcam snapshots for Prusa Connect, see camera.py
+        self._http = None # Pooled keep-alive session for all Prusa Connect traffic, created with the settings
+        self._config = None # Immutable settings snapshot, loaded with the settings and refreshed on save
+        # Held around every read-modify-write of the settings, they are written from the SDK, bridge, camera and API threads
+        self._settings_lock = threading.RLock()
+        self._startup_thread = None # Sets up the SDK after startup, off OctoPrint's startup path
+        # Settings saved before the setup is done are applied by it, against the config from before the first save
+        self._startup_lock = threading.Lock()
+        self._setup_done = False
+        self._config_before_setup_saves = None
+        # OctoPrint events for Prusa Connect, coalesced per key and handled off the event bus
+        self._events = EventQueue(self._handle_event, logger=logging.getLogger("octoprint.plugins.PrusaConnectBridge.events"),
+                                  metrics=self._metrics)
+        # Seconds spent per startup phase: import, settings_initialized, after_startup and (in the background) sdk_ready
+        self._startup_timings = {"import": _IMPORT_SECONDS}
+        self._register_metric_gauges()
         self._logger.info("PrusaConnectBridgePlugin initialized.")
 
+    @property
+    def prusa_printer(self):
+        return self._sdk.printer
+
+    @property
+    def sdk_thread(self):
+        return self._sdk.thread
+
+    @property
+    def _registration_error_message(self):
+        # For wizard error reporting, part of the pushed status
+        return self._status["error"]
+
+    @_registration_error_message.setter
+    def _registration_error_message(self, message):
+        self._status.update(error=message)
+
 
     ##~~ SettingsPlugin mixin
 
     def get_settings_defaults(self):
-        return dict(
-            prusa_connect_sn=None,
-            prusa_connect_fingerprint=None,
-            prusa_connect_token=None,
-            prusa_connect_tmp_code=None,
-            prusa_server_url="https://connect.prusa3d.com", # Added
-            prusa_connect_manual_sn=None # Add this line
-        )
+        # The table with the defaults lives in config.py, next to the snapshot built from it
+        return settings_defaults()
+
+    def _write_settings(self, trigger_event=False, **values):
+        # Batched: one save for all values, and none at all if nothing changed
+        with self._settings_lock:
+            self._config = self._config.write(self._settings, values, trigger_event=trigger_event)
 
     def on_settings_initialized(self):
         self._logger.info("PrusaConnectBridgePlugin: Settings initialized.")
+        start = time.perf_counter()
 
-        self.prusa_server = self._settings.get(["prusa_server_url"]) # Load server URL
-        self.last_status_sent_to_ui = "" # Initialize for status pushing
-        # Initial status update can be triggered from on_after_startup or get_template_vars
-        # self._get_prusa_connect_status() # Initial status check and push
+        self._config = Config.load(self._settings)
+        self.prusa_server = self._config.prusa_server_url # Load server URL
+        self._status.update(sn=self._config.prusa_connect_sn,
+                            token=self._config.prusa_connect_token,
+                            tmp_code=self._config.prusa_connect_tmp_code)
+        self._events.configure(window=self._config.event_coalesce_window, maxlen=self._config.event_queue_size)
+        self._startup_timings["settings_initialized"] = time.perf_counter() - start
 
 
     def on_settings_save(self, data):
         self._logger.info("PrusaConnectBridgePlugin: on_settings_save called.")
-        old_server_url = self._settings.get(["prusa_server_url"])
-        old_active_sn = self._settings.get(["prusa_connect_sn"]) # Used for registration
-
         # Important: Let OctoPrint save the settings from 'data' first.
         # This will update prusa_connect_manual_sn and prusa_server_url if they were changed in UI.
-        octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        with self._settings_lock:
+            old_config = self._config
+            octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+            self._config = Config.load(self._settings)
+
+        # Saved while the SDK is still being set up: the changes are applied to what it set up once it is done,
+        # rather than holding up OctoPrint's request until then
+        if not self._wait_for_startup():
+            with self._startup_lock:
+                if not self._setup_done:
+                    if self._config_before_setup_saves is None:
+                        self._config_before_setup_saves = old_config
+                    self._logger.info("Settings saved while Prusa Connect is being set up, applying them once it is done.")
+                    return
+        self._apply_settings(old_config)
+
+    def _apply_settings(self, old_config):
+        """Applies the saved settings to the SDK, telemetry and the other parts, compared with ``old_config``."""
+        old_server_url = old_config.prusa_server_url
+        old_active_sn = old_config.prusa_connect_sn # Used for registration
 
         # Retrieve the potentially new server URL
-        self.prusa_server = self._settings.get(["prusa_server_url"])
+        self.prusa_server = self._config.prusa_server_url
 
         needs_sdk_reinitialization = False
         force_reregistration = False # Implies clearing token and tmp_code
@@ -91,21 +160,21 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
         # 1. Consider the new prusa_connect_manual_sn (just saved by OctoPrint).
         # 2. Determine the new active prusa_connect_sn and prusa_connect_fingerprint.
         # 3. Save these new active identifiers to settings.
-        new_active_sn, new_fingerprint = self._initialize_identifiers() # This method calls self._settings.save()
+        new_active_sn, new_fingerprint = self._initialize_identifiers() # Saves only if SN or fingerprint changed
 
         # Check if the active SN changed
         if old_active_sn != new_active_sn:
             self._logger.info(f"Active Serial Number changed. Old: '{old_active_sn}', New: '{new_active_sn}'.")
             needs_sdk_reinitialization = True
-            if self._settings.get(["prusa_connect_token"]): # If already registered
+            if self._config.prusa_connect_token: # If already registered
                 self._logger.warning("SN changed while registered. This requires re-registration with Prusa Connect.")
                 force_reregistration = True
 
         if force_reregistration:
             self._logger.info("Forcing re-registration: Clearing Prusa Connect token and temporary code.")
-            self._settings.set(["prusa_connect_token"], None)
-            self._settings.set(["prusa_connect_tmp_code"], None)
-            self._settings.save() # Persist cleared token/tmp_code immediately
+            self._write_settings(prusa_connect_token=None, prusa_connect_tmp_code=None) # Persist immediately
+            self._status.update(token=None, tmp_code=None)
+            self._forget_camera_token()
 
         if needs_sdk_reinitialization:
             self._logger.info("SDK needs re-initialization due to settings changes.")
@@ -116,39 +185,33 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
                     self.token_retrieval_timer.cancel()
                     self.token_retrieval_timer = None
                     self._logger.info("Token retrieval timer cancelled for SDK re-initialization.")
-                if self.telemetry_timer and self.telemetry_timer.is_alive():
-                    self.telemetry_timer.cancel()
-                    self.telemetry_timer = None
+                if self._telemetry_engine and self._telemetry_engine.is_alive():
+                    self._stop_telemetry_timer()
                     self._logger.info("Telemetry timer cancelled for SDK re-initialization.")
 
             try:
                 # Get the final SN and Fingerprint that _initialize_identifiers decided upon and saved
-                final_sn_for_sdk = self._settings.get(["prusa_connect_sn"])
-                final_fp_for_sdk = self._settings.get(["prusa_connect_fingerprint"])
+                final_sn_for_sdk = self._config.prusa_connect_sn
+                final_fp_for_sdk = self._config.prusa_connect_fingerprint
 
                 if not final_sn_for_sdk or not final_fp_for_sdk:
                     self._logger.error("Cannot re-initialize SDK: SN or Fingerprint is missing after _initialize_identifiers.")
                     raise ValueError("SN or Fingerprint missing, cannot create Printer object.")
 
-                self._logger.info(f"Re-creating Prusa SDK Printer object with SN: {final_sn_for_sdk}, FP: {final_fp_for_sdk[:10]}...")
-                self.prusa_printer = Printer(fingerprint=final_fp_for_sdk, sn=final_sn_for_sdk, printer_type=const.PrinterType.I3MK3)
-                self._logger.info("New Prusa SDK Printer object created.")
+                # The executor is bound to the old printer's command state
+                self._stop_command_executor()
 
-                current_token_for_sdk = self._settings.get(["prusa_connect_token"]) # Might be None if force_reregistration
-                self.prusa_printer.set_connection(server_url=self.prusa_server, token=current_token_for_sdk)
+                # Stops and joins the old loop before the new Printer object takes over
+                self._logger.info(f"Re-creating Prusa SDK Printer object with SN: {final_sn_for_sdk}, FP: {final_fp_for_sdk[:10]}...")
+                current_token_for_sdk = self._config.prusa_connect_token # Might be None if force_reregistration
+                self._sdk.create(final_sn_for_sdk, final_fp_for_sdk, server=self.prusa_server, token=current_token_for_sdk)
                 self._logger.info(f"SDK connection re-configured. Server: {self.prusa_server}, Token: {'Set' if current_token_for_sdk else 'None'}.")
 
                 self._register_sdk_handlers() # Re-register command handlers for the new printer object
-
-                # SDK Thread Management
-                if self.sdk_thread and self.sdk_thread.is_alive():
-                    self._logger.info("Previous SDK thread is alive. A new one will be started. The old one should exit as it's a daemon.")
-                    # Old thread will eventually terminate as its prusa_printer object is no longer referenced here.
+                self._start_command_executor()
 
                 self._logger.info("Starting new SDK loop thread after settings save.")
-                self.sdk_thread = threading.Thread(target=self.prusa_printer.loop, daemon=True, name="PrusaConnectSDKLoop-SettingsSave")
-                self.sdk_thread.start()
-                self._logger.info("New SDK loop thread started.")
+                self._sdk.start(name="PrusaConnectSDKLoop-SettingsSave")
 
                 if force_reregistration:
                     self._logger.info("Re-registration is now required. User may need to use Wizard or 'Clear & Re-register' button if not guided automatically.")
@@ -165,25 +228,71 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
                 self._logger.error(f"Error during SDK re-initialization: {e}", exc_info=True)
                 self._registration_error_message = f"Failed to re-initialize Prusa Connect SDK: {e}. Check logs."
                 # If SDK init fails, it's safer to clear the printer object
-                self.prusa_printer = None
-                if self.telemetry_timer and self.telemetry_timer.is_alive(): self.telemetry_timer.cancel()
+                self._stop_telemetry_timer()
+                self._stop_command_executor()
+                self._sdk.discard()
+
+        if self._telemetry_engine:
+            # Apply changed telemetry deadbands/heartbeat to the running engine
+            self._configure_telemetry_engine()
+
+        if self._command_executor and not needs_sdk_reinitialization:
+            old_workers = self._command_executor.workers
+            self._command_executor.configure(workers=self._config.command_workers,
+                                             timeout=self._config.command_timeout)
+            if self._command_executor.workers != old_workers:
+                # The pool size is fixed once started
+                self._start_command_executor()
+
+        self._events.configure(window=self._config.event_coalesce_window, maxlen=self._config.event_queue_size)
+
+        if self._http is not None:
+            self._http.resize(self._config.http_pool_size)
+
+        if self._storage is not None:
+            self._storage.configure(interval=self._config.storage_sample_interval,
+                                    low_percent=self._config.storage_low_space_percent,
+                                    change_percent=self._config.storage_change_percent)
+
+        if self._file_sync is not None:
+            self._file_sync.max_changes = self._config.file_sync_max_changes
+
+        if self._snapshots is not None and old_config.time_index_enabled != self._config.time_index_enabled:
+            if self._config.time_index_enabled:
+                self._open_time_index()
+            else:
+                self._close_time_index()
 
+        if self._downloads is not None:
+            self._downloads.chunk_size = self._config.download_chunk_size
+            self._downloads.retries = self._config.download_retries
 
-        # Always update the status display
-        self._get_prusa_connect_status()
+        if old_server_url != self.prusa_server or old_config.bridge_poll_interval != self._config.bridge_poll_interval:
+            self._start_bridge()
+
+        # The camera is registered under the printer's SN
+        if (self._camera is None or old_active_sn != new_active_sn
+                or old_config.camera_enabled != self._config.camera_enabled
+                or old_config.camera_snapshot_url != self._config.camera_snapshot_url):
+            self._start_camera()
+        else:
+            self._configure_camera()
 
     ##~~ StartupPlugin mixin
     def _initialize_identifiers(self):
+        import hashlib
+        import uuid
+
         self._logger.info("Attempting to initialize Prusa Connect identifiers (SN and Fingerprint)...")
         try:
-            manual_sn = self._settings.get(["prusa_connect_manual_sn"])
+            manual_sn = self._config.prusa_connect_manual_sn
             sn = None
 
             if manual_sn: # Check if manual_sn is not None and not empty
                 sn = manual_sn
                 self._logger.info(f"Using manual SN from settings: {sn}")
             else:
-                sn = self._settings.get(["prusa_connect_sn"])
+                sn = self._config.prusa_connect_sn
                 if not sn: # Check if sn is None or empty (it will be None if not set)
                     self._logger.info("SN not found in settings or manual SN not provided, attempting to generate a new one.")
                     if hasattr(self._printer, 'get_firmware_uuid') and self._printer.get_firmware_uuid():
@@ -198,18 +307,17 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
                 else:
                     self._logger.info(f"Using existing SN from settings: {sn}")
 
-            # Save the determined SN back to prusa_connect_sn for consistency
-            self._settings.set(["prusa_connect_sn"], sn)
-
-            fingerprint = self._settings.get(["prusa_connect_fingerprint"])
+            fingerprint = self._config.prusa_connect_fingerprint
             calculated_fingerprint = hashlib.sha256(sn.encode('utf-8')).hexdigest()
 
             if fingerprint != calculated_fingerprint:
                 self._logger.info(f"Fingerprint mismatch or not set. Current: '{fingerprint}', Calculated: '{calculated_fingerprint}'. Updating fingerprint.")
-                self._settings.set(["prusa_connect_fingerprint"], calculated_fingerprint)
                 fingerprint = calculated_fingerprint
 
-            self._settings.save() # Persist any changes to SN or fingerprint
+            # Save the determined SN back to prusa_connect_sn for consistency. Usually both are
+            # unchanged, then config.yaml isn't rewritten.
+            self._write_settings(prusa_connect_sn=sn, prusa_connect_fingerprint=fingerprint)
+            self._status.update(sn=sn)
 
             self._logger.info(f"Identifiers initialized. SN: {sn}, Fingerprint: {fingerprint[:10]}...")
             return sn, fingerprint
@@ -225,239 +333,340 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
 
     def on_after_startup(self):
         self._logger.info("PrusaConnectBridgePlugin: on_after_startup initiated.")
+        start = time.perf_counter()
+
+        # Built lazily on the first SEND_INFO, then kept current from file events
+        self._file_index = FileIndex(self._file_manager)
+        # Sampled on its own thread once the SDK is set up, SEND_INFO and downloads read the cached figures
+        self._storage = StorageMonitor(lambda: self._file_manager.get_basedir("local"),
+                                       interval=self._config.storage_sample_interval,
+                                       low_percent=self._config.storage_low_space_percent,
+                                       change_percent=self._config.storage_change_percent,
+                                       on_change=self._storage_changed,
+                                       logger=logging.getLogger("octoprint.plugins.PrusaConnectBridge.storage"),
+                                       metrics=self._metrics)
+
+        # Importing the SDK, creating the Printer and starting its threads doesn't hold up OctoPrint
+        self._startup_thread = threading.Thread(target=self._deferred_startup, args=(start,), daemon=True,
+                                                name="PrusaConnectBridgeStartup")
+        self._startup_thread.start()
+        self._startup_timings["after_startup"] = time.perf_counter() - start
+        self._logger.info("PrusaConnectBridgePlugin on_after_startup complete, SDK setup continues in the background.")
+
+    # Seconds requests wait for the background setup before answering that it is still running, and
+    # shutdown waits before going ahead anyway
+    STARTUP_WAIT = 5.0
+    SHUTDOWN_WAIT = 30.0
+
+    def _wait_for_startup(self, timeout=None):
+        """Waits up to ``timeout`` (``STARTUP_WAIT``) seconds for the background setup, returns whether it is done."""
+        thread = self._startup_thread
+        if thread is None or thread is threading.current_thread():
+            return True
+        thread.join(self.STARTUP_WAIT if timeout is None else timeout)
+        return not thread.is_alive()
+
+    def _deferred_startup(self, started):
+        try:
+            self._setup_sdk()
+        except Exception as e:
+            self._logger.error(f"Error setting up Prusa Connect after startup: {e}", exc_info=True)
+        finally:
+            self._startup_timings["sdk_ready"] = time.perf_counter() - started
+            timings = ", ".join(f"{phase} {seconds * 1000.0:.1f} ms"
+                                for phase, seconds in self._startup_timings.items())
+            self._logger.info(f"PrusaConnectBridgePlugin startup timings: {timings}.")
+            self._apply_settings_saved_during_setup()
+
+    def _apply_settings_saved_during_setup(self):
+        with self._startup_lock:
+            self._setup_done = True
+            old_config, self._config_before_setup_saves = self._config_before_setup_saves, None
+        if old_config is None:
+            return
+        self._logger.info("Applying the settings saved while Prusa Connect was being set up.")
+        try:
+            self._apply_settings(old_config)
+        except Exception as e:
+            self._logger.error(f"Error applying the settings saved during setup: {e}", exc_info=True)
+
+    def _setup_sdk(self):
+        from .connection import ConnectSession
+        from .filesync import FileSync
+        from .telemetry import MachineState, SnapshotBuilder
+
+        self._machine = MachineState()
+        self._snapshots = SnapshotBuilder(self._machine)
+
+        # Every SDK Printer (and bridged printer) sends through it, so connections survive re-creation
+        self._http = ConnectSession(pool_size=self._config.http_pool_size,
+                                    logger=logging.getLogger("octoprint.plugins.PrusaConnectBridge.connection"))
+        self._sdk.session = self._http.session
+        self._sdk.async_core = self._config.sdk_async_core
+        self._sdk.ssl_context = self._http.ssl_context
+        self._sdk.connections = self._config.http_pool_size
+
+        self._open_metadata_cache()
+        if self._config.time_index_enabled:
+            self._open_time_index()
+        self._storage.start()
+        self._file_sync = FileSync(self._file_index, lambda: self.prusa_printer, self._printer_info,
+                                   free_space=lambda: self._storage.free_space,
+                                   max_changes=self._config.file_sync_max_changes,
+                                   logger=logging.getLogger("octoprint.plugins.PrusaConnectBridge.filesync"),
+                                   metrics=self._metrics)
+
+        if self._config.prusa_connect_token:
+            # Registered, so SEND_INFO and START_PRINT will need it. Built here rather than on the first command.
+            self._file_index.rebuild()
 
         sn, fingerprint = self._initialize_identifiers()
 
+        token = self._config.prusa_connect_token
+
         try:
-            self.prusa_printer = Printer(fingerprint=fingerprint, sn=sn, printer_type=const.PrinterType.I3MK3)
-            self._logger.info(f"Prusa SDK Printer object created. SN: {sn}, Fingerprint: {fingerprint[:10]}...")
+            # The server is always set, registration needs it. The token may still be None.
+            self._sdk.create(sn, fingerprint, server=self.prusa_server, token=token)
         except Exception as e:
             self._logger.error(f"Failed to initialize Prusa SDK Printer object: {e}", exc_info=True)
-            self.last_status_sent_to_ui = ""
-            self._get_prusa_connect_status()
-            self._logger.info("PrusaConnectBridgePlugin on_after_startup finished due to critical SDK error.")
+            self._logger.info("PrusaConnectBridgePlugin SDK setup finished due to critical SDK error.")
             return
 
-        # Register command handlers
+        # Register command handlers, they are run by the command executor as Prusa Connect sends them
         self._register_sdk_handlers()
-
-        # The actual connection (with server and token) is set conditionally below or during registration.
-
-        token = self._settings.get(["prusa_connect_token"])
+        self._start_command_executor()
+        # Events queued since startup are handled from here on
+        self._events.start()
 
         if token:
-            self._logger.info("Token found in settings, attempting to connect to Prusa Connect.")
-            try:
-                self.prusa_printer.set_connection(server_url=self.prusa_server, token=token)
-                self._logger.info(f"SDK connection configured with server URL: {self.prusa_server} and existing token: {token[:4]}...{token[-4:]}")
-            except Exception as e:
-                self._logger.error(f"Error setting SDK connection with existing token: {e}", exc_info=True)
-
-            if not self.sdk_thread or not self.sdk_thread.is_alive():
-                self._logger.info("Starting SDK loop thread with existing token.")
-                self.sdk_thread = threading.Thread(target=self.prusa_printer.loop, daemon=True, name="PrusaConnectSDKLoop")
-                self.sdk_thread.start()
-                self._logger.info("SDK loop started with existing token.")
-            else:
-                self._logger.info("SDK loop thread already running.")
+            self._logger.info(f"SDK connection configured with server URL: {self.prusa_server} and existing token: {token[:4]}...{token[-4:]}")
+            self._logger.info("Starting SDK loop thread with existing token.")
+            self._sdk.start(name="PrusaConnectSDKLoop")
             self._start_telemetry_timer()
         else:
             self._logger.info("No token found in settings. Registration will be handled by the wizard if required.")
             # Ensure SDK loop is running, as printer.register() might need it.
-            if not self.sdk_thread or not self.sdk_thread.is_alive():
-                self._logger.info("Starting SDK loop thread (no token, for potential wizard registration).")
-                self.sdk_thread = threading.Thread(target=self.prusa_printer.loop, daemon=True, name="PrusaConnectSDKLoop-PreToken")
-                self.sdk_thread.start()
-                self._logger.info("SDK loop thread started for potential wizard-led registration.")
-            else:
-                self._logger.info("SDK loop thread already running (no token). Wizard will handle registration if needed.")
+            self._logger.info("Starting SDK loop thread (no token, for potential wizard registration).")
+            self._sdk.start(name="PrusaConnectSDKLoop-PreToken")
             # DO NOT call _initiate_registration() here. It will be called by the wizard.
-        self._logger.info("PrusaConnectBridgePlugin on_after_startup complete.")
+        # Grabs nothing until the printer is registered
+        self._start_camera()
+        self._start_bridge()
+        self._logger.info("PrusaConnectBridgePlugin SDK setup complete.")
+
+    ##~~ ShutdownPlugin mixin
+
+    def on_shutdown(self):
+        if not self._wait_for_startup(self.SHUTDOWN_WAIT):
+            self._logger.warning(f"Prusa Connect setup still running after {self.SHUTDOWN_WAIT:.0f}s, shutting down anyway.")
+        self._stop_bridge()
+        self._stop_camera()
+        self._events.stop()
+        self._stop_telemetry_timer()
+        self._stop_downloads()
+        self._stop_command_executor()
+        self._sdk.discard()
+        if self._storage is not None:
+            self._storage.stop()
+        if self._metadata is not None:
+            self._metadata.close()
+        self._close_time_index()
+        if self._http is not None:
+            self._http.close()
+        # After the SDK loop is gone, its stop would otherwise schedule a push
+        self._status.cancel()
+        self._logger.info("PrusaConnectBridgePlugin shut down.")
+
+    def _open_metadata_cache(self):
+        from .metadata import MetadataCache
+
+        try:
+            self._metadata = MetadataCache(
+                os.path.join(self.get_plugin_data_folder(), "metadata.sqlite"),
+                resolve=lambda path: self._file_manager.path_on_disk("local", path),
+                on_extracted=self._metadata_extracted,
+                logger=logging.getLogger("octoprint.plugins.PrusaConnectBridge.metadata"),
+                metrics=self._metrics)
+            self._metadata.open()
+        except Exception as e:
+            # SEND_INFO and FILE_INFO still work, with OctoPrint's analysis and without previews
+            self._logger.error(f"Could not open the metadata cache: {e}", exc_info=True)
+            self._metadata = None
+            return
+        self._file_index.metadata = self._metadata
+
+    def _open_time_index(self):
+        from .timeindex import TimeIndexCache
+
+        try:
+            self._times = TimeIndexCache(
+                os.path.join(self.get_plugin_data_folder(), "timeindex.sqlite"),
+                resolve=lambda path: self._file_manager.path_on_disk("local", path),
+                logger=logging.getLogger("octoprint.plugins.PrusaConnectBridge.timeindex"),
+                metrics=self._metrics)
+            self._times.open()
+        except Exception as e:
+            # Telemetry carries OctoPrint's own time estimate
+            self._logger.error(f"Could not open the time index cache: {e}", exc_info=True)
+            self._times = None
+            return
+        self._snapshots.times = self._times
+
+    def _close_time_index(self):
+        if self._times is not None:
+            if self._snapshots is not None:
+                self._snapshots.times = None
+            self._times.close()
+            self._times = None
+
+    def _metadata_extracted(self, path, metadata):
+        self._file_index.apply_metadata(path, metadata)
+        # A better print time estimate is a modified file for Prusa Connect
+        self._queue_file_sync()
 
     def _register_sdk_handlers(self):
         if not self.prusa_printer:
             self._logger.error("Cannot register SDK handlers: prusa_printer object is not initialized.", exc_info=True)
             return
 
+        from prusa.connect.printer import const
+        from prusa.connect.printer.command import CommandFailed
+        from .downloads import DownloadManager
+
         self._logger.info("Registering Prusa Connect SDK command handlers...")
+        # Called from the SDK loop once the registration code was entered in Prusa Connect
+        self.prusa_printer.register_handler = self._token_received
         try:
+            # Handlers run on the command executor's workers and get the SDK's Command (caller) with
+            # the command's args/kwargs. They return the kwargs for FINISHED or raise CommandFailed.
             @self.prusa_printer.handler(const.Command.START_PRINT)
-            def decorated_handle_start_print(args):
-                self._logger.info(f"Prusa Connect Command (Decorated): START_PRINT with args: {args}")
-                filename = None
-                if isinstance(args, list) and len(args) > 0:
-                    filename = args[0]
-                elif isinstance(args, str):
-                    filename = args
+            def decorated_handle_start_print(caller):
+                self._logger.info(f"Prusa Connect Command (Decorated): START_PRINT with args: {caller.args}, kwargs: {caller.kwargs}")
+                filename = (caller.kwargs or {}).get("path")
+                if not filename and caller.args:
+                    filename = caller.args[0]
 
                 if not filename or not isinstance(filename, str):
                     self._logger.error("START_PRINT: Filename not provided or invalid.")
-                    self.prusa_printer.event_cb(const.Event.COMMAND_REJECTED, const.Source.PLUGIN, command=const.Command.START_PRINT, reason="Missing filename")
-                    return {"source": const.Source.PLUGIN, "error": "Missing filename"}
+                    raise CommandFailed("Missing filename")
 
+                # Resolved through the file index: by path, by Connect hash or by name alone, without
+                # touching the storage, so this takes the same time however large the library is
                 try:
-                    if not self._file_manager.file_exists("local", filename):
-                        self._logger.error(f"START_PRINT: File '{filename}' not found in local storage via file_manager.")
-                        self.prusa_printer.event_cb(const.Event.COMMAND_REJECTED, const.Source.PLUGIN, command=const.Command.START_PRINT, reason=f"File '{filename}' not found")
-                        return {"source": const.Source.PLUGIN, "error": f"File '{filename}' not found"}
-
-                    path_to_file = self._file_manager.path_on_disk("local", filename)
-                    if not path_to_file:
-                        self._logger.error(f"START_PRINT: Could not get disk path for supposedly existing file '{filename}'.")
-                        # This case should ideally be caught by file_exists, but as a fallback:
-                        self.prusa_printer.event_cb(const.Event.COMMAND_REJECTED, const.Source.PLUGIN, command=const.Command.START_PRINT, reason=f"Could not get disk path for {filename}")
-                        return {"source": const.Source.PLUGIN, "error": f"Could not get disk path for {filename}"}
-
-                    self._logger.info(f"Attempting to select and print file: {path_to_file}")
-                    self._printer.select_file(path_to_file, printAfterSelect=True)
-                    self.prusa_printer.set_state(const.State.PRINTING)
-                    self._logger.info(f"Successfully initiated print for {filename}")
-                    return {"source": const.Source.PLUGIN}
-                except Exception as e:
-                    self._logger.error(f"Error handling START_PRINT for {filename}: {e}", exc_info=True)
-                    self.prusa_printer.event_cb(const.Event.COMMAND_FAILED, const.Source.PLUGIN, command=const.Command.START_PRINT, reason=str(e))
-                    return {"source": const.Source.PLUGIN, "error": str(e)}
+                    resolved = self._file_index.resolve(filename, hash_=(caller.kwargs or {}).get("hash"))
+                except AmbiguousFile as e:
+                    self._logger.error(f"START_PRINT: {e}")
+                    raise CommandFailed(str(e))
+                if resolved is None:
+                    self._logger.error(f"START_PRINT: File '{filename}' not found in local storage.")
+                    raise CommandFailed(f"File '{filename}' not found")
+                filename, path_to_file = resolved
+
+                self._logger.info(f"Attempting to select and print file: {path_to_file}")
+                self._printer.select_file(path_to_file, False, printAfterSelect=True)
+                self.prusa_printer.set_state(const.State.PRINTING, const.Source.CONNECT)
+                self._logger.info(f"Successfully initiated print for {filename}")
+                return {"source": const.Source.CONNECT}
 
             @self.prusa_printer.handler(const.Command.STOP_PRINT)
-            def decorated_handle_stop_print(args=None):
-                self._logger.info(f"Prusa Connect Command (Decorated): STOP_PRINT. Args: {args}")
-                try:
-                    self._printer.cancel_print()
-                    self.prusa_printer.set_state(const.State.READY)
-                    self._logger.info("Print cancelled successfully via Prusa Connect command (Decorated).")
-                    return {"source": const.Source.PLUGIN}
-                except Exception as e:
-                    self._logger.error(f"Error handling STOP_PRINT (Decorated): {e}", exc_info=True)
-                    self.prusa_printer.event_cb(const.Event.COMMAND_FAILED, const.Source.PLUGIN, command=const.Command.STOP_PRINT, reason=str(e))
-                    return {"source": const.Source.PLUGIN, "error": str(e)}
+            def decorated_handle_stop_print(caller):
+                self._logger.info(f"Prusa Connect Command (Decorated): STOP_PRINT. Args: {caller.args}")
+                self._printer.cancel_print()
+                self.prusa_printer.set_state(const.State.READY, const.Source.CONNECT)
+                self._logger.info("Print cancelled successfully via Prusa Connect command (Decorated).")
+                return {"source": const.Source.CONNECT}
 
             @self.prusa_printer.handler(const.Command.PAUSE_PRINT)
-            def decorated_handle_pause_print(args=None):
-                self._logger.info(f"Prusa Connect Command (Decorated): PAUSE_PRINT. Args: {args}")
-                try:
-                    if self._printer.is_printing() and not self._printer.is_paused():
-                        self._printer.pause_print()
-                        self.prusa_printer.set_state(const.State.PAUSED)
-                        self._logger.info("Print paused successfully via Prusa Connect command (Decorated).")
-                    elif self._printer.is_paused():
-                        self._logger.info("Print is already paused. No action taken (Decorated).")
-                    else:
-                        self._logger.warning("Cannot pause: Printer is not currently printing (Decorated).")
-                        self.prusa_printer.event_cb(const.Event.COMMAND_REJECTED, const.Source.PLUGIN, command=const.Command.PAUSE_PRINT, reason="Not printing")
-                        return {"source": const.Source.PLUGIN, "error": "Not printing"}
-                    return {"source": const.Source.PLUGIN}
-                except Exception as e:
-                    self._logger.error(f"Error handling PAUSE_PRINT (Decorated): {e}", exc_info=True)
-                    self.prusa_printer.event_cb(const.Event.COMMAND_FAILED, const.Source.PLUGIN, command=const.Command.PAUSE_PRINT, reason=str(e))
-                    return {"source": const.Source.PLUGIN, "error": str(e)}
+            def decorated_handle_pause_print(caller):
+                self._logger.info(f"Prusa Connect Command (Decorated): PAUSE_PRINT. Args: {caller.args}")
+                if self._printer.is_printing() and not self._printer.is_paused():
+                    self._printer.pause_print()
+                    self.prusa_printer.set_state(const.State.PAUSED, const.Source.CONNECT)
+                    self._logger.info("Print paused successfully via Prusa Connect command (Decorated).")
+                elif self._printer.is_paused():
+                    self._logger.info("Print is already paused. No action taken (Decorated).")
+                else:
+                    self._logger.warning("Cannot pause: Printer is not currently printing (Decorated).")
+                    raise CommandFailed("Not printing")
+                return {"source": const.Source.CONNECT}
 
             @self.prusa_printer.handler(const.Command.RESUME_PRINT)
-            def decorated_handle_resume_print(args=None):
-                self._logger.info(f"Prusa Connect Command (Decorated): RESUME_PRINT. Args: {args}")
-                try:
-                    if self._printer.is_paused():
-                        self._printer.resume_print()
-                        self.prusa_printer.set_state(const.State.PRINTING)
-                        self._logger.info("Print resumed successfully via Prusa Connect command (Decorated).")
-                    else:
-                        self._logger.warning("Cannot resume: Printer is not currently paused (Decorated).")
-                        self.prusa_printer.event_cb(const.Event.COMMAND_REJECTED, const.Source.PLUGIN, command=const.Command.RESUME_PRINT, reason="Not paused")
-                        return {"source": const.Source.PLUGIN, "error": "Not paused"}
-                    return {"source": const.Source.PLUGIN}
-                except Exception as e:
-                    self._logger.error(f"Error handling RESUME_PRINT (Decorated): {e}", exc_info=True)
-                    self.prusa_printer.event_cb(const.Event.COMMAND_FAILED, const.Source.PLUGIN, command=const.Command.RESUME_PRINT, reason=str(e))
-                    return {"source": const.Source.PLUGIN, "error": str(e)}
+            def decorated_handle_resume_print(caller):
+                self._logger.info(f"Prusa Connect Command (Decorated): RESUME_PRINT. Args: {caller.args}")
+                if self._printer.is_paused():
+                    self._printer.resume_print()
+                    self.prusa_printer.set_state(const.State.PRINTING, const.Source.CONNECT)
+                    self._logger.info("Print resumed successfully via Prusa Connect command (Decorated).")
+                else:
+                    self._logger.warning("Cannot resume: Printer is not currently paused (Decorated).")
+                    raise CommandFailed("Not paused")
+                return {"source": const.Source.CONNECT}
 
             @self.prusa_printer.handler(const.Command.SEND_INFO)
-            def decorated_handle_send_info(args=None):
-                self._logger.info(f"Prusa Connect Command (Decorated): SEND_INFO. Args: {args}")
+            def decorated_handle_send_info(caller):
+                self._logger.info(f"Prusa Connect Command (Decorated): SEND_INFO. Args: {caller.args}")
+                if not self.prusa_printer or not self.prusa_printer.fs:
+                    self._logger.error("Filesystem object (self.prusa_printer.fs) not available (Decorated).")
+                    raise CommandFailed("Filesystem not initialized")
+
+                if not self._file_index:
+                    self._logger.error("File index not available for population (Decorated).")
+                    raise CommandFailed("FS root not available for population")
+
+                # The tree sent here is what later file changes are sent against
+                info = self._file_sync.info() if self._file_sync else self._printer_info()
+                self._logger.info("File system information updated for Prusa Connect based on SEND_INFO (Decorated).")
+                return info
+
+            @self.prusa_printer.handler(const.Command.SEND_FILE_INFO)
+            def decorated_handle_send_file_info(caller):
+                path = (caller.kwargs or {}).get("path")
+                self._logger.info(f"Prusa Connect Command (Decorated): SEND_FILE_INFO for {path}")
+                if not path or not self._file_index:
+                    raise CommandFailed("SEND_FILE_INFO requires a path")
                 try:
-                    if not self.prusa_printer or not self.prusa_printer.fs:
-                        self._logger.error("Filesystem object (self.prusa_printer.fs) not available (Decorated).")
-                        # No specific event_cb for this internal check, but fail the command.
-                        # The SDK might retry or handle this. For now, return error.
-                        return {"source": const.Source.PLUGIN, "error": "Filesystem not initialized"}
-
-                    octoprint_files_data = self._file_manager.list_files(recursive=True, locations=['local'])
-
-                    # Initialize self.prusa_printer.fs.root as a dictionary
-                    self.prusa_printer.fs.root = {
-                        'name': '/',
-                        'path': '/',
-                        'type': 'DIR',
-                        'children': [],
-                        'size': 0,
-                        'm_timestamp': int(time.time())
-                    }
-                    # Clearing children:
-                    # self.prusa_printer.fs.root['children'].clear() # This is already done by re-assigning above essentially
-
-                    def build_fs_tree(octo_files_dict, parent_node_dict):
-                        for name, item_data in octo_files_dict.items():
-                            node_type_str = None
-                            if item_data["type"] == "folder":
-                                node_type_str = 'DIR'
-                            elif item_data["type"] == "machinecode":
-                                node_type_str = 'FILE'
-                            else:
-                                self._logger.debug(f"Skipping item '{name}' of type '{item_data['type']}' (Decorated)")
-                                continue
-
-                            node_path = os.path.join(parent_node_dict['path'], name).lstrip("/")
-                            if parent_node_dict['path'] == "/":
-                                node_path = name
-
-                            node_dict = {
-                                'name': name,
-                                'path': node_path,
-                                'type': node_type_str,
-                                'size': item_data.get("size", 0) if node_type_str == 'FILE' else 0,
-                                'm_timestamp': int(item_data.get("date", time.time())),
-                            }
-                            if node_type_str == 'DIR':
-                                node_dict['children'] = []
-
-                            if node_type_str == 'FILE' and item_data.get("gcodeAnalysis"):
-                                estimated_print_time = item_data["gcodeAnalysis"].get("estimatedPrintTime")
-                                if estimated_print_time:
-                                    node_dict['print_time'] = int(estimated_print_time)
-
-                            parent_node_dict['children'].append(node_dict)
-
-                            if node_type_str == 'DIR' and "children" in item_data:
-                                build_fs_tree(item_data.get("children", {}), node_dict)
-
-                    if self.prusa_printer and self.prusa_printer.fs and self.prusa_printer.fs.root:
-                        # Ensure root children are clear before building, self.prusa_printer.fs.root is now a dict
-                        self.prusa_printer.fs.root['children'].clear()
-                        build_fs_tree(octoprint_files_data.get('local', {}), self.prusa_printer.fs.root)
-                    else:
-                        self._logger.error("Prusa printer FS root (dict) not available for population (Decorated).")
-                        return {"source": const.Source.PLUGIN, "error": "FS root not available for population"}
-
-                    try:
-                        actual_uploads_path = self._file_manager.get_basedir("local")
-                        if actual_uploads_path and os.path.exists(actual_uploads_path):
-                            stat = os.statvfs(actual_uploads_path)
-                            self.prusa_printer.fs.fs_free_space = stat.f_bavail * stat.f_frsize
-                            self.prusa_printer.fs.fs_total_space = stat.f_blocks * stat.f_frsize
-                            self._logger.info(f"Disk space for '{actual_uploads_path}': Free: {self.prusa_printer.fs.fs_free_space}, Total: {self.prusa_printer.fs.fs_total_space} (Decorated)")
-                        else:
-                            self._logger.warning(f"Could not determine valid uploads path ('{actual_uploads_path}') for disk space calculation (Decorated). Using defaults (0).")
-                            self.prusa_printer.fs.fs_free_space = 0
-                            self.prusa_printer.fs.fs_total_space = 0
-                    except Exception as e_stat:
-                        self._logger.error(f"Error calculating disk space for path '{actual_uploads_path}': {e_stat} (Decorated)", exc_info=True)
-                        self.prusa_printer.fs.fs_free_space = 0
-                        self.prusa_printer.fs.fs_total_space = 0
-
-                    self._logger.info("File system information updated for Prusa Connect based on SEND_INFO (Decorated).")
-                    return {"message": "File system info processed", "source": const.Source.PLUGIN}
-                except Exception as e:
-                    self._logger.error(f"Error handling SEND_INFO (Decorated): {e}", exc_info=True)
-                    self.prusa_printer.event_cb(const.Event.COMMAND_FAILED, const.Source.PLUGIN, command=const.Command.SEND_INFO, reason=str(e))
-                    return {"source": const.Source.PLUGIN, "error": str(e)}
+                    resolved = self._file_index.resolve(path)
+                except AmbiguousFile as e:
+                    raise CommandFailed(str(e))
+                if resolved is None:
+                    raise CommandFailed(f"File does not exist: {path}")
+
+                storage_path, disk_path = resolved
+                stat = os.stat(disk_path)
+                info = dict(source=const.Source.CONNECT, event=const.Event.FILE_INFO, path=path,
+                            size=stat.st_size, m_timestamp=int(stat.st_mtime))
+                if self._metadata is not None:
+                    # Parsed once per file version, from then on read from the cache
+                    metadata, thumbnail = self._metadata.get(storage_path)
+                    info.update(metadata)
+                    if thumbnail:
+                        info["preview"] = thumbnail
+                return info
+
+            # Downloads are bound to the printer's transfer, a new printer gets a new manager
+            self._stop_downloads()
+            self._downloads = DownloadManager(
+                self.prusa_printer,
+                self._file_manager,
+                session=self._http.session if self._http else None,
+                chunk_size=self._config.download_chunk_size,
+                retries=self._config.download_retries,
+                printed_path=self._printed_path,
+                on_finished=self._download_finished,
+                storage_monitor=self._storage,
+                metrics=self._metrics
+            )
+
+            @self.prusa_printer.handler(const.Command.START_CONNECT_DOWNLOAD)
+            def decorated_handle_start_connect_download(caller):
+                self._logger.info(f"Prusa Connect Command (Decorated): START_CONNECT_DOWNLOAD with kwargs: {caller.kwargs}")
+                # Returns once the download is started, it runs on the download manager's thread
+                return self._downloads.start_connect_download(caller)
+
+            @self.prusa_printer.handler(const.Command.START_URL_DOWNLOAD)
+            def decorated_handle_start_url_download(caller):
+                self._logger.info(f"Prusa Connect Command (Decorated): START_URL_DOWNLOAD with kwargs: {caller.kwargs}")
+                return self._downloads.start_url_download(caller)
 
             self._logger.info("Successfully registered Prusa Connect SDK command handlers (Decorated).")
         except Exception as e:
@@ -465,94 +674,366 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
 
     # The old _handle_... methods are now removed as their logic is inside _register_sdk_handlers.
 
+    def _printer_info(self):
+        # The index is kept current from OctoPrint's file events, so this is only a full walk of
+        # the upload folder on the very first request. The tree is built straight into the INFO
+        # payload rather than being kept alive on self.prusa_printer.fs.root.
+        with self._metrics.timer("prusaconnect_send_info_tree_seconds"):
+            files = self._file_index.tree()
+
+        # Sampled in the background, no filesystem call here. Only before the first sample is there one.
+        if self._storage.sampled is None:
+            self._storage.sample()
+        files["free_space"] = self.prusa_printer.fs.fs_free_space = self._storage.free_space
+        files["total_space"] = self.prusa_printer.fs.fs_total_space = self._storage.total_space
+
+        info = self.prusa_printer.get_info()
+        info["files"] = files
+        return info
+
+    def _storage_changed(self, free, total):
+        # Prusa Connect's telemetry has no storage figures, they reach it with an unsolicited INFO
+        if not self.prusa_printer or not self.prusa_printer.token or not self._file_index:
+            return
+        self._logger.info(f"Free space in the upload folder changed to {free} of {total} bytes, updating Prusa Connect.")
+        if self._file_sync is not None:
+            # The total space only goes out with the whole tree, which then is the file sync's snapshot too
+            self._file_sync.resync()
+            return
+        info = self._printer_info()
+        self.prusa_printer.event_cb(info.pop("event"), info.pop("source"), **info)
+
+    def _queue_file_sync(self):
+        if self._file_sync is not None and self.prusa_printer and self.prusa_printer.token:
+            # A burst of file events is sent as one batch of changes
+            self._events.put("files", None, None)
+
+    def _stop_downloads(self):
+        if self._downloads is not None:
+            self._downloads.stop()
+            self._downloads = None
+
+    def _printed_path(self):
+        # Disk path of the file being printed, a download must not replace it
+        if not (self._printer.is_printing() or self._printer.is_paused()):
+            return None
+        job_file = (self._printer.get_current_job() or {}).get("file") or {}
+        if job_file.get("origin") != "local" or not job_file.get("path"):
+            return None
+        return self._file_manager.path_on_disk("local", job_file["path"])
+
+    def _download_finished(self, path, transfer):
+        if transfer.hash and self._file_index:
+            # START_PRINT for a file sent from Connect may only name it by its hash
+            self._file_index.remember_hash(transfer.hash, path)
+        if transfer.to_print or transfer.to_select:
+            self._logger.info(f"Selecting downloaded file {path}{' and starting the print' if transfer.to_print else ''}.")
+            self._printer.select_file(self._file_manager.path_on_disk("local", path), False,
+                                      printAfterSelect=bool(transfer.to_print))
+
+    def _start_command_executor(self):
+        from .commands import CommandExecutor
+
+        self._stop_command_executor()
+        # The SDK loop only accepts commands, the executor runs them on its own workers so slow
+        # handlers (select_file, a first SEND_INFO on a big library) can't hold up telemetry.
+        self._command_executor = CommandExecutor(
+            self.prusa_printer,
+            workers=self._config.command_workers,
+            timeout=self._config.command_timeout,
+            metrics=self._metrics
+        )
+        if self._sdk.async_core:
+            # Driven by the SDK's event loop, which has no dispatcher thread to spare
+            self._sdk.attach_executor(self._command_executor)
+        else:
+            self._command_executor.start()
+
+    def _stop_command_executor(self):
+        if self._command_executor is not None:
+            self._command_executor.stop()
+            self._command_executor = None
+
+    ##~~ Camera snapshots
+
+    def _camera_source(self):
+        if self._config.camera_snapshot_url:
+            return self._config.camera_snapshot_url
+        # OctoPrint 1.9+ has the webcam in the bundled classic webcam plugin, older versions in its own settings
+        return (self._settings.global_get(["plugins", "classicwebcam", "snapshot"])
+                or self._settings.global_get(["webcam", "snapshot"]))
+
+    def _start_camera(self):
+        from .camera import SnapshotPipeline
+
+        self._stop_camera()
+        if not self._config.camera_enabled or not self._config.prusa_connect_sn:
+            return
+        source = self._camera_source()
+        if not source:
+            self._logger.info("No webcam snapshot URL configured, no camera snapshots are sent to Prusa Connect.")
+            return
+        try:
+            self._camera = SnapshotPipeline(
+                source,
+                printer=lambda: self.prusa_printer,
+                printing=lambda: self._printer.is_printing() or self._printer.is_paused(),
+                # With the async core snapshots share its connections, queued behind telemetry and events
+                session=self._sdk.upload_session if self._sdk.async_core else self._http.session,
+                camera_id=f"{self._config.prusa_connect_sn}-webcam",
+                token=self._config.camera_token,
+                on_token=lambda token: self._write_settings(camera_token=token),
+                logger=logging.getLogger("octoprint.plugins.PrusaConnectBridge.camera"),
+                metrics=self._metrics
+            )
+            self._configure_camera()
+            self._camera.start()
+        except Exception as e:
+            # Everything but the snapshots keeps working
+            self._logger.error(f"Could not start camera snapshots: {e}", exc_info=True)
+            self._camera = None
+
+    def _configure_camera(self):
+        if self._camera is not None:
+            self._camera.configure(interval_printing=self._config.camera_interval_printing,
+                                   interval_idle=self._config.camera_interval_idle,
+                                   max_width=self._config.camera_max_width,
+                                   quality=self._config.camera_jpeg_quality)
+
+    def _stop_camera(self):
+        if self._camera is not None:
+            self._camera.stop()
+            self._camera = None
+
+    def _forget_camera_token(self):
+        # The camera was registered on behalf of the printer, a new registration needs a new camera token
+        self._write_settings(camera_token=None)
+        if self._camera is not None:
+            self._camera.token = None
+
+    ##~~ Bridged printers
+
+    def _start_bridge(self):
+        from .bridge import PrinterBridge
+
+        self._stop_bridge()
+        configs = self._config.bridged_printers
+        if not configs:
+            return
+        self._bridge = PrinterBridge(
+            self.prusa_server,
+            session=self._http.session if self._http else None,
+            poll_interval=self._config.bridge_poll_interval,
+            workers=self._config.command_workers,
+            timeout=self._config.command_timeout,
+            on_token=self._bridged_token_received,
+            metrics=self._metrics
+        )
+        for config in configs:
+            try:
+                self._bridge.add(config)
+            except Exception as e:
+                self._logger.error(f"Could not bridge printer '{config.get('name')}': {e}", exc_info=True)
+        self._bridge.start()
+
+    def _stop_bridge(self):
+        if self._bridge is not None:
+            self._bridge.stop()
+            self._bridge = None
+
+    def _bridged_token_received(self, sn, token):
+        # Called from the bridge loop once the registration code was entered in Prusa Connect
+        with self._settings_lock:
+            configs = [dict(config) for config in self._config.bridged_printers]
+            for config in configs:
+                if config.get("sn") == sn:
+                    config["token"] = token
+            self._write_settings(bridged_printers=configs)
+
+    def _add_bridged_printer(self, name, url, api_key):
+        import hashlib
+        import uuid
+
+        sn = str(uuid.uuid4())
+        config = dict(
+            name=name or url,
+            url=url,
+            api_key=api_key,
+            sn=sn,
+            fingerprint=hashlib.sha256(sn.encode('utf-8')).hexdigest(),
+            token=None
+        )
+        with self._settings_lock:
+            self._write_settings(bridged_printers=self._config.bridged_printers + (config,))
+
+        if self._bridge is None:
+            self._start_bridge()
+            bridged = self._bridge.get(sn)
+        else:
+            bridged = self._bridge.add(config)
+        try:
+            # The code is entered in Prusa Connect, the bridge loop picks the token up
+            return config, bridged.register()
+        except Exception:
+            self._remove_bridged_printer(sn)
+            raise
+
+    def _remove_bridged_printer(self, sn):
+        with self._settings_lock:
+            configs = self._config.bridged_printers
+            remaining = tuple(config for config in configs if config.get("sn") != sn)
+            if len(remaining) == len(configs):
+                return False
+            self._write_settings(bridged_printers=remaining)
+        if self._bridge is not None:
+            self._bridge.remove(sn)
+            if not remaining:
+                self._stop_bridge()
+        return True
+
     def _initiate_registration(self):
-        if not self.prusa_printer or not self.prusa_printer.token_set:
+        if not self.prusa_printer:
+            self._registration_error_message = "Prusa Connect SDK is not initialized. Check logs."
+            return
+        if self.prusa_printer.token:
+            self._start_telemetry_timer()
+            return
+        try:
+            code = self.prusa_printer.register()
+        except Exception as e:
+            self._logger.error(f"Could not get a registration code from Prusa Connect: {e}", exc_info=True)
+            self._registration_error_message = f"Could not get a registration code from Prusa Connect: {e}"
+            return
+        self._logger.info(f"Registration code issued by Prusa Connect: {code}")
+        self._write_settings(prusa_connect_tmp_code=code)
+        self._status.update(tmp_code=code, error=None)
+
+    def _token_received(self, token):
+        self._logger.info("Token received from Prusa Connect, registration complete.")
+        self._write_settings(prusa_connect_token=token, prusa_connect_tmp_code=None)
+        self._status.update(token=token, tmp_code=None, error=None)
+        self._start_telemetry_timer()
+        if self._camera is not None:
+            self._camera.wake()
+
+    def _start_telemetry_timer(self):
+        from .telemetry import CadenceScheduler, TelemetryBuffer, TelemetryEngine
+
+        if not self.prusa_printer or not self.prusa_printer.token:
             self._logger.info("Cannot start telemetry timer: Prusa printer not ready or token not set.")
             return
 
-        if self.telemetry_timer is not None:
-            self.telemetry_timer.cancel()
-            self.telemetry_timer = None
+        if self._telemetry_engine is not None:
+            self._stop_telemetry_timer()
             self._logger.info("Cancelled existing telemetry timer.")
 
-        self.telemetry_timer = RepeatedTimer(
-            1.0,  # Interval in seconds
-            self._send_telemetry,
-            run_first=False, # Do not run immediately, wait for the first interval
-            daemon=True
+        # Telemetry is pushed from OctoPrint's printer callbacks and only sent upstream when something
+        # meaningful changed, with a heartbeat to keep Prusa Connect (and its command polling) alive.
+        # State changes are sent by the event queue, once per burst of printer state events.
+        self._telemetry_engine = TelemetryEngine(self._printer, self._send_telemetry, cadence=CadenceScheduler(),
+                                                 deferred=("state",))
+        self._telemetry_buffer = TelemetryBuffer(
+            capacity=self._config.telemetry_buffer_size,
+            interval=self._config.telemetry_buffer_interval,
+            rate=self._config.telemetry_replay_rate,
+            jitter=self._config.telemetry_replay_jitter
+        )
+        self._configure_telemetry_engine()
+        self._telemetry_engine.start()
+        self._logger.info("Started change-driven telemetry transmission.")
+
+    def _stop_telemetry_timer(self):
+        if self._telemetry_engine is not None:
+            self._telemetry_engine.stop()
+            self._telemetry_engine = None
+        if self._telemetry_buffer is not None:
+            self._telemetry_buffer.stop_replay()
+            self._telemetry_buffer = None
+
+    def _configure_telemetry_engine(self):
+        self._telemetry_engine.cadence.configure(
+            heating=self._config.telemetry_cadence_heating,
+            printing=self._config.telemetry_cadence_printing,
+            idle=self._config.telemetry_heartbeat_interval,
+            offline=self._config.telemetry_cadence_offline,
+            layer_burst=self._config.telemetry_layer_burst,
+            backoff_max=self._config.telemetry_backoff_max
+        )
+        self._telemetry_engine.configure(
+            temp_deadband=self._config.telemetry_temp_deadband,
+            progress_deadband=self._config.telemetry_progress_deadband
         )
-        self.telemetry_timer.start()
-        self._logger.info("Started telemetry transmission (1s interval).")
 
-    def _send_telemetry(self):
-        if not self.prusa_printer or not self.prusa_printer.token_set:
-            # This check is important because the timer might fire before token is set,
+    def _emit_telemetry(self, snapshot):
+        from .telemetry import link_down, send_snapshot
+
+        # The SDK doesn't report send results back, but flags its connection conditions as NOK
+        # on failures. Back the cadence off exponentially while they are broken.
+        engine = self._telemetry_engine
+        if engine is None:
+            return # Telemetry was stopped (or is being restarted) while this snapshot was on its way
+        cadence = engine.cadence
+        if link_down():
+            cadence.record_failure()
+        else:
+            cadence.record_success()
+        try:
+            send_snapshot(self.prusa_printer, snapshot)
+        except Exception:
+            cadence.record_failure()
+            raise
+        self._metrics.inc("prusaconnect_telemetry_emitted_total")
+
+    def _send_telemetry(self, printer_data=None, temperature_data=None, force=False):
+        if not self.prusa_printer or not self.prusa_printer.token or not self._telemetry_engine:
+            # This check is important because the printer callbacks might fire before token is set,
             # or if connection is somehow lost.
             # self._logger.debug("Prusa printer not ready or token not set. Skipping telemetry.")
             return
 
+        from .telemetry import link_down
+
+        start = time.perf_counter()
         try:
-            printer_data = self._printer.get_current_data()
-            temperature_data = self._printer.get_current_temperatures()
-
-            # State Mapping
-            octo_state = printer_data["state"]["flags"]
-            prusa_state = const.State.READY  # Default
-
-            if octo_state["printing"]:
-                prusa_state = const.State.PRINTING
-            elif octo_state["paused"]:
-                prusa_state = const.State.PAUSED
-            elif octo_state["error"] or octo_state["closedOrError"]:
-                prusa_state = const.State.ERROR
-            elif not octo_state["operational"]:
-                prusa_state = const.State.ATTENTION
-            elif octo_state["ready"]:
-                 prusa_state = const.State.READY
-            # Add other states if necessary, e.g., FINISHING based on OctoPrint events later.
-
-            # Temperature Data
-            # Ensure tool0 exists, otherwise default to 0.0
-            nozzle_actual = temperature_data.get("tool0", {}).get("actual") if temperature_data.get("tool0") else 0.0
-            nozzle_target = temperature_data.get("tool0", {}).get("target") if temperature_data.get("tool0") else 0.0
-            # Ensure bed exists, otherwise default to 0.0
-            bed_actual = temperature_data.get("bed", {}).get("actual") if temperature_data.get("bed") else 0.0
-            bed_target = temperature_data.get("bed", {}).get("target") if temperature_data.get("bed") else 0.0
-
-            # Ensure values are float, default to 0.0 if None
-            nozzle_actual = float(nozzle_actual) if nozzle_actual is not None else 0.0
-            nozzle_target = float(nozzle_target) if nozzle_target is not None else 0.0
-            bed_actual = float(bed_actual) if bed_actual is not None else 0.0
-            bed_target = float(bed_target) if bed_target is not None else 0.0
-
-
-            # Print Progress and File
-            progress = None
-            filename = None
-            if prusa_state == const.State.PRINTING or prusa_state == const.State.PAUSED:
-                if printer_data.get("progress") and printer_data["progress"].get("completion") is not None:
-                    progress = round(printer_data["progress"]["completion"])  # SDK expects int 0-100
-                if printer_data.get("job") and printer_data["job"].get("file") and printer_data["job"]["file"].get("name"):
-                    filename = printer_data["job"]["file"]["name"]
-
-            # self._logger.debug(
-            #     f"Sending telemetry: State: {prusa_state}, Nozzle: {nozzle_actual}°C (T: {nozzle_target}°C), "
-            #     f"Bed: {bed_actual}°C (T: {bed_target}°C), Progress: {progress}%, File: {filename}"
-            # )
-
-            self.prusa_printer.telemetry(
-                state=prusa_state,
-                temp_nozzle=nozzle_actual,
-                target_nozzle=nozzle_target,
-                temp_bed=bed_actual,
-                target_bed=bed_target,
-                progress=progress,
-                print_file=filename
-                # TODO: Consider adding material and time_est if easily available from OctoPrint
-            )
+            # Data pushed by OctoPrint's printer callbacks is used when available, otherwise poll
+            if printer_data is None:
+                printer_data = self._printer.get_current_data()
+            if temperature_data is None:
+                temperature_data = self._printer.get_current_temperatures()
+
+            snapshot, heating = self._snapshots.build(printer_data, temperature_data)
+
+            # Pick the heartbeat cadence from the state, heating counts when a target is set and not yet reached
+            if self._telemetry_engine.cadence.update(snapshot["state"], heating=heating):
+                self._telemetry_engine.reschedule()
+
+            buffer = self._telemetry_buffer
+            if buffer is None:
+                pass
+            elif link_down():
+                # Connect misses these, they are replayed once it can be reached again
+                buffer.record(snapshot)
+            elif len(buffer):
+                buffer.start_replay(self.prusa_printer)
+
+            if self._file_sync is None:
+                pass
+            elif link_down():
+                # File changes sent meanwhile may be lost, Connect gets the whole tree once it is back
+                self._file_sync.link_lost()
+            elif self._file_sync.stale:
+                self._queue_file_sync()
+
+            # Only goes upstream if it differs from the last sent snapshot beyond the deadbands,
+            # or if the heartbeat interval expired. While Connect can't be reached that's only the
+            # backed off heartbeat, which tells when it's back.
+            self._telemetry_engine.submit(snapshot, self._emit_telemetry, force=force)
 
         except Exception as e:
+            self._metrics.inc("prusaconnect_telemetry_errors_total")
             self._logger.error(f"Error sending telemetry: {e}", exc_info=True)
+        finally:
+            self._metrics.observe("prusaconnect_telemetry_seconds", time.perf_counter() - start)
 
 
     ##~~ TemplatePlugin mixin
@@ -563,77 +1044,18 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
         ]
 
     def get_template_vars(self):
-        current_status_text = self._get_prusa_connect_status() # Ensures status is evaluated and pushed
+        current_status_text = self._status.text
         return dict(
-            prusa_connect_sn=self._settings.get(["prusa_connect_sn"]),
-            prusa_connect_manual_sn=self._settings.get(["prusa_connect_manual_sn"]),
-            prusa_connect_fingerprint=self._settings.get(["prusa_connect_fingerprint"]),
+            prusa_connect_sn=self._config.prusa_connect_sn,
+            prusa_connect_manual_sn=self._config.prusa_connect_manual_sn,
+            prusa_connect_fingerprint=self._config.prusa_connect_fingerprint,
             prusa_connect_status_text=current_status_text,
-            prusa_server_url=self._settings.get(["prusa_server_url"])
-        )
-
-    def _get_prusa_connect_status(self):
-        token = self._settings.get(["prusa_connect_token"])
-        tmp_code = self._settings.get(["prusa_connect_tmp_code"])
-        sn = self._settings.get(["prusa_connect_sn"])
-        status = "Status Unknown. Please check logs." # Default
-        is_token_available = False
-        tmp_code_to_send = None
-        token_display_partial_val = None
-
-        if self.prusa_printer and self.prusa_printer.token_set and token:
-            status_token_display = f"{token[:4]}...{token[-4:]}" if token and len(token) > 8 else "Set"
-            status = f"Registered (Token: {status_token_display})"
-            is_token_available = True
-            if len(token) > 8:
-                token_display_partial_val = f"{token[:4]}...{token[-4:]}"
-            elif token:
-                token_display_partial_val = "Token Set (Short)"
-            else:
-                token_display_partial_val = "Token Set"
-            # If we are registered, there should be no persistent registration error message.
-            # self._registration_error_message = None # Cleared in _token_retrieved_successfully
-
-        elif tmp_code and self.token_retrieval_timer and self.token_retrieval_timer.is_alive() and not self._registration_error_message:
-            status = f"Awaiting code entry on Prusa Connect: {tmp_code}"
-            tmp_code_to_send = tmp_code
-        elif tmp_code and not self._registration_error_message: # tmp_code exists, timer might not be active (e.g. restart)
-             status = f"Has temporary code {tmp_code}. Registration process may be paused or will resume/restart."
-             tmp_code_to_send = tmp_code
-        elif self._registration_error_message:
-            status = "Registration Error" # General status text for error
-            tmp_code_to_send = tmp_code # Still send tmp_code if we have one
-            # The specific error is in self._registration_error_message
-        elif not token and self.prusa_printer and hasattr(self.prusa_printer, 'tmp_code') and self.prusa_printer.tmp_code and self.sdk_thread and self.sdk_thread.is_alive():
-             status = f"Not Registered. SDK active. Temp code from SDK: {self.prusa_printer.tmp_code}. Waiting for user entry."
-             tmp_code_to_send = self.prusa_printer.tmp_code
-        elif not token and self.sdk_thread and self.sdk_thread.is_alive():
-            status = "Not Registered. SDK is active. Wizard will guide registration if needed."
-        elif not token:
-             status = "Not Registered. SDK may not be active or initialized. Wizard will guide registration if needed."
-
-
-        current_message_content = dict(
-            status_text=status,
-            prusa_connect_sn=sn if sn else "Not set",
-            tmp_code=tmp_code_to_send,
-            token_available=is_token_available,
-            token_display_partial=token_display_partial_val,
-            registration_error_message=self._registration_error_message # Add the error message
+            prusa_server_url=self._config.prusa_server_url
         )
 
-        # Push status updates to UI via plugin message if it has changed.
-        # Add self._registration_error_message to the tuple for change detection.
-        simplified_current_status_tuple = (status, tmp_code_to_send, is_token_available, token_display_partial_val, self._registration_error_message)
-        simplified_last_status_tuple = getattr(self, "_last_simplified_status_pushed", None)
-
-        if simplified_last_status_tuple != simplified_current_status_tuple:
-            self._logger.debug(f"Sending PrusaConnectBridge plugin message: {current_message_content}")
-            self._plugin_manager.send_plugin_message(self._identifier, current_message_content)
-            self.last_status_sent_to_ui = status
-            self._last_simplified_status_pushed = simplified_current_status_tuple
-
-        return status
+    def _push_status(self, message):
+        self._logger.debug(f"Sending PrusaConnectBridge plugin message: {message}")
+        self._plugin_manager.send_plugin_message(self._identifier, message)
 
     ##~~ AssetPlugin mixin
 
@@ -646,13 +1068,61 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
             less=["less/prusaconnectbridge.less"]
         )
 
+    ##~~ Metrics
+
+    def _register_metric_gauges(self):
+        # Evaluated on every scrape only
+        self._metrics.gauge("prusaconnect_sdk_loop_lag_seconds", self._sdk.loop_lag)
+        self._metrics.gauge("prusaconnect_sdk_loop_threads", lambda: self._sdk.thread_count)
+        self._metrics.gauge("prusaconnect_sdk_queue_depth",
+                            lambda: self.prusa_printer.queue.qsize() if self.prusa_printer else None)
+        self._metrics.gauge("prusaconnect_command_workers_busy",
+                            lambda: self._command_executor.busy_workers if self._command_executor else None)
+        self._metrics.gauge("prusaconnect_telemetry_buffered",
+                            lambda: len(self._telemetry_buffer) if self._telemetry_buffer else 0)
+        self._metrics.gauge("prusaconnect_telemetry_buffer_dropped_total",
+                            lambda: self._telemetry_buffer.dropped if self._telemetry_buffer else 0)
+        self._metrics.gauge("prusaconnect_telemetry_replayed_total",
+                            lambda: self._telemetry_buffer.replayed if self._telemetry_buffer else 0)
+        self._metrics.gauge("prusaconnect_http_connections_opened_total",
+                            lambda: self._http.connections_opened() if self._http else None)
+        self._metrics.gauge("prusaconnect_http_requests_total",
+                            lambda: self._http.requests_sent() if self._http else None)
+        self._metrics.gauge("prusaconnect_storage_free_bytes",
+                            lambda: self._storage.free_space if self._storage and self._storage.sampled else None)
+        self._metrics.gauge("prusaconnect_storage_total_bytes",
+                            lambda: self._storage.total_space if self._storage and self._storage.sampled else None)
+        self._metrics.gauge("prusaconnect_camera_interval_seconds",
+                            lambda: self._camera.interval() if self._camera else None)
+        self._metrics.gauge("prusaconnect_bridged_printers",
+                            lambda: len(self._bridge.printers) if self._bridge else 0)
+        for phase in ("import", "settings_initialized", "after_startup", "sdk_ready"):
+            self._metrics.gauge("prusaconnect_startup_seconds", lambda phase=phase: self._startup_timings.get(phase),
+                                phase=phase)
+
     ##~~ SimpleApiPlugin mixin
+    def on_api_get(self, request):
+        import flask
+
+        # Prometheus scrape target, e.g. /api/plugin/prusaconnectbridge with an X-Api-Key header
+        return flask.Response(self._metrics.render(), mimetype="text/plain; version=0.0.4")
+
     def get_api_commands(self):
         return dict(
-            clear_prusa_connect_settings=[]
+            clear_prusa_connect_settings=[],
+            add_bridged_printer=["url", "api_key"],
+            remove_bridged_printer=["sn"],
+            list_bridged_printers=[],
+            resync_files=[]
         )
 
     def on_api_command(self, command, data):
+        import flask
+
+        # Commands act on the SDK Printer and the bridge, both set up in the background after startup
+        if not self._wait_for_startup():
+            return flask.make_response(flask.jsonify(status="starting",
+                                                     error="Prusa Connect is still being set up, try again shortly"), 503)
         if command == "clear_prusa_connect_settings":
             self._logger.info("API command: 'clear_prusa_connect_settings' received.")
 
@@ -661,36 +1131,24 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
                 self.token_retrieval_timer.cancel()
                 self.token_retrieval_timer = None
                 self._logger.info("Token retrieval timer cancelled.")
-            if self.telemetry_timer and self.telemetry_timer.is_alive():
-                self.telemetry_timer.cancel()
-                self.telemetry_timer = None
+            if self._telemetry_engine and self._telemetry_engine.is_alive():
+                self._stop_telemetry_timer()
                 self._logger.info("Telemetry timer cancelled.")
 
-            # Reset SDK printer object attributes safely
-            if self.prusa_printer:
-                try:
-                    # Attempt to stop the SDK loop gracefully if possible
-                    # This depends on SDK internals; a direct stop method is often not exposed for the loop thread.
-                    # For now, we rely on daemon=True for the thread and re-creating the Printer object.
-                    self._logger.info("Resetting Prusa SDK printer object attributes.")
-                    self.prusa_printer.token = None
-                    self.prusa_printer.tmp_code = None
-                    self.prusa_printer.token_set = False
-                except Exception as e_sdk_reset:
-                    self._logger.error(f"Error resetting SDK printer object attributes: {e_sdk_reset}")
-
-
-            # Clear settings in OctoPrint's storage
-            self._settings.set(["prusa_connect_sn"], None)
-            self._settings.set(["prusa_connect_fingerprint"], None)
-            self._settings.set(["prusa_connect_token"], None)
-            self._settings.set(["prusa_connect_tmp_code"], None)
-            self._settings.set(["prusa_connect_manual_sn"], None) # Clear manual SN as well
+            # Stop the SDK loop and the command executor bound to it, the printer is re-created below
+            self._stop_command_executor()
+            self._sdk.discard()
+
+
+            # Clear settings in OctoPrint's storage, including the manual SN.
             # Server URL is kept as it's user-configurable separately.
-            self._settings.save(trigger_event=True) # Save changes and trigger event for UI updates
+            self._write_settings(prusa_connect_sn=None, prusa_connect_fingerprint=None, prusa_connect_token=None,
+                                 prusa_connect_tmp_code=None, prusa_connect_manual_sn=None,
+                                 trigger_event=True) # Trigger event for UI updates
+            self._forget_camera_token()
 
             self.temp_code_displayed = False
-            self.last_status_sent_to_ui = ""
+            self._status.update(token=None, tmp_code=None, error=None)
 
             self._logger.info("Prusa Connect settings cleared. Attempting to re-initialize SDK and registration.")
             msg = "Settings cleared. Re-initializing and attempting re-registration..."
@@ -699,24 +1157,16 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
                 # Re-initialize identifiers (this will generate new SN if old one was cleared)
                 new_sn, new_fingerprint = self._initialize_identifiers()
 
-                # Create a new Printer object for the SDK
-                self.prusa_printer = Printer(fingerprint=new_fingerprint, sn=new_sn, printer_type=const.PrinterType.I3MK3)
-                self._logger.info(f"New Prusa SDK Printer object created. SN: {new_sn}, Fingerprint: {new_fingerprint}")
+                # Create a new Printer object for the SDK, without a token
+                self._sdk.create(new_sn, new_fingerprint, server=self.prusa_server)
 
                 # Re-register handlers for the new printer object
                 self._register_sdk_handlers()
+                self._start_command_executor()
 
-                # SDK Thread Management
-                # The old SDK thread, if running, is a daemon and will exit if its target (old prusa_printer.loop) finishes or errors out.
-                # Starting a new thread for the new printer object.
-                if self.sdk_thread and self.sdk_thread.is_alive():
-                    self._logger.warning("Previous SDK thread might still be running. Starting new SDK thread for re-registration.")
-                    # Ideally, we'd signal the old thread to stop, but SDK doesn't expose this easily.
-                    # Rely on daemon thread nature and OctoPrint shutdown for cleanup of old threads.
-
-                self.sdk_thread = threading.Thread(target=self.prusa_printer.loop, daemon=True, name="PrusaConnectSDKLoop-Reset")
-                self.sdk_thread.start()
+                self._sdk.start(name="PrusaConnectSDKLoop-Reset")
                 self._logger.info("New SDK thread started for re-registration.")
+                self._start_camera() # Under the new SN
 
                 self._initiate_registration() # Start registration with the new printer object
                 msg = "Settings cleared. Re-registration process initiated with new/regenerated identifiers."
@@ -726,47 +1176,138 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
                 self._logger.error(f"Critical error during settings clear and re-initialization: {str(e)}", exc_info=True)
                 msg = f"Critical error during settings clear: {str(e)}. Check plugin logs for details. You may need to restart OctoPrint."
 
-            self.last_status_sent_to_ui = "" # Force status update after all operations
-            self._get_prusa_connect_status()
             return flask.jsonify(message=msg)
+
+        elif command == "add_bridged_printer":
+            self._logger.info(f"API command: 'add_bridged_printer' received for {data.get('url')}.")
+            try:
+                config, code = self._add_bridged_printer(data.get("name"), data["url"], data["api_key"])
+            except Exception as e:
+                self._logger.error(f"Could not add bridged printer: {e}", exc_info=True)
+                return flask.make_response(flask.jsonify(error=str(e)), 500)
+            return flask.jsonify(sn=config["sn"], name=config["name"], code=code)
+
+        elif command == "remove_bridged_printer":
+            if not self._remove_bridged_printer(data["sn"]):
+                return flask.make_response(flask.jsonify(error="Unknown bridged printer"), 404)
+            return flask.jsonify(sn=data["sn"])
+
+        elif command == "list_bridged_printers":
+            printers = []
+            for config in self._config.bridged_printers:
+                bridged = self._bridge.get(config["sn"]) if self._bridge else None
+                printers.append(dict(
+                    name=config.get("name"),
+                    url=config.get("url"),
+                    sn=config.get("sn"),
+                    registered=bool(bridged.token if bridged else config.get("token")),
+                    code=bridged.printer.code if bridged else None,
+                    reachable=bridged.reachable if bridged else None
+                ))
+            return flask.jsonify(printers=printers)
+
+        elif command == "resync_files":
+            self._logger.info("API command: 'resync_files' received.")
+            if not self._file_sync or not self._file_sync.resync():
+                return flask.make_response(flask.jsonify(error="Not registered with Prusa Connect"), 409)
+            return flask.jsonify(version=self._file_sync.version)
         return None
 
     ##~~ EventHandlerPlugin mixin
+
+    # OctoPrint events forwarded to Prusa Connect, by the event queue key they coalesce under
+    QUEUED_EVENTS = {
+        Events.CONNECTED: "state",
+        Events.DISCONNECTED: "state",
+        Events.PRINTER_STATE_CHANGED: "state",
+        Events.Z_CHANGE: "layer",
+    }
+
     def on_event(self, event, payload):
+        # Keep the file index current, independent of the registration state
+        if self._file_index and event in FileIndex.HANDLED_EVENTS:
+            try:
+                self._file_index.on_event(event, payload)
+            except Exception as e:
+                self._logger.error(f"Error updating file index for OctoPrint event '{event}': {e}", exc_info=True)
+            # Files came or went, sampled once a burst of them is over
+            self._storage.request()
+            self._queue_file_sync()
+            self._update_time_index(event, payload or {})
+            return
+
+        if event == Events.FILE_SELECTED and self._times is not None and (payload or {}).get("origin") == "local":
+            # Loaded (or built) before the print starts, not on its first telemetry tick
+            self._times.request(payload["path"], load=True)
+            return
+
+        if event == Events.PRINT_STARTED and self._machine is not None:
+            # Layers count from the start of the print
+            self._machine.print_started()
+            return
+
+        key = self.QUEUED_EVENTS.get(event)
+        if key is None:
+            return
+
         # Ensure SDK object is initialized and token is set before trying to use it
-        if not hasattr(self, 'prusa_printer') or not self.prusa_printer or not self.prusa_printer.token_set:
+        if not self.prusa_printer or not self.prusa_printer.token:
             # Only process events if SDK is initialized and token is set (i.e., registered and connected)
             return
 
-        try:
-            if event == Events.CONNECTED:
-                self._logger.info("OctoPrint connected to printer. Setting Prusa Connect state to READY (if not already printing/paused).")
-                current_data = self._printer.get_current_data()
-                if not current_data['state']['flags']['printing'] and not current_data['state']['flags']['paused']:
-                    self.prusa_printer.set_state(const.State.READY)
+        # Handled by the event queue worker, a burst of events for the same key ends up as one update
+        self._events.put(key, event, payload)
 
+    def _update_time_index(self, event, payload):
+        times = self._times
+        if times is None or payload.get("storage", "local") != "local" or "path" not in payload:
+            return
+        if event == Events.FILE_ADDED and "machinecode" in (payload.get("type") or []):
+            # Built right after the upload, so printing it needs no parsing
+            times.request(payload["path"])
+        elif event in (Events.FILE_REMOVED, Events.FOLDER_REMOVED):
+            times.forget(payload["path"])
+
+    def _handle_event(self, key, event, payload):
+        if key == "state":
+            if event == Events.CONNECTED:
+                self._logger.info("OctoPrint connected to printer. Sending the current state to Prusa Connect.")
             elif event == Events.DISCONNECTED:
-                self._logger.info("OctoPrint disconnected from printer. Reporting OFFLINE to Prusa Connect.")
-                self.prusa_printer.set_state(const.State.OFFLINE)
-
-            elif event == Events.PRINTER_STATE_CHANGED:
-                new_octo_state_id = payload.get("state_id")
-                self._logger.debug(f"OctoPrint PRINTER_STATE_CHANGED event: {new_octo_state_id}") # DEBUG level for frequent events
-                if new_octo_state_id == "ERROR" or new_octo_state_id == "CLOSED_WITH_ERROR":
-                    self._logger.warning(f"OctoPrint reported printer state: {new_octo_state_id}. Setting Prusa Connect state to ERROR.")
-                    self.prusa_printer.set_state(const.State.ERROR)
-                    # Optionally send a FAILED event to Prusa Connect with more details if available
-                    # self.prusa_printer.event_cb(const.Event.FAILED, message=f"Printer error: {new_octo_state_id}")
-                elif new_octo_state_id == "OFFLINE": # Should be covered by DISCONNECTED, but good for robustness
-                    self._logger.info("OctoPrint reported printer state: OFFLINE. Setting Prusa Connect state to OFFLINE.")
-                    self.prusa_printer.set_state(const.State.OFFLINE)
-                # Other state changes are typically handled by the periodic telemetry update.
-        except AttributeError as ae:
-            # This can happen if prusa_printer is None or methods are missing (e.g. token_set before init)
-            self._logger.debug(f"SDK attribute error in on_event handling OctoPrint event '{event}': {ae}. SDK might not be fully initialized or printer object changed.", exc_info=False) # Debug, as this might be normal during startup/shutdown
-        except Exception as e:
-            self._logger.error(f"Error processing OctoPrint event '{event}' for Prusa Connect: {e}", exc_info=True)
-
+                self._logger.info("OctoPrint disconnected from printer. Sending the current state to Prusa Connect.")
+            else:
+                state_id = (payload or {}).get("state_id")
+                self._logger.debug(f"OctoPrint PRINTER_STATE_CHANGED event: {state_id}") # DEBUG level for frequent events
+                if state_id in ("ERROR", "CLOSED_WITH_ERROR"):
+                    self._logger.warning(f"OctoPrint reported printer state: {state_id}. Sending ERROR to Prusa Connect.")
+            # The snapshot maps OctoPrint's current state (READY, PRINTING, PAUSED, ERROR or ATTENTION while
+            # disconnected) and goes out right away, the telemetry engine leaves state changes to us
+            self._send_telemetry(force=True)
+            if self._camera is not None:
+                # Printing and idle have their own snapshot intervals
+                self._camera.wake()
+
+        elif key == "files":
+            self._file_sync.sync()
+
+        elif key == "layer":
+            # Layer change while printing, send telemetry at the fast cadence for a little while
+            if self._telemetry_engine and self._printer.is_printing():
+                # The Z the nozzle settled at, hops within the coalescing window don't reach us
+                self._machine.on_z_change((payload or {}).get("new"))
+                if self._telemetry_engine.cadence.layer_changed():
+                    self._telemetry_engine.reschedule()
+
+
+    ##~~ G-code sent hook
+
+    def on_gcode_sent(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+        # Runs on OctoPrint's serial thread for every command, anything but fan, feedrate and flow is a set lookup
+        machine = self._machine
+        if machine is not None and gcode in machine.GCODES:
+            try:
+                machine.on_gcode_sent(gcode, cmd)
+            except Exception as e:
+                self._logger.debug(f"Could not track G-code '{cmd}': {e}")
 
     ##~~ Softwareupdate hook
 
@@ -796,7 +1337,7 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
 
     def is_wizard_required(self):
         self._logger.debug("PrusaConnectBridgePlugin: Checking if wizard is required.")
-        token = self._settings.get(["prusa_connect_token"])
+        token = self._config.prusa_connect_token
         if token is None or token == "":
             self._logger.info("PrusaConnectBridgePlugin: Wizard required because Prusa Connect token is missing.")
             return True
@@ -806,15 +1347,18 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
 
     def on_wizard_show(self):
         self._logger.info("PrusaConnectBridgePlugin: Wizard shown.")
-        # Optionally, send current status to pre-populate wizard dynamically if needed beyond get_wizard_details
-        # self._get_prusa_connect_status() # This will send a plugin message
+        # A freshly opened wizard gets the current status even if nothing changed since the last push
+        self._status.update()
+        self._push_status(self._status.message)
 
     def on_wizard_finish(self):
         self._logger.info("PrusaConnectBridgePlugin: Wizard finished.")
-        self._get_prusa_connect_status() # Update status on settings page etc.
 
     def on_wizard_proceed(self, current_step_id, next_step_id, data=None): # Added data=None for safety, though base class provides it
         self._logger.info(f"Wizard proceeding from '{current_step_id}' to '{next_step_id}'.")
+        if not self._wait_for_startup():
+            self._registration_error_message = "Prusa Connect is still being set up, go back and try again in a moment."
+            return
 
         if current_step_id == "introduction" and next_step_id == "collect_sn_input":
             self._logger.info("Proceeding from introduction to SN collection step.")
@@ -825,16 +1369,29 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
 
             if manual_sn: # Check if manual_sn is not None and not an empty string
                 self._logger.info(f"User provided manual SN: {manual_sn}")
-                self._settings.set(["prusa_connect_manual_sn"], manual_sn)
             else:
                 self._logger.info("User did not provide manual SN, or it was empty. Clearing any existing manual SN setting.")
-                self._settings.set(["prusa_connect_manual_sn"], None) # Ensure it's None if empty or not provided
+                manual_sn = None # Ensure it's None if empty or not provided
 
-            self._settings.save()
+            self._write_settings(prusa_connect_manual_sn=manual_sn)
             self._logger.info("Manual SN (or lack thereof) saved to settings.")
 
             self._logger.info("Re-initializing identifiers based on wizard input before Prusa Connect registration.")
-            self._initialize_identifiers() # This will use manual_sn if set, or generate/use existing, and save all SN/FP.
+            sn, fingerprint = self._initialize_identifiers() # This will use manual_sn if set, or generate/use existing, and save all SN/FP.
+
+            if self.prusa_printer is None or self.prusa_printer.sn != sn:
+                # The code is issued for the printer's SN, so it has to be the one the user chose
+                self._logger.info(f"Re-creating Prusa SDK Printer object for SN {sn} before registration.")
+                try:
+                    self._stop_command_executor()
+                    self._sdk.create(sn, fingerprint, server=self.prusa_server)
+                    self._register_sdk_handlers()
+                    self._start_command_executor()
+                    self._sdk.start(name="PrusaConnectSDKLoop-Wizard")
+                except Exception as e:
+                    self._logger.error(f"Failed to re-create Prusa SDK Printer object: {e}", exc_info=True)
+                    self._registration_error_message = f"Failed to initialize Prusa Connect SDK: {e}. Check logs."
+                    return
 
             self._logger.info("Identifiers re-initialized. Initiating Prusa Connect registration.")
             self._initiate_registration()
@@ -842,10 +1399,10 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
 
     def get_wizard_details(self):
         self._logger.debug("PrusaConnectBridgePlugin: get_wizard_details called.")
-        sn = self._settings.get(["prusa_connect_sn"])
-        fingerprint = self._settings.get(["prusa_connect_fingerprint"])
-        tmp_code = self._settings.get(["prusa_connect_tmp_code"])
-        token = self._settings.get(["prusa_connect_token"])
+        sn = self._config.prusa_connect_sn
+        fingerprint = self._config.prusa_connect_fingerprint
+        tmp_code = self._config.prusa_connect_tmp_code
+        token = self._config.prusa_connect_token
 
         token_display = "Not yet available"
         if token and len(token) > 8:
@@ -873,7 +1430,7 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
                 "description": "You can optionally provide a specific Serial Number (SN) for your printer to use with Prusa Connect. This is useful if you have an Original Prusa printer or need to use a pre-assigned SN. If you leave this field blank, a unique ID will be automatically generated.",
                 "template": "prusaconnectbridge_wizard.jinja2",
                 "data": {
-                    "manual_sn_value": self._settings.get(["prusa_connect_manual_sn"]),
+                    "manual_sn_value": self._config.prusa_connect_manual_sn,
                     "next_button_label": "Continue to Registration",
                     "finish_button": False
                 }
@@ -906,6 +1463,9 @@ class PrusaConnectBridgePlugin(octoprint.plugin.SettingsPlugin,
             }
         ]
 
+# Everything above, without what OctoPrint had already imported
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
+
 # Plugin registration
 __plugin_name__ = "PrusaConnect-Bridge"
 __plugin_version__ = "0.1.4"
@@ -921,5 +1481,6 @@ def __plugin_load__():
     global __plugin_hooks__
     __plugin_hooks__ = {
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
-        "octoprint.plugin.settings.initialized": __plugin_implementation__.on_settings_initialized # Add this hook
+        "octoprint.plugin.settings.initialized": __plugin_implementation__.on_settings_initialized, # Add this hook
+        "octoprint.comm.protocol.gcode.sent": __plugin_implementation__.on_gcode_sent
     }
@@ -0,0 +1,648 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import queue
+import socket
+import threading
+import time
+from concurrent.futures import CancelledError as FutureCancelledError
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import nullcontext
+from urllib.parse import urlsplit
+
+from prusa.connect.printer import const, errors
+from prusa.connect.printer.conditions import HTTP, INTERNET, TOKEN, CondState
+from prusa.connect.printer.models import CameraRegister, Event, LoopObject, Register, Telemetry
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests.exceptions import HTTPError, Timeout
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_environ_proxies, select_proxy
+
+# Lower goes first. Command results and state changes before registration, registration before
+# telemetry (which also polls for commands), camera snapshots last.
+PRIORITY_EVENT = 0
+PRIORITY_REGISTER = 1
+PRIORITY_TELEMETRY = 2
+PRIORITY_UPLOAD = 3
+
+# Responses from Prusa Connect are small, anything larger than this is a broken response
+MAX_BODY = 16 * 1024 * 1024
+
+
+class ProtocolError(IOError):
+    pass
+
+
+def proxy_for(url):
+    """The proxy requests would take to ``url`` by the environment (``HTTPS_PROXY``, ``NO_PROXY``...), or None."""
+    return select_proxy(url, get_environ_proxies(url))
+
+
+def priority_of(item):
+    if isinstance(item, Event):
+        return PRIORITY_EVENT
+    if isinstance(item, (Register, CameraRegister)):
+        return PRIORITY_REGISTER
+    return PRIORITY_TELEMETRY
+
+
+class Response(object):
+    """The parts of a requests Response the SDK and the bridge use."""
+
+    def __init__(self, url, status_code, reason, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPError(f"{self.status_code} {self.reason} for url: {self.url}", response=self)
+
+
+class AsyncHTTP(object):
+    """Minimal non-blocking HTTP/1.1 client on asyncio streams, for Prusa Connect's small requests.
+
+    Keeps up to ``connections`` keep-alive connections per host. When all are
+    busy, requests wait for one, the lowest ``priority`` first. A request on a
+    reused connection that the server closed in the meantime is sent again on
+    a new one, as the SDK's RetryingSession does. Unlike requests it doesn't
+    go through proxies, see :func:`proxy_for`.
+    """
+
+    def __init__(self, ssl_context=None, connections=2, timeout=const.CONNECTION_TIMEOUT):
+        self._ssl_context = ssl_context
+        self.connections = max(int(connections), 1)
+        self.timeout = timeout
+        self._idle = {} # (scheme, host, port) -> [(reader, writer)]
+        self._open = {} # (scheme, host, port) -> connections open or being opened
+        self._waiters = {} # (scheme, host, port) -> heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self.connections_opened = 0
+        self.requests_sent = 0
+
+    async def request(self, method, url, headers=None, body=None, priority=PRIORITY_TELEMETRY, timeout=None):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        host = parts.hostname if parts.port is None else f"{parts.hostname}:{parts.port}"
+        timeout = self.timeout if timeout is None else timeout
+
+        for attempt in (0, 1):
+            conn, reused = await self._acquire(key, priority)
+            try:
+                response, keep_alive = await asyncio.wait_for(
+                    self._exchange(conn, method, host, target, headers, body, url), timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self._release(key, conn, False)
+                if reused and not attempt:
+                    continue # The server closed the idle connection, try a fresh one
+                raise
+            except BaseException:
+                self._release(key, conn, False)
+                raise
+            self.requests_sent += 1
+            self._release(key, conn, keep_alive)
+            return response
+
+    async def close(self):
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+    ##~~ Connections
+
+    async def _acquire(self, key, priority):
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return (reader, writer), True
+            writer.close()
+            self._open[key] -= 1
+        if self._open.get(key, 0) >= self.connections:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters.setdefault(key, []), (priority, next(self._seq), future))
+            conn = await future
+            if conn is not None:
+                return conn, True
+            # A connection was closed, its slot is ours
+        self._open[key] = self._open.get(key, 0) + 1
+        scheme, hostname, port = key
+        try:
+            conn = await asyncio.wait_for(asyncio.open_connection(
+                hostname, port, ssl=self._ssl_context if scheme == "https" else None,
+                server_hostname=hostname if scheme == "https" else None), self.timeout)
+        except BaseException:
+            self._open[key] -= 1
+            self._hand_over(key, None)
+            raise
+        sock = conn[1].get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections_opened += 1
+        return conn, False
+
+    def _release(self, key, conn, keep_alive):
+        if keep_alive and self._hand_over(key, conn):
+            return
+        if keep_alive:
+            self._idle.setdefault(key, []).append(conn)
+            return
+        conn[1].close()
+        self._open[key] -= 1
+        self._hand_over(key, None)
+
+    def _hand_over(self, key, conn):
+        """Passes a connection (or with None a free slot) to the most urgent waiter, returns whether there was one."""
+        waiters = self._waiters.get(key)
+        while waiters:
+            _, _, future = heapq.heappop(waiters)
+            if not future.done():
+                future.set_result(conn)
+                return True
+        return False
+
+    ##~~ Exchange
+
+    async def _exchange(self, conn, method, host, target, headers, body, url):
+        reader, writer = conn
+        body = body or b""
+        lines = [f"{method} {target} HTTP/1.1", f"Host: {host}", "Accept-Encoding: identity"]
+        lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+        if body or method in ("POST", "PUT", "PATCH"):
+            lines.append(f"Content-Length: {len(body)}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+        while True:
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionResetError("connection closed before the response")
+            try:
+                version, status, reason = (status_line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+                status = int(status)
+            except ValueError:
+                raise ProtocolError(f"invalid status line {status_line!r}")
+            response_headers = CaseInsensitiveDict()
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n"):
+                    break
+                if not line:
+                    raise asyncio.IncompleteReadError(line, None)
+                name, _, value = line.decode("latin-1").partition(":")
+                response_headers[name.strip()] = value.strip()
+            if status >= 200:
+                break # Skips 100 Continue and other interim responses
+
+        keep_alive = version != "HTTP/1.0" and response_headers.get("Connection", "").lower() != "close"
+        if method == "HEAD" or status in (204, 304):
+            content = b""
+        elif response_headers.get("Transfer-Encoding", "").lower() == "chunked":
+            content = await self._read_chunked(reader)
+        elif "Content-Length" in response_headers:
+            length = int(response_headers["Content-Length"])
+            if length > MAX_BODY:
+                raise ProtocolError(f"response body of {length} bytes")
+            content = await reader.readexactly(length)
+        else:
+            content = await self._read_to_eof(reader)
+            keep_alive = False
+        return Response(url, status, reason, response_headers, content), keep_alive
+
+    @staticmethod
+    async def _read_to_eof(reader):
+        # Without a length the body ends when the server closes the connection, read() returns what has arrived
+        content = bytearray()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return bytes(content)
+            content += data
+            if len(content) > MAX_BODY:
+                raise ProtocolError("response body too large")
+
+    @staticmethod
+    async def _read_chunked(reader):
+        content = bytearray()
+        while True:
+            size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+            if not size:
+                break
+            content += await reader.readexactly(size)
+            await reader.readexactly(2)
+            if len(content) > MAX_BODY:
+                raise ProtocolError("response body too large")
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass # Trailers
+        return bytes(content)
+
+
+class _Recorder(object):
+    """Passed to ``LoopObject.send`` as the connection, keeps the request instead of sending it."""
+
+    text = ""
+
+    def request(self, method, url, headers=None, json=None, data=None, params=None, timeout=None, **kwargs):
+        self.method = method
+        self.url = url
+        self.headers = dict(headers or {})
+        if json is not None:
+            self.headers["Content-Type"] = "application/json"
+            data = _dumps(json)
+        self.body = data
+        return self
+
+
+def _dumps(payload):
+    # Like requests, which refuses NaN as well
+    return json.dumps(payload, allow_nan=False).encode("utf-8")
+
+
+class _LoopQueue(object):
+    """Takes the place of the SDK Printer's ``queue``, ordered by :func:`priority_of` and then by arrival.
+
+    Thread-safe like the ``queue.Queue`` it replaces: ``put`` wakes the core's
+    event loop, which drains the queue without blocking. ``get`` blocks like
+    the original, should ``Printer.loop`` ever run on it again.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._notify = None
+
+    def attach(self, notify):
+        self._notify = notify
+
+    def put(self, item, block=True, timeout=None):
+        with self._cond:
+            heapq.heappush(self._heap, (priority_of(item), next(self._seq), item))
+            notify = self._notify
+            self._cond.notify()
+        if notify is not None:
+            notify()
+
+    put_nowait = put
+
+    def get(self, block=True, timeout=None):
+        with self._cond:
+            if block and not self._cond.wait_for(lambda: self._heap, timeout):
+                raise queue.Empty
+            if not self._heap:
+                raise queue.Empty
+            return heapq.heappop(self._heap)[2]
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return len(self._heap)
+
+    def empty(self):
+        return not self._heap
+
+
+class AsyncCore(object):
+    """Runs a Prusa Connect SDK ``Printer``'s traffic on one asyncio event loop, in place of ``Printer.loop``.
+
+    On its one thread the core sends what the printer queues (events first,
+    then registration, then telemetry), parses the commands telemetry
+    responses carry, drives the command executor that runs them, and
+    multiplexes other requests to Prusa Connect such as camera snapshots
+    (:meth:`request`) over the same keep-alive connections. The responses
+    are handled like ``Printer.loop_step`` handles them: commands,
+    registration and camera tokens, and the SDK's connection conditions.
+
+    The command handlers themselves still run on a small worker pool, they
+    call into OctoPrint, which blocks. ``timed_step()`` returns a context
+    manager timing one send and ``idle()`` is called when there was nothing
+    to send for :attr:`IDLE_TICK`, which is how the loop health is kept.
+    """
+
+    IDLE_TICK = 1.0
+    # Seconds a request from another thread may wait for a connection, behind others, on top of its timeout
+    REQUEST_GRACE = 30.0
+
+    def __init__(self, printer, ssl_context=None, connections=2, executor=None, timed_step=None, idle=None,
+                 logger=None):
+        self._printer = printer
+        self._ssl_context = ssl_context
+        self._connections = connections
+        self._executor = executor
+        self._pool = None
+        self._timed_step = timed_step or nullcontext
+        self._idle = idle
+        self._logger = logger or logging.getLogger("octoprint.plugins.PrusaConnectBridge.asynccore")
+
+        self._queue = _LoopQueue()
+        self._thread = None
+        self._loop = None
+        self._http = None
+        self._started = threading.Event()
+        self._stopping = None # asyncio.Event, set from stop()
+        self._wakeup = None # asyncio.Event, set when something was queued
+        self._commands = None # asyncio.Event, set when a command may have been accepted
+        # Requests from other threads: accepted only while the loop runs, cancelled when it stops
+        self._request_lock = threading.Lock()
+        self._accepting = False
+        self._pending = set() # concurrent.futures.Future waited on by the requesting threads
+        self._requests = set() # asyncio.Task of those requests
+
+    @property
+    def thread(self):
+        return self._thread
+
+    @property
+    def http(self):
+        return self._http
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    ##~~ Lifecycle
+
+    def start(self, name="PrusaConnectAsyncCore"):
+        # Items the printer queued before the core took over are sent first
+        old_queue, self._printer.queue = self._printer.queue, self._queue
+        while True:
+            try:
+                self._queue.put(old_queue.get_nowait())
+            except queue.Empty:
+                break
+        self._thread = threading.Thread(target=self._run, daemon=True, name=name)
+        self._thread.start()
+        self._started.wait()
+
+    def stop(self, timeout=2.0):
+        """Stops the loop, returns whether its thread exited within ``timeout``."""
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self._stopping.set)
+            except RuntimeError:
+                pass # Closed meanwhile
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        self._shutdown_pool()
+        return not self.is_alive()
+
+    def attach(self, executor):
+        """Drives ``executor`` from the loop, on a worker pool owned by the core instead of its dispatcher thread."""
+        self._shutdown_pool()
+        self._executor = executor
+        if executor is None:
+            return
+        self._pool = ThreadPoolExecutor(max_workers=executor.workers, thread_name_prefix="PrusaConnectCommand")
+        # An executor still running on the pool of a previous core is moved over
+        executor.stop()
+        executor.start(pool=self._pool)
+        self._notify_commands()
+
+    def _shutdown_pool(self):
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            # Like the executor's own pool, running handlers can't be interrupted anyway
+            pool.shutdown(wait=False)
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._main())
+        except Exception as e:
+            self._logger.error(f"Prusa Connect async core stopped with an error: {e}", exc_info=True)
+        finally:
+            self._started.set()
+            loop.close()
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self._commands = asyncio.Event()
+        self._http = AsyncHTTP(self._ssl_context, self._connections)
+        self._queue.attach(self._notify_queue)
+        if self._executor is not None and self._pool is None:
+            self.attach(self._executor)
+        tasks = [asyncio.ensure_future(self._send_loop()), asyncio.ensure_future(self._command_loop())]
+        with self._request_lock:
+            self._accepting = True
+        self._started.set()
+        self._logger.info("Prusa Connect async core started.")
+        try:
+            await self._stopping.wait()
+        finally:
+            self._queue.attach(None)
+            with self._request_lock:
+                self._accepting = False
+                pending = list(self._pending)
+            # Requests in flight fail, rather than leave their threads waiting on a closed loop
+            tasks.extend(self._requests)
+            for task in tasks:
+                task.cancel()
+            for future in pending:
+                future.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self._http.close()
+            self._logger.info("Prusa Connect async core stopped.")
+
+    def _notify_queue(self):
+        self._call_soon(self._wakeup.set)
+
+    def _notify_commands(self):
+        if self._commands is not None:
+            self._call_soon(self._commands.set)
+
+    def _call_soon(self, callback):
+        try:
+            self._loop.call_soon_threadsafe(callback)
+        except RuntimeError:
+            pass # The loop is gone, nothing to wake
+
+    ##~~ Requests from other threads
+
+    def request(self, method, url, headers=None, data=None, json=None, priority=PRIORITY_UPLOAD, timeout=None):
+        """Sends a request on the loop from any other thread and waits for the :class:`Response`."""
+        headers = dict(headers or {})
+        if json is not None:
+            headers["Content-Type"] = "application/json"
+            data = _dumps(json)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if isinstance(timeout, tuple):
+            timeout = sum(timeout) # requests' (connect, read), one total here
+        with self._request_lock:
+            if not self._accepting:
+                raise RequestsConnectionError("The Prusa Connect async core is not running")
+            future = asyncio.run_coroutine_threadsafe(
+                self._request(method, url, headers, data, priority=priority, timeout=timeout), self._loop)
+            self._pending.add(future)
+        # A reused connection is tried once more on a fresh one
+        wait = (self._http.timeout if timeout is None else timeout) * 2 + self.REQUEST_GRACE
+        try:
+            return future.result(wait)
+        except FutureTimeoutError:
+            future.cancel()
+            raise Timeout(f"No response from the Prusa Connect async core within {wait:.0f} s")
+        except FutureCancelledError:
+            raise RequestsConnectionError("The Prusa Connect async core stopped during the request")
+        finally:
+            with self._request_lock:
+                self._pending.discard(future)
+
+    async def _request(self, *args, **kwargs):
+        task = asyncio.current_task()
+        self._requests.add(task)
+        try:
+            return await self._http.request(*args, **kwargs)
+        finally:
+            self._requests.discard(task)
+
+    ##~~ Sending
+
+    async def _send_loop(self):
+        while True:
+            # Cleared before looking, so an item queued right after is not missed
+            self._wakeup.clear()
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.IDLE_TICK)
+                except asyncio.TimeoutError:
+                    if self._idle is not None:
+                        self._idle()
+                continue
+            try:
+                with self._timed_step():
+                    await self._send(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._logger.exception("Unexpected exception caught in the Prusa Connect async core!")
+
+    async def _send(self, item):
+        printer = self._printer
+        if not printer.server:
+            self._logger.warning(f"Server is not set, skipping item: {item}")
+            return
+        if not isinstance(item, LoopObject):
+            self._logger.warning(f"Enqueued an unknown item: {item}")
+            return
+        if item.needs_token and not printer.token:
+            errors.TOKEN.ok = False
+            TOKEN.state = CondState.NOK
+            self._logger.warning(f"No token, skipping item: {item}")
+            return
+
+        request = _Recorder()
+        item.send(request, printer.server, printer.make_headers(item.timestamp))
+        try:
+            response = await self._http.request(request.method, request.url, request.headers, request.body,
+                                                priority=priority_of(item))
+        except (ConnectionError, socket.gaierror) as e:
+            errors.HTTP.ok = False
+            HTTP.state = CondState.NOK
+            self._logger.error(f"Could not reach Prusa Connect: {e!r}")
+        except (OSError, EOFError, asyncio.TimeoutError) as e:
+            # asyncio.TimeoutError is only an OSError from Python 3.11 on
+            errors.INTERNET.ok = False
+            INTERNET.state = CondState.NOK
+            self._logger.error(f"Request to Prusa Connect failed: {e!r}")
+        else:
+            await self._handle_response(item, response)
+
+    async def _handle_response(self, item, response):
+        printer = self._printer
+        if isinstance(item, Telemetry):
+            if response.status_code == 200:
+                # A command: accepting it waits up to a second for the previous one to end, off the loop
+                await self._loop.run_in_executor(None, printer.parse_command, response)
+            else:
+                printer.parse_command(response)
+            self._commands.set()
+        elif isinstance(item, Register):
+            if response.status_code == 200:
+                printer.token = response.headers["Token"]
+                errors.TOKEN.ok = True
+                TOKEN.state = CondState.OK
+                self._logger.info("New token was set.")
+                printer.register_handler(printer.token)
+                printer.code = None
+            elif response.status_code == 202 and item.timeout > time.time():
+                # Not confirmed yet, asked again in a second
+                self._loop.call_later(1.0, self._queue.put, item)
+        elif isinstance(item, CameraRegister):
+            if response.status_code == 200:
+                item.camera.set_token(response.headers["Token"])
+            else:
+                self._logger.warning(response.text)
+
+        printer.deduce_state_from_code(response.status_code)
+        if response.status_code > 400:
+            self._logger.warning(response.text)
+        elif response.status_code == 400:
+            self._logger.debug(response.text)
+
+    ##~~ Commands
+
+    async def _command_loop(self):
+        # In place of the executor's dispatcher thread: looks for accepted commands after every telemetry
+        # response, and every poll interval while commands run, for their timeouts and completion
+        while True:
+            self._commands.clear()
+            running = False
+            if self._executor is not None:
+                try:
+                    running = self._executor.poll()
+                except Exception as e:
+                    self._logger.error(f"Error in command dispatcher: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._commands.wait(), self._executor.POLL_INTERVAL if running else None)
+            except asyncio.TimeoutError:
+                pass
+
+
+class CoreSession(object):
+    """requests-like session that sends through the running :class:`AsyncCore`, or ``fallback`` without one.
+
+    ``core()`` returns the current core, so holders of the session follow the
+    core through SDK Printer re-creations.
+    """
+
+    def __init__(self, core, fallback, priority=PRIORITY_UPLOAD):
+        self._core = core
+        self._fallback = fallback
+        self.priority = priority
+
+    def request(self, method, url, **kwargs):
+        core = self._core()
+        if core is None or not core.is_alive():
+            return self._fallback.request(method, url, **kwargs)
+        return core.request(method, url, headers=kwargs.get("headers"), data=kwargs.get("data"),
+                            json=kwargs.get("json"), priority=self.priority, timeout=kwargs.get("timeout"))
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
@@ -0,0 +1,426 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from urllib.parse import quote
+
+from prusa.connect.printer import Printer, const
+from prusa.connect.printer.command import CommandFailed
+from prusa.connect.printer.models import Register
+from requests import RequestException, Session
+
+from .commands import CommandExecutor
+from .connection import attach_session
+from .files import FileIndex
+from .telemetry import CadenceScheduler, SnapshotBuilder, TelemetryEngine, link_down, send_snapshot
+
+
+class RestPrinterClient(object):
+    """Just enough of OctoPrint's printer and file manager, over the REST API of another OctoPrint instance.
+
+    :meth:`current_data` returns the layout of OctoPrint's printer callbacks and
+    :meth:`list_files` the one of ``file_manager.list_files``, so the bridged
+    printer can reuse :class:`SnapshotBuilder` and :class:`FileIndex` as they are.
+    """
+
+    # Kept well below the SDK's CONNECTION_TIMEOUT, an unreachable instance holds up the shared loop
+    TIMEOUT = 3.0
+
+    def __init__(self, url, api_key, session, timeout=TIMEOUT):
+        self.url = url.rstrip("/")
+        self._headers = {"X-Api-Key": api_key or ""}
+        self._session = session
+        self.timeout = timeout
+        # From the last file listing, for SEND_INFO
+        self.free_space = 0
+        self.total_space = 0
+
+    def _request(self, method, path, **kwargs):
+        return self._session.request(method, self.url + path, headers=self._headers, timeout=self.timeout, **kwargs)
+
+    def current_data(self):
+        """Returns (printer_data, temperature_data) of the instance's printer."""
+        res = self._request("GET", "/api/printer", params={"exclude": "sd"})
+        if res.status_code == 409:
+            # OctoPrint is up, but not connected to its printer
+            flags = dict(operational=False, printing=False, paused=False, error=False, closedOrError=True, ready=False)
+            return dict(state=dict(flags=flags)), {}
+        res.raise_for_status()
+        printer = res.json()
+        job = {}
+        flags = printer["state"]["flags"]
+        # Progress and file name are only reported while printing, skip the request otherwise
+        if flags.get("printing") or flags.get("paused"):
+            res = self._request("GET", "/api/job")
+            res.raise_for_status()
+            job = res.json()
+        return dict(state=printer["state"], job=job.get("job"), progress=job.get("progress")), printer.get("temperature") or {}
+
+    def list_files(self, recursive=True, locations=None, **kwargs):
+        res = self._request("GET", "/api/files/local", params={"recursive": "true"})
+        res.raise_for_status()
+        listing = res.json()
+        self.free_space = listing.get("free") or 0
+        self.total_space = listing.get("total") or 0
+        return {"local": _entries(listing.get("files") or [])}
+
+    def start_print(self, path):
+        res = self._request("POST", "/api/files/local/" + quote(path.lstrip("/")), json={"command": "select", "print": True})
+        if res.status_code == 404:
+            raise CommandFailed(f"File '{path}' not found")
+        if res.status_code == 409:
+            raise CommandFailed("Printer not ready")
+        res.raise_for_status()
+
+    def job_command(self, command, action=None):
+        data = {"command": command}
+        if action:
+            data["action"] = action
+        res = self._request("POST", "/api/job", json=data)
+        if res.status_code == 409:
+            # OctoPrint's answer when the job isn't in a state the command applies to
+            raise CommandFailed(f"Cannot {action or command}: {res.text.strip() or 'printer not ready'}")
+        res.raise_for_status()
+
+
+def _entries(files):
+    """Converts the REST file list (children as lists) to the ``list_files`` layout (children as dicts)."""
+    entries = {}
+    for item in files:
+        entry = dict(item)
+        if item.get("type") == "folder":
+            entry["children"] = _entries(item.get("children") or [])
+        entries[item["name"]] = entry
+    return entries
+
+
+class _BridgeQueue(Queue):
+    """SDK send queue that wakes the bridge loop up and holds registration polls back for the bridge.
+
+    The SDK's loop re-queues a pending Register and sleeps a second, which would
+    stall every other printer on the shared loop, so the bridge polls it itself.
+    """
+
+    def __init__(self, bridged, wakeup):
+        Queue.__init__(self)
+        self._bridged = bridged
+        self._wakeup = wakeup
+
+    def put(self, item, block=True, timeout=None):
+        if isinstance(item, Register):
+            self._bridged.pending_register = item
+        else:
+            Queue.put(self, item, block, timeout)
+        self._wakeup.set()
+
+
+class BridgedPrinter(object):
+    """A printer of another OctoPrint instance, registered with Prusa Connect as its own printer.
+
+    It has its own SDK ``Printer`` (identifiers, token, command state, send
+    queue) but no threads: the :class:`PrinterBridge` polls it on a shared
+    pool, and its loop sends its queue and dispatches its commands to the
+    shared command pool.
+    """
+
+    # Seconds between registration polls while a code is waiting to be entered in Prusa Connect
+    REGISTER_INTERVAL = 2.0
+
+    def __init__(self, config, server, session, wakeup, workers=2, timeout=30.0, on_token=None, logger=None, metrics=None):
+        self.sn = config["sn"]
+        self.name = config.get("name") or self.sn
+        self._logger = logger or logging.getLogger("octoprint.plugins.PrusaConnectBridge.bridge")
+        self._metrics = metrics
+        self._on_token = on_token
+        self.client = RestPrinterClient(config["url"], config.get("api_key"), session)
+
+        printer = Printer(type_=const.PrinterType.I3MK3, sn=self.sn, fingerprint=config["fingerprint"])
+        # Nothing on this host to watch, and the file tree comes from the instance's REST API
+        printer.inotify_handler.inotify.close()
+        printer.inotify_handler = None
+        # All bridged printers share one HTTP session (and its keep-alive connections to Connect)
+        attach_session(printer, session)
+        printer.queue = _BridgeQueue(self, wakeup)
+        printer.set_connection(server, config.get("token"))
+        printer.register_handler = self._token_received
+        # Only the commands below make sense for a remote instance, the SDK's own ones work on local files
+        printer.command.handlers = {}
+        self.printer = printer
+        self.pending_register = None
+        self._next_register = 0.0
+
+        self.files = FileIndex(self.client, logger=self._logger)
+        # Not started, the bridge loop feeds it from its polls
+        self.telemetry = TelemetryEngine(None, None, cadence=CadenceScheduler(), logger=self._logger)
+        self.snapshots = SnapshotBuilder()
+        self.executor = CommandExecutor(printer, workers=workers, timeout=timeout, logger=self._logger, metrics=metrics)
+        self.next_poll = 0.0
+        self.polling = None # Future of the poll in flight
+        self.reachable = None
+        self._register_handlers()
+
+    @property
+    def token(self):
+        return self.printer.token
+
+    def register(self):
+        """Requests a registration code from Prusa Connect, the bridge loop then waits for it to be entered."""
+        return self.printer.register()
+
+    ##~~ Polled from the bridge loop
+
+    def poll(self):
+        """Reads the instance's state and submits it as telemetry. Returns False if the instance is unreachable."""
+        try:
+            printer_data, temperature_data = self.client.current_data()
+        except (RequestException, ValueError, KeyError) as e:
+            if self.reachable is not False:
+                self._logger.warning(f"Bridged printer '{self.name}' ({self.client.url}) is unreachable: {e}")
+            self.reachable = False
+            self.telemetry.cadence.update(const.State.ERROR)
+            return False
+        if self.reachable is False:
+            self._logger.info(f"Bridged printer '{self.name}' is reachable again.")
+        self.reachable = True
+
+        snapshot, heating = self.snapshots.build(printer_data, temperature_data)
+        self.telemetry.cadence.update(snapshot["state"], heating=heating)
+        if self.printer.token:
+            self.telemetry.submit(snapshot, self._emit)
+        return True
+
+    def poll_registration(self, now):
+        item = self.pending_register
+        if item is None or now < self._next_register:
+            return
+        self._next_register = now + self.REGISTER_INTERVAL
+        printer = self.printer
+        try:
+            res = item.send(printer.conn, printer.server, printer.make_headers(item.timestamp))
+        except RequestException as e:
+            self._logger.warning(f"Registration poll of bridged printer '{self.name}' failed: {e}")
+            return
+        if res.status_code == 200:
+            self.pending_register = None
+            printer.code = None
+            printer.token = res.headers["Token"]
+            self._token_received(printer.token)
+        elif res.status_code != 202 or item.timeout <= time.time():
+            self.pending_register = None
+            self._logger.warning(f"Registration of bridged printer '{self.name}' failed ({res.status_code}): {res.text}")
+
+    def _emit(self, snapshot):
+        cadence = self.telemetry.cadence
+        if link_down():
+            cadence.record_failure()
+        else:
+            cadence.record_success()
+        send_snapshot(self.printer, snapshot)
+        if self._metrics is not None:
+            self._metrics.inc("prusaconnect_telemetry_emitted_total")
+
+    def _token_received(self, token):
+        self._logger.info(f"Bridged printer '{self.name}' registered with Prusa Connect.")
+        if self._on_token is not None:
+            self._on_token(self.sn, token)
+
+    ##~~ Command handlers
+
+    def _register_handlers(self):
+        printer = self.printer
+        printer.set_handler(const.Command.START_PRINT, self._start_print)
+        printer.set_handler(const.Command.STOP_PRINT, self._job_handler("cancel", const.State.READY))
+        printer.set_handler(const.Command.PAUSE_PRINT, self._job_handler("pause", const.State.PAUSED, action="pause"))
+        printer.set_handler(const.Command.RESUME_PRINT, self._job_handler("pause", const.State.PRINTING, action="resume"))
+        printer.set_handler(const.Command.SEND_INFO, self._send_info)
+
+    def _start_print(self, caller):
+        path = (caller.kwargs or {}).get("path") or (caller.args[0] if caller.args else None)
+        if not path or not isinstance(path, str):
+            raise CommandFailed("Missing filename")
+        self.client.start_print(path)
+        self.printer.set_state(const.State.PRINTING, const.Source.CONNECT)
+        return {"source": const.Source.CONNECT}
+
+    def _job_handler(self, command, state, action=None):
+        def handler(caller):
+            self.client.job_command(command, action=action)
+            self.printer.set_state(state, const.Source.CONNECT)
+            return {"source": const.Source.CONNECT}
+        return handler
+
+    def _send_info(self, caller):
+        # There are no file events from the remote instance, so every SEND_INFO reads the listing
+        self.files.invalidate()
+        files = self.files.tree()
+        files["free_space"] = self.client.free_space
+        files["total_space"] = self.client.total_space
+        info = self.printer.get_info()
+        info["files"] = files
+        return info
+
+
+class PrinterBridge(object):
+    """Bridges other OctoPrint instances to Prusa Connect from this OctoPrint process.
+
+    Every instance gets its own :class:`BridgedPrinter` with its own
+    identifiers and token, but they all share one loop thread, one HTTP
+    session, one command worker pool and a pool of at most
+    :attr:`POLL_WORKERS` poll threads, so a bridged printer costs no threads
+    of its own. Each instance is polled over its REST API at the telemetry
+    cadence (at most every ``poll_interval`` seconds) on the poll pool, so an
+    instance that is slow or down holds up no other. The loop sends what the
+    SDK printers queued and dispatches accepted commands.
+    """
+
+    # Queued items sent per printer and loop iteration, so one busy printer can't starve the others
+    MAX_SENDS = 5
+    # Instances polled at the same time at most
+    POLL_WORKERS = 4
+
+    def __init__(self, server, session=None, poll_interval=2.0, workers=2, timeout=30.0, on_token=None,
+                 logger=None, metrics=None):
+        self.server = server
+        self._session = session or Session()
+        self.poll_interval = float(poll_interval)
+        self.workers = max(int(workers), 1)
+        self.timeout = float(timeout)
+        self._on_token = on_token
+        self._logger = logger or logging.getLogger("octoprint.plugins.PrusaConnectBridge.bridge")
+        self._metrics = metrics
+
+        self._lock = threading.RLock()
+        self._printers = {} # sn -> BridgedPrinter
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pool = None
+        self._poll_pool = None
+
+    @property
+    def printers(self):
+        with self._lock:
+            return list(self._printers.values())
+
+    def get(self, sn):
+        return self._printers.get(sn)
+
+    def add(self, config):
+        """Adds a bridged printer from its settings dict (name, url, api_key, sn, fingerprint, token)."""
+        with self._lock:
+            self.remove(config["sn"])
+            bridged = BridgedPrinter(config, self.server, self._session, self._wakeup, workers=self.workers,
+                                     timeout=self.timeout, on_token=self._on_token, logger=self._logger,
+                                     metrics=self._metrics)
+            if self._pool is not None:
+                bridged.executor.start(pool=self._pool)
+            self._printers[bridged.sn] = bridged
+        self._wakeup.set()
+        self._logger.info(f"Bridging printer '{bridged.name}' ({bridged.client.url}) as SN {bridged.sn}.")
+        return bridged
+
+    def remove(self, sn):
+        with self._lock:
+            bridged = self._printers.pop(sn, None)
+            if bridged is None:
+                return False
+            bridged.executor.stop()
+        self._logger.info(f"Stopped bridging printer '{bridged.name}'.")
+        return True
+
+    ##~~ Lifecycle
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            # Shared by all bridged printers, each one limits itself to `workers` commands at a time
+            self._pool = ThreadPoolExecutor(max_workers=self.workers * 2, thread_name_prefix="PrusaConnectBridgeCommand")
+            self._poll_pool = ThreadPoolExecutor(max_workers=self.POLL_WORKERS,
+                                                 thread_name_prefix="PrusaConnectBridgePoll")
+            for bridged in self._printers.values():
+                bridged.executor.start(pool=self._pool)
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self._loop, args=(self._stopped,), daemon=True,
+                                            name="PrusaConnectBridgeLoop")
+            self._thread.start()
+        self._logger.info(f"Printer bridge started for {len(self._printers)} printer(s).")
+
+    def stop(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._stopped.set()
+            self._wakeup.set()
+            self._thread = None
+            for bridged in self._printers.values():
+                bridged.executor.stop()
+            self._pool.shutdown(wait=False)
+            self._pool = None
+            # Polls in flight end with their request timeout
+            self._poll_pool.shutdown(wait=False)
+            self._poll_pool = None
+        self._logger.info("Printer bridge stopped.")
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    ##~~ Loop
+
+    def _loop(self, stopped):
+        while not stopped.is_set():
+            # Cleared before the work, so anything queued meanwhile makes the wait below return at once
+            self._wakeup.clear()
+            now = time.monotonic()
+            next_run = now + self.poll_interval
+            for bridged in self.printers:
+                if stopped.is_set():
+                    break
+                try:
+                    next_run = min(next_run, self._step(bridged, now))
+                except Exception as e:
+                    self._logger.error(f"Error bridging printer '{bridged.name}': {e}", exc_info=True)
+            self._wakeup.wait(max(0.0, next_run - time.monotonic()))
+
+    def _step(self, bridged, now):
+        """Services one bridged printer. Returns when it next needs the loop."""
+        if now >= bridged.next_poll and bridged.polling is None:
+            bridged.polling = self._poll_pool.submit(self._poll, bridged, now)
+        bridged.poll_registration(now)
+
+        printer = bridged.printer
+        for _ in range(self.MAX_SENDS):
+            if printer.queue.empty():
+                break
+            # Doesn't block, the queue isn't empty. A telemetry response may accept a command.
+            printer.loop_step()
+        if not printer.queue.empty():
+            self._wakeup.set()
+
+        # A poll in flight wakes the loop when it is done
+        next_run = bridged.next_poll if bridged.polling is None else now + self.poll_interval
+        if bridged.executor.poll():
+            # Commands are running, check their timeouts
+            next_run = min(next_run, now + CommandExecutor.POLL_INTERVAL)
+        if bridged.pending_register is not None:
+            next_run = min(next_run, now + bridged.REGISTER_INTERVAL)
+        return next_run
+
+    def _poll(self, bridged, started):
+        # On the poll pool, the REST requests block for up to the client's timeout
+        try:
+            reachable = bridged.poll()
+        except Exception as e:
+            self._logger.error(f"Error polling bridged printer '{bridged.name}': {e}", exc_info=True)
+            reachable = False
+        if reachable:
+            bridged.next_poll = started + min(self.poll_interval, bridged.telemetry.heartbeat_interval)
+        else:
+            # An instance that is down is tried less often
+            bridged.next_poll = started + bridged.telemetry.heartbeat_interval
+        bridged.polling = None
+        self._wakeup.set()
@@ -0,0 +1,350 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import io
+import logging
+import os
+import threading
+import time
+
+from prusa.connect.printer import const, get_timestamp
+from prusa.connect.printer.util import make_fingerprint
+
+# Frames larger than this are rejected while reading, so a broken source can't fill the memory
+FRAME_LIMIT = 8 * 1024 * 1024
+JPEG_MAGIC = b"\xff\xd8"
+
+
+def _pillow():
+    """Pillow's Image module, or None. Pillow is optional, without it frames are uploaded as they come."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    return Image
+
+
+class _Slot(object):
+    """Holds at most one frame between two stages.
+
+    A frame put while the previous one is still waiting replaces it: the next
+    stage always gets the newest frame, the stale one is counted as skipped.
+    """
+
+    def __init__(self, stopped):
+        self._cond = threading.Condition()
+        self._stopped = stopped
+        self._frame = None
+
+    def put(self, frame):
+        """Returns whether a waiting frame was replaced."""
+        with self._cond:
+            replaced = self._frame is not None
+            self._frame = frame
+            self._cond.notify()
+            return replaced
+
+    def take(self):
+        """Waits for a frame, returns None once the pipeline is stopped."""
+        with self._cond:
+            while self._frame is None:
+                if self._stopped.is_set():
+                    return None
+                self._cond.wait()
+            frame, self._frame = self._frame, None
+            return frame
+
+    def wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+
+class SnapshotPipeline(object):
+    """Sends webcam snapshots to Prusa Connect: grab, encode and upload, each on its own thread.
+
+    The grabber reads a JPEG from ``source``, an http(s) URL (OctoPrint's
+    webcam snapshot URL) or a file on disk, every ``interval_printing``
+    seconds while ``printing()`` says so and every ``interval_idle`` seconds
+    otherwise (0 turns snapshots off for that state), and not at all while
+    the printer isn't registered. The encoder downscales frames wider than
+    ``max_width`` and re-encodes them at ``quality``, if Pillow is installed.
+    The uploader registers the camera with Prusa Connect once, on behalf of
+    the printer, and PUTs each frame to ``/c/snapshot``.
+
+    Between the stages sits a one-frame slot, so each stage holds at most one
+    frame and one in flight. When uploading falls behind, the frame waiting in
+    the slot is replaced by the newer one and counted as skipped, and the grab
+    interval stretches to the time the last upload took.
+
+    ``printer()`` returns the current SDK Printer, for the server, the headers
+    and whether it is registered. ``on_token(token)`` is called to persist the
+    camera token.
+    """
+
+    NAME = "OctoPrint webcam"
+    TIMEOUT = (const.CONNECTION_TIMEOUT, 30.0)
+
+    def __init__(self, source, printer, printing, session, camera_id, token=None, on_token=None,
+                 interval_printing=10.0, interval_idle=120.0, max_width=1280, quality=80, logger=None, metrics=None):
+        self.source = source
+        self._printer = printer
+        self._printing = printing
+        self._session = session
+        self.camera_id = camera_id
+        self.fingerprint = make_fingerprint(camera_id)
+        self.token = token
+        self._on_token = on_token
+        self._logger = logger or logging.getLogger("octoprint.plugins.PrusaConnectBridge.camera")
+        self._metrics = metrics
+
+        self._stopped = threading.Event()
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._encode_slot = None
+        self._upload_slot = None
+        self._source_session = None # Plain session for the webcam, which is local and not Prusa Connect
+        self._upload_seconds = 0.0 # Duration of the last upload, the grab interval doesn't go below it
+        self._pillow_checked = False
+        self._image = None
+        self.configure(interval_printing=interval_printing, interval_idle=interval_idle, max_width=max_width,
+                       quality=quality)
+
+    def configure(self, interval_printing=None, interval_idle=None, max_width=None, quality=None):
+        if interval_printing is not None:
+            self.interval_printing = max(float(interval_printing), 0.0)
+        if interval_idle is not None:
+            self.interval_idle = max(float(interval_idle), 0.0)
+        if max_width is not None:
+            self.max_width = max(int(max_width), 0)
+        if quality is not None:
+            self.quality = min(max(int(quality), 1), 95)
+        self.wake()
+
+    ##~~ Lifecycle
+
+    def start(self):
+        if self._threads:
+            return
+        # Every start gets its own stop event and slots, like the other workers
+        self._stopped = threading.Event()
+        self._encode_slot = _Slot(self._stopped)
+        self._upload_slot = _Slot(self._stopped)
+        for name, target, args in (("Grab", self._grab_loop, (self._stopped, self._encode_slot)),
+                                   ("Encode", self._encode_loop, (self._encode_slot, self._upload_slot)),
+                                   ("Upload", self._upload_loop, (self._upload_slot,))):
+            thread = threading.Thread(target=target, args=args, daemon=True, name=f"PrusaConnectCamera{name}")
+            thread.start()
+            self._threads.append(thread)
+        self._logger.info(f"Camera snapshots from {self.source} started.")
+
+    def stop(self, timeout=2.0):
+        if not self._threads:
+            return
+        self._stopped.set()
+        self._wakeup.set()
+        self._encode_slot.wake()
+        self._upload_slot.wake()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout)
+        self._threads = []
+        if self._source_session is not None:
+            self._source_session.close()
+            self._source_session = None
+        self._logger.info("Camera snapshots stopped.")
+
+    def is_alive(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def wake(self):
+        """Re-evaluates the interval now, after the printer state or the settings changed."""
+        self._wakeup.set()
+
+    def interval(self):
+        """Seconds until the next grab, 0 when snapshots are off for the current state."""
+        printer = self._printer()
+        if printer is None or not printer.token:
+            return 0.0 # Nowhere to send them yet, woken once the printer is registered
+        interval = self.interval_printing if self._printing() else self.interval_idle
+        if not interval:
+            return 0.0
+        return max(interval, self._upload_seconds)
+
+    ##~~ Stages
+
+    def _grab_loop(self, stopped, encode_slot):
+        last = None
+        while not stopped.is_set():
+            self._wakeup.clear()
+            interval = self.interval()
+            if not interval:
+                self._wakeup.wait()
+                continue
+            remaining = interval if last is None else last + interval - time.monotonic()
+            if last is not None and remaining > 0:
+                # Woken early on a state change, the interval of the new state applies from the last grab
+                self._wakeup.wait(remaining)
+                continue
+            last = time.monotonic()
+            frame = self._stage("grab", self.grab)
+            if frame is not None and encode_slot.put(frame):
+                self._count("grab", "skipped")
+
+    def _encode_loop(self, encode_slot, upload_slot):
+        while True:
+            frame = encode_slot.take()
+            if frame is None:
+                return
+            frame = self._stage("encode", self.encode, frame)
+            if frame is not None and upload_slot.put(frame):
+                self._count("encode", "skipped")
+
+    def _upload_loop(self, upload_slot):
+        while True:
+            frame = upload_slot.take()
+            if frame is None:
+                return
+            start = time.monotonic()
+            self._stage("upload", self.upload, frame)
+            self._upload_seconds = time.monotonic() - start
+
+    def _stage(self, stage, func, *args):
+        start = time.perf_counter()
+        try:
+            result = func(*args)
+        except Exception as e:
+            self._count(stage, "error")
+            self._logger.warning(f"Camera snapshot {stage} failed: {e}")
+            return None
+        finally:
+            if self._metrics is not None:
+                self._metrics.observe("prusaconnect_camera_stage_seconds", time.perf_counter() - start, stage=stage)
+        if result is not None:
+            self._count(stage, "ok")
+            if self._metrics is not None and stage != "upload":
+                self._metrics.inc("prusaconnect_camera_bytes_total", len(result), stage=stage)
+        return result
+
+    def _count(self, stage, result):
+        if self._metrics is not None:
+            self._metrics.inc("prusaconnect_camera_frames_total", stage=stage, result=result)
+
+    ##~~ Grab
+
+    def grab(self):
+        """Reads one frame from the source, at most :data:`FRAME_LIMIT` bytes."""
+        source = self.source
+        if source.startswith(("http://", "https://")):
+            return self._grab_http(source)
+        if source.startswith("file://"):
+            source = source[len("file://"):]
+        with open(os.path.expanduser(source), "rb") as f:
+            frame = f.read(FRAME_LIMIT + 1)
+        if len(frame) > FRAME_LIMIT:
+            raise ValueError(f"frame larger than {FRAME_LIMIT} bytes")
+        return frame
+
+    def _grab_http(self, url):
+        if self._source_session is None:
+            from requests import Session
+            self._source_session = Session()
+        with self._source_session.get(url, stream=True, timeout=self.TIMEOUT) as response:
+            response.raise_for_status()
+            frame = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                frame += chunk
+                if len(frame) > FRAME_LIMIT:
+                    raise ValueError(f"frame larger than {FRAME_LIMIT} bytes")
+        return bytes(frame)
+
+    ##~~ Encode
+
+    def encode(self, frame):
+        """Downscales the frame to ``max_width`` and re-encodes it as JPEG.
+
+        JPEGs that are narrow enough are passed on untouched. Without Pillow
+        JPEGs are always passed on, anything else is refused.
+        """
+        if not self._pillow_checked:
+            self._image = _pillow()
+            self._pillow_checked = True
+            if self._image is None:
+                self._logger.info("Pillow is not installed, camera snapshots are uploaded without downscaling.")
+        image_module = self._image
+        is_jpeg = frame.startswith(JPEG_MAGIC)
+        if image_module is None:
+            if not is_jpeg:
+                raise ValueError("not a JPEG, and Pillow is not installed to convert it")
+            return frame
+
+        with image_module.open(io.BytesIO(frame)) as image:
+            max_width = self.max_width or image.width
+            if is_jpeg and image.width <= max_width:
+                return frame
+            if image.width > max_width:
+                size = (max_width, max(round(image.height * max_width / image.width), 1))
+                # Lets the JPEG decoder scale down by a power of two while decoding, far cheaper than a full decode
+                image.draft("RGB", size)
+                image = image.convert("RGB").resize(size, image_module.BILINEAR)
+            else:
+                image = image.convert("RGB")
+            out = io.BytesIO()
+            image.save(out, "JPEG", quality=self.quality)
+        return out.getvalue()
+
+    ##~~ Upload
+
+    def upload(self, frame):
+        """Sends a frame to Prusa Connect, registering the camera first if needed.
+
+        Returns None (not uploaded) while the printer is not registered.
+        """
+        printer = self._printer()
+        if printer is None or not printer.token:
+            self._count("upload", "unregistered")
+            return None
+        if not self.token and not self._register(printer):
+            return None
+        headers = {
+            "Timestamp": str(get_timestamp()),
+            "Fingerprint": self.fingerprint,
+            "Token": self.token,
+            "Content-Type": "image/jpg",
+        }
+        response = self._session.put(printer.server + "/c/snapshot", headers=headers, data=frame,
+                                     timeout=self.TIMEOUT)
+        if response.status_code in (401, 403):
+            # Deleted in Prusa Connect, or a stale token. Registered again with the next frame.
+            self._logger.warning(f"Prusa Connect refused the camera token ({response.status_code}), registering again.")
+            self._set_token(None)
+        response.raise_for_status()
+        if self._metrics is not None:
+            self._metrics.inc("prusaconnect_camera_bytes_total", len(frame), stage="upload")
+        return frame
+
+    def _register(self, printer):
+        payload = dict(
+            config=dict(camera_id=self.camera_id, name=self.NAME,
+                        # Snapshots are scheduled by the bridge, not by the trigger schemes Connect offers
+                        trigger_scheme=const.TriggerScheme.MANUAL.name),
+            options=dict(available_resolutions=[]),
+            capabilities=[const.CapabilityType.TRIGGER_SCHEME.value, const.CapabilityType.IMAGING.value],
+            fingerprint=self.fingerprint,
+        )
+        response = self._session.post(printer.server + "/p/camera", headers=printer.make_headers(), json=payload,
+                                      timeout=self.TIMEOUT)
+        if response.status_code != 200 or "Token" not in response.headers:
+            self._logger.warning(f"Camera registration with Prusa Connect failed ({response.status_code}): {response.text}")
+            self._count("upload", "unregistered")
+            return False
+        self._logger.info("Camera registered with Prusa Connect.")
+        self._set_token(response.headers["Token"])
+        return True
+
+    def _set_token(self, token):
+        self.token = token
+        if self._on_token is not None:
+            try:
+                self._on_token(token)
+            except Exception as e:
+                self._logger.error(f"Could not save the camera token: {e}", exc_info=True)
@@ -0,0 +1,239 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import copy
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from prusa.connect.printer import const
+from prusa.connect.printer.command import CommandFailed
+
+
+class CommandExecutor(object):
+    """Runs Prusa Connect commands off the SDK loop thread.
+
+    The SDK loop only accepts commands (it sends ACCEPTED and flags
+    ``printer.command.new_cmd_evt``), running them is up to the application. A
+    dispatcher thread picks every accepted command up and hands it to a bounded
+    worker pool, so a slow handler never delays telemetry or event delivery.
+
+    Handlers get a snapshot of the command, so a command accepted while another
+    one is still running can't change its arguments. A handler returns the
+    kwargs for FINISHED (at least ``source``) or raises
+    :class:`~prusa.connect.printer.command.CommandFailed`. Commands that don't
+    finish within their timeout are reported FAILED, their worker stays busy
+    until the handler returns, and its late result is dropped.
+
+    Started with a shared ``pool`` there is no dispatcher thread, the owner of
+    the pool calls :meth:`poll` from its own loop instead. That is how the
+    bridged printers share one loop and one pool.
+    """
+
+    # How often the dispatcher looks for timeouts and new commands while commands are running
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, printer, workers=2, timeout=30.0, timeouts=None, logger=None, metrics=None):
+        self._printer = printer
+        self._logger = logger or logging.getLogger("octoprint.plugins.PrusaConnectBridge.commands")
+        self._metrics = metrics
+        self.workers = max(int(workers), 1)
+        self.timeout = float(timeout)
+        # Per-command timeout overrides, keyed by const.Command
+        self.timeouts = dict(timeouts or {})
+
+        self._lock = threading.RLock()
+        self._pool = None
+        self._owns_pool = True
+        self._dispatcher = None
+        self._stopped = threading.Event()
+        # Set when a command completes, so the dispatcher doesn't sit out its poll interval
+        self._wakeup = threading.Event()
+        # command_id -> (command name, future, deadline) of commands being handled by a worker
+        self._running = {}
+        # Command ids that were reported FAILED after their timeout but are still occupying a worker
+        self._timed_out = set()
+        self._last_dispatched = None
+
+    ##~~ Lifecycle
+
+    def start(self, pool=None):
+        """Starts the worker pool and the dispatcher, or with ``pool`` runs on that pool driven by :meth:`poll`."""
+        with self._lock:
+            if self._pool is not None:
+                return
+            # Like the telemetry heartbeat, every dispatcher gets its own stop event
+            self._stopped = threading.Event()
+            if pool is not None:
+                self._pool = pool
+                self._owns_pool = False
+                self._logger.debug(f"Command executor started on a shared pool ({self.workers} workers, {self.timeout}s timeout).")
+                return
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="PrusaConnectCommand")
+            self._owns_pool = True
+            self._dispatcher = threading.Thread(target=self._dispatch_loop, args=(self._stopped,),
+                                                daemon=True, name="PrusaConnectCommandDispatcher")
+            self._dispatcher.start()
+        self._logger.info(f"Command executor started ({self.workers} workers, {self.timeout}s timeout).")
+
+    def stop(self):
+        with self._lock:
+            if self._pool is None:
+                return
+            self._stopped.set()
+            self._wakeup.set()
+            self._dispatcher = None
+            if self._owns_pool:
+                # Don't wait for running handlers, they can't be interrupted anyway
+                self._pool.shutdown(wait=False)
+            self._pool = None
+            self._running.clear()
+            self._timed_out.clear()
+        self._logger.info("Command executor stopped.")
+
+    def is_alive(self):
+        if not self._owns_pool:
+            return self._pool is not None
+        return self._dispatcher is not None and self._dispatcher.is_alive()
+
+    def configure(self, workers=None, timeout=None):
+        """Applies new settings. A changed pool size takes effect on the next :meth:`start`."""
+        with self._lock:
+            if workers is not None:
+                self.workers = max(int(workers), 1)
+            if timeout is not None:
+                self.timeout = float(timeout)
+
+    @property
+    def busy_workers(self):
+        with self._lock:
+            return len(self._running) + len(self._timed_out)
+
+    ##~~ Dispatching
+
+    def poll(self):
+        """Runs one dispatcher iteration: reports timed out commands and dispatches a newly accepted one.
+
+        Returns True while commands are running, the caller should poll again
+        within :attr:`POLL_INTERVAL` then.
+        """
+        with self._lock:
+            if self._pool is None:
+                return False
+            command = self._printer.command
+            self._check_timeouts()
+            if command.state == const.Event.ACCEPTED and command.command_id != self._last_dispatched:
+                self._dispatch(command)
+            return bool(self._running or self._timed_out)
+
+    def _dispatch_loop(self, stopped):
+        command = self._printer.command
+        while not stopped.is_set():
+            if self._running or self._timed_out:
+                # new_cmd_evt stays set while a command runs, so poll (for timeouts and priority
+                # commands) until it completes instead of waiting on it
+                self._wakeup.wait(self.POLL_INTERVAL)
+                self._wakeup.clear()
+            else:
+                command.new_cmd_evt.wait(1.0)
+            if stopped.is_set():
+                break
+
+            try:
+                self.poll()
+            except Exception as e:
+                self._logger.error(f"Error in command dispatcher: {e}", exc_info=True)
+                time.sleep(self.POLL_INTERVAL)
+
+    def _dispatch(self, command):
+        with self._lock:
+            command_id = command.command_id
+            self._last_dispatched = command_id
+            try:
+                name = const.Command(command.command_name)
+                handler = command.handlers[name]
+            except ValueError:
+                self._logger.error(f"Unknown Prusa Connect command {command.command_name}.")
+                self._count(command.command_name, "rejected")
+                command.reject(const.Source.WUI, reason="Unknown command")
+                return
+            except KeyError:
+                self._logger.error(f"Prusa Connect command {command.command_name} not implemented.")
+                self._count(command.command_name, "rejected")
+                command.reject(const.Source.WUI, reason="Not Implemented")
+                return
+
+            if self.busy_workers >= self.workers:
+                self._logger.warning(f"Rejecting {name.value} ({command_id}), all {self.workers} command workers are busy.")
+                self._count(name.value, "rejected")
+                command.reject(const.Source.WUI, reason="Too many commands running")
+                return
+
+            timeout = self.timeouts.get(name, self.timeout)
+            future = self._pool.submit(self._run, handler, copy.copy(command), command_id)
+            self._running[command_id] = (name, future, time.monotonic() + timeout)
+            self._count(name.value, "accepted")
+            self._logger.debug(f"Dispatched {name.value} ({command_id}) with a {timeout}s timeout.")
+
+    def _run(self, handler, caller, command_id):
+        start = time.monotonic()
+        try:
+            kwargs = handler(caller)
+        except CommandFailed as e:
+            self._complete(command_id, failed=str(e))
+        except Exception as e:
+            self._logger.error(f"Error handling Prusa Connect command {caller.command_name} ({command_id}): {e}",
+                               exc_info=True)
+            self._complete(command_id, failed="Command error", error=repr(e))
+        else:
+            self._complete(command_id, **(kwargs or {"source": const.Source.CONNECT}))
+        finally:
+            elapsed = time.monotonic() - start
+            if self._metrics is not None:
+                self._metrics.observe("prusaconnect_command_seconds", elapsed, command=caller.command_name)
+            self._logger.debug(f"Handled {caller.command_name} ({command_id}) in {elapsed:.3f}s.")
+
+    def _check_timeouts(self):
+        now = time.monotonic()
+        with self._lock:
+            for command_id, (name, future, deadline) in list(self._running.items()):
+                if now < deadline or future.done():
+                    continue
+                self._logger.warning(f"Prusa Connect command {name.value} ({command_id}) timed out, reporting it as failed.")
+                self._complete(command_id, failed="Command timed out", result="timeout")
+                self._timed_out.add(command_id)
+                future.add_done_callback(lambda _, command_id=command_id: self._release(command_id))
+
+    def _release(self, command_id):
+        with self._lock:
+            self._timed_out.discard(command_id)
+
+    def _complete(self, command_id, failed=None, result=None, **kwargs):
+        """Reports the result of a command, unless it was already reported (e.g. after a timeout)."""
+        with self._lock:
+            running = self._running.pop(command_id, None)
+            if running is None:
+                self._logger.info(f"Dropping late result of Prusa Connect command {command_id}.")
+                return
+            self._count(running[0].value, result or ("failed" if failed else "finished"))
+            self._wakeup.set()
+            command = self._printer.command
+            # Only tear the shared command state down if it still belongs to this command, a
+            # priority command may have been accepted in the meantime
+            if command.command_id == command_id and command.state is not None:
+                if failed:
+                    command.failed(const.Source.WUI, reason=failed, command_id=command_id, **kwargs)
+                else:
+                    command.finish(command_id=command_id, **kwargs)
+            elif failed:
+                self._printer.event_cb(const.Event.FAILED, const.Source.WUI, command_id=command_id,
+                                       reason=failed, **kwargs)
+            else:
+                source = kwargs.pop("source", const.Source.CONNECT)
+                event = kwargs.pop("event", const.Event.FINISHED)
+                self._printer.event_cb(event, source, command_id=command_id, **kwargs)
+
+    def _count(self, command_name, result):
+        if self._metrics is not None:
+            self._metrics.inc("prusaconnect_commands_total", command=command_name, result=result)
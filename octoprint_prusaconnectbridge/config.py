@@ -0,0 +1,115 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import copy
+from collections import namedtuple
+
+# Plugin settings and their defaults. The type of the default is the type of the setting.
+DEFAULTS = dict(
+    prusa_connect_sn=None,
+    prusa_connect_fingerprint=None,
+    prusa_connect_token=None,
+    prusa_connect_tmp_code=None,
+    prusa_server_url="https://connect.prusa3d.com",
+    prusa_connect_manual_sn=None,
+    # Telemetry is sent on meaningful changes, or at least once per heartbeat interval
+    telemetry_heartbeat_interval=10.0, # Seconds, heartbeat while idle
+    telemetry_temp_deadband=0.5, # Degrees C
+    telemetry_progress_deadband=1.0, # Percent
+    # Heartbeat cadence for the other printer states
+    telemetry_cadence_heating=1.0, # Seconds, while heating up to a target temperature
+    telemetry_cadence_printing=5.0, # Seconds
+    telemetry_cadence_offline=60.0, # Seconds, while disconnected or in error
+    telemetry_layer_burst=10.0, # Seconds of heating cadence after a layer change
+    telemetry_backoff_max=300.0, # Upper bound for the exponential backoff on send failures
+    # While Prusa Connect is unreachable telemetry is buffered, and replayed once it is back
+    telemetry_buffer_size=1800, # Samples, the oldest are dropped when full
+    telemetry_buffer_interval=2.0, # Seconds between buffered samples
+    telemetry_replay_rate=10.0, # Samples per second sent when replaying
+    telemetry_replay_jitter=5.0, # Upper bound of the random delay before replaying
+    # Prusa Connect commands run on a small worker pool, off the SDK loop thread
+    command_workers=2,
+    command_timeout=30.0, # Seconds before a running command is reported as failed
+    # Other OctoPrint instances bridged to Prusa Connect from this one, as dicts with
+    # name, url, api_key, sn, fingerprint and token. Managed through the API commands.
+    bridged_printers=[],
+    bridge_poll_interval=2.0, # Seconds, upper bound between REST polls of a bridged instance
+    http_pool_size=4, # Keep-alive connections kept per host for Prusa Connect traffic
+    # Telemetry, commands and camera uploads on one asyncio event loop instead of a thread each.
+    # Read when the SDK is set up, so it takes effect after a restart of OctoPrint.
+    sdk_async_core=False,
+    # Files sent by Prusa Connect are streamed to disk in chunks and resumed after interruptions
+    download_chunk_size=65536, # Bytes
+    download_retries=5, # Resume attempts before a download is aborted
+    # OctoPrint events for Prusa Connect are queued, and events for the same thing within the window merged
+    event_coalesce_window=0.5, # Seconds
+    event_queue_size=64, # Distinct events waiting at most, the oldest is dropped when full
+    # File changes reach Prusa Connect one by one, past this many at once it gets the whole tree instead
+    file_sync_max_changes=100,
+    # Time remaining from a per-file index of print time by file position, built once per G-code in the background
+    time_index_enabled=True,
+    # Free space of the upload folder is sampled in the background and after file changes
+    storage_sample_interval=60.0, # Seconds
+    storage_low_space_percent=10.0, # Prusa Connect is updated when free space crosses this
+    storage_change_percent=5.0, # ...or moved by this much of the total since the last update
+    # Webcam snapshots for Prusa Connect, from OctoPrint's webcam unless a snapshot URL or file is set
+    camera_enabled=True,
+    camera_snapshot_url="",
+    camera_interval_printing=10.0, # Seconds, 0 turns snapshots off while printing
+    camera_interval_idle=120.0, # Seconds, 0 turns snapshots off while not printing
+    camera_max_width=1280, # Pixels, wider frames are downscaled if Pillow is installed
+    camera_jpeg_quality=80,
+    camera_token=None # Issued by Prusa Connect when the camera is registered
+)
+
+
+class Config(namedtuple("Config", DEFAULTS.keys())):
+    """Immutable snapshot of the plugin settings, one attribute per key of :data:`DEFAULTS`.
+
+    Reading an attribute is a plain tuple lookup, where ``settings.get`` walks
+    OctoPrint's layered config on every call. The plugin loads a snapshot when
+    the settings are initialized and again after the user saved them, its own
+    writes go through :meth:`write`.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def load(cls, settings):
+        values = {}
+        for key, default in DEFAULTS.items():
+            if isinstance(default, bool):
+                values[key] = settings.get_boolean([key])
+            elif isinstance(default, int):
+                values[key] = settings.get_int([key])
+            elif isinstance(default, float):
+                values[key] = settings.get_float([key])
+            elif isinstance(default, list):
+                # Copies, so nothing holding the snapshot can change OctoPrint's config behind its back
+                values[key] = tuple(copy.deepcopy(settings.get([key]) or []))
+            else:
+                values[key] = settings.get([key])
+        return cls(**values)
+
+    def write(self, settings, values, trigger_event=False):
+        """Sets the ``values`` that differ from this snapshot and saves once, returns the updated snapshot.
+
+        Nothing is written (and config.yaml not rewritten) if every value is unchanged.
+        """
+        changed = {}
+        for key, value in values.items():
+            if isinstance(value, list):
+                value = tuple(value)
+            if getattr(self, key) != value:
+                changed[key] = value
+        if not changed:
+            return self
+        for key, value in changed.items():
+            settings.set([key], list(value) if isinstance(value, tuple) else value)
+        settings.save(trigger_event=trigger_event)
+        return self._replace(**changed)
+
+
+def settings_defaults():
+    """Fresh copy of :data:`DEFAULTS` for ``get_settings_defaults``, so the mutable defaults aren't shared."""
+    return copy.deepcopy(DEFAULTS)
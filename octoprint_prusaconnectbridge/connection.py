@@ -0,0 +1,89 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.ssl_ import create_urllib3_context
+
+
+class _SharedContextAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools all use one SSL context.
+
+    Without a context urllib3 creates one per new connection and loads the
+    system CA store into it, which is most of the cost of a connection after
+    the handshake itself.
+    """
+
+    def __init__(self, ssl_context, **kwargs):
+        self._ssl_context = ssl_context
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self._ssl_context
+        return HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+
+
+class ConnectSession(object):
+    """Pooled keep-alive HTTP session for all of the bridge's Prusa Connect traffic.
+
+    Owned by the plugin and attached to every SDK ``Printer`` it creates (see
+    :func:`attach_session`), so connections and their TLS sessions outlive
+    ``Printer`` re-creation and are shared with the bridged printers. Requests
+    reuse an idle keep-alive connection to the host if there is one, only
+    ``pool_size`` connections per host are kept.
+    """
+
+    def __init__(self, pool_size=4, logger=None):
+        self._logger = logger or logging.getLogger("octoprint.plugins.PrusaConnectBridge.connection")
+        self._ssl_context = create_urllib3_context()
+        self._ssl_context.load_default_certs()
+        self.session = Session()
+        self.pool_size = None
+        self.resize(pool_size)
+
+    @property
+    def ssl_context(self):
+        """The SSL context of all connections, with the system CA store loaded once."""
+        return self._ssl_context
+
+    def resize(self, pool_size):
+        """Applies a new pool size. Connections of the old pools are closed once they are idle."""
+        pool_size = max(int(pool_size), 1)
+        if pool_size == self.pool_size:
+            return
+        old_adapter = self.session.adapters.get("https://")
+        adapter = _SharedContextAdapter(self._ssl_context, pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        if old_adapter is not None:
+            old_adapter.close()
+        self.pool_size = pool_size
+        self._logger.info(f"HTTP connection pool size set to {pool_size}.")
+
+    def close(self):
+        self.session.close()
+
+    ##~~ Statistics
+
+    def _pools(self):
+        adapter = self.session.adapters.get("https://")
+        if adapter is None:
+            return []
+        manager = adapter.poolmanager
+        return [manager.pools[key] for key in manager.pools.keys()]
+
+    def connections_opened(self):
+        """Connections opened by the current pools. Compare to :meth:`requests_sent` for the reuse rate."""
+        return sum(pool.num_connections for pool in self._pools())
+
+    def requests_sent(self):
+        return sum(pool.num_requests for pool in self._pools())
+
+
+def attach_session(printer, session):
+    """Makes the SDK ``printer`` send through ``session`` instead of the Session it created itself."""
+    if printer.conn is not session:
+        printer.conn.close()
+    printer.conn = printer.camera_controller.session = session
@@ -0,0 +1,384 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+
+from prusa.connect.printer import const
+from prusa.connect.printer.command import CommandFailed
+from prusa.connect.printer.download import TransferRunningError
+from requests import RequestException
+
+# "bytes 1000-1999/5000", the total may be "*"
+_CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+# Digests a server may announce for the body (RFC 3230 Digest, RFC 9530 Repr-Digest)
+_DIGEST_HEADERS = ("Repr-Digest", "Digest")
+
+
+class DownloadAborted(Exception):
+    """The download can't complete, reported to Prusa Connect as TRANSFER_ABORTED."""
+
+
+class _Retry(Exception):
+    """The response ended early or can't be used, request again from the current offset."""
+
+
+class _PartFile(object):
+    """A download in progress, next to its destination as ``.<name>.part``.
+
+    What is needed to resume it (URL, size and the server's validators) is
+    kept in ``.<name>.part.json``. Both are hidden files, OctoPrint doesn't
+    list them. The SHA-256 of the received bytes is updated as they are
+    written, on resume it is computed once over what is already on disk.
+    """
+
+    def __init__(self, folder, name, url, chunk_size):
+        self.path = os.path.join(folder, f".{name}.part")
+        self.meta_path = self.path + ".json"
+        self.url = url
+        self.chunk_size = chunk_size
+        self.meta = {}
+        self.offset = 0
+        self.digest = hashlib.sha256()
+
+    def load(self):
+        """Picks up a part of an earlier download of the same URL. Returns the offset to resume from."""
+        try:
+            with open(self.meta_path, "r") as f:
+                meta = json.load(f)
+            offset = os.path.getsize(self.path)
+        except (OSError, ValueError):
+            self.reset()
+            return 0
+        if meta.get("url") != self.url or (meta.get("size") is not None and offset > meta["size"]):
+            self.reset()
+            return 0
+        digest = hashlib.sha256()
+        with open(self.path, "rb") as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                digest.update(chunk)
+        self.meta, self.offset, self.digest = meta, offset, digest
+        return offset
+
+    @property
+    def validator(self):
+        """Value for If-Range, so a changed file is sent whole instead of resumed."""
+        return self.meta.get("etag") or self.meta.get("last_modified")
+
+    def begin(self, response, size):
+        """Records the response the part is (now) based on."""
+        self.meta = dict(
+            url=self.url,
+            size=size,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified")
+        )
+        with open(self.meta_path, "w") as f:
+            json.dump(self.meta, f)
+
+    def reset(self):
+        self.meta = {}
+        self.offset = 0
+        self.digest = hashlib.sha256()
+        with open(self.path, "wb"):
+            pass
+
+    def discard(self):
+        for path in (self.path, self.meta_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class DownloadManager(object):
+    """Downloads the files Prusa Connect sends to the printer into OctoPrint's storage.
+
+    Serves START_CONNECT_DOWNLOAD and START_URL_DOWNLOAD. The transfer is kept
+    in the SDK ``printer.transfer``, so the SDK's STOP_TRANSFER and
+    SEND_TRANSFER_INFO handlers work with it. The command finishes right away;
+    the download runs on its own thread, one at a time.
+
+    The body is streamed to a hidden part file in ``chunk_size`` pieces, so
+    memory use doesn't depend on the file size. When the connection drops, the
+    download is requested again with a ``Range`` header from where it
+    stopped, up to ``retries`` times. ``If-Range`` makes sure a changed file
+    starts over. A part left behind by a stopped OctoPrint is resumed the same
+    way when Connect sends the download again. The SHA-256 is computed while
+    writing and compared with the digest the server announces, if it
+    announces one. The finished file is moved into the storage with
+    ``file_manager.add_file``, so OctoPrint analyses it and its file events
+    update the SEND_INFO index. ``on_finished(path, transfer)`` is called
+    afterwards, with the SDK transfer telling whether to select or print it.
+
+    With a ``storage_monitor`` a download is refused before it starts if
+    Connect announced a size that doesn't fit the last sampled free space,
+    and checked against a fresh sample once the response tells the size.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+    VALID_MIME_TYPES = ("text/plain", "text/x.gcode", "application/binary", "application/octet-stream")
+    # Seconds to connect and between received chunks
+    TIMEOUT = (const.CONNECTION_TIMEOUT, 30.0)
+    BACKOFF_MAX = 30.0
+
+    def __init__(self, printer, file_manager, session=None, storage="local", chunk_size=CHUNK_SIZE, retries=5,
+                 printed_path=None, on_finished=None, storage_monitor=None, logger=None, metrics=None):
+        self._printer = printer
+        self._file_manager = file_manager
+        # Downloads from Connect ride the plugin's pooled session, like all other Connect traffic
+        self._session = session if session is not None else printer.conn
+        self._storage = storage
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self._printed_path = printed_path or (lambda: None)
+        self._on_finished = on_finished
+        self._storage_monitor = storage_monitor
+        self._logger = logger or logging.getLogger("octoprint.plugins.PrusaConnectBridge.downloads")
+        self._metrics = metrics
+
+        self._thread = None
+        # Set on shutdown: the download stops but its part is kept for resuming
+        self._stopped = threading.Event()
+
+    @property
+    def transfer(self):
+        return self._printer.transfer
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    ##~~ Command handlers
+
+    def start_connect_download(self, caller):
+        kwargs = caller.kwargs or {}
+        try:
+            url = self._printer.server + "/p/teams/{team_id}/files/{hash}/raw".format(**kwargs)
+        except KeyError as e:
+            raise CommandFailed(f"{const.Command.START_CONNECT_DOWNLOAD.value} requires kwarg {e}")
+        return self._start(caller, const.TransferType.FROM_CONNECT, url,
+                           hash_=kwargs["hash"], team_id=kwargs["team_id"])
+
+    def start_url_download(self, caller):
+        url = (caller.kwargs or {}).get("url")
+        if not url:
+            raise CommandFailed(f"{const.Command.START_URL_DOWNLOAD.value} requires kwarg 'url'")
+        return self._start(caller, const.TransferType.FROM_WEB, url)
+
+    def _start(self, caller, type_, url, **kwargs):
+        path = (caller.kwargs or {}).get("path")
+        if not path:
+            raise CommandFailed("Missing path")
+        size = caller.kwargs.get("size")
+        if size is not None and self._storage_monitor is not None and not self._storage_monitor.fits(size):
+            # Refused before anything is requested or written, from the cached free space
+            if self._metrics is not None:
+                self._metrics.inc("prusaconnect_downloads_total", result="no_space")
+            raise CommandFailed(f"Not enough free space: {size} bytes needed, "
+                                f"{self._storage_monitor.free_space} free")
+        try:
+            folder, name, storage_path = self._destination(path)
+        except ValueError as e:
+            raise CommandFailed(f"Invalid path '{path}': {e}")
+
+        try:
+            info = self.transfer.start(type_, path, url,
+                                       to_print=caller.kwargs.get("printing", False),
+                                       to_select=caller.kwargs.get("selecting", False),
+                                       start_cmd_id=caller.command_id, **kwargs)
+        except TransferRunningError:
+            raise CommandFailed("Another transfer in progress")
+        except Exception as e:
+            raise CommandFailed(str(e))
+
+        self._thread = threading.Thread(target=self._run, args=(url, folder, name, storage_path), daemon=True,
+                                        name="PrusaConnectDownload")
+        self._thread.start()
+        info["source"] = const.Source.CONNECT
+        return info
+
+    def _destination(self, path):
+        """Folder on disk, sanitized file name and path in the storage for a Connect path."""
+        storage_folder, name = self._file_manager.split_path(self._storage, path.lstrip("/"))
+        name = self._file_manager.sanitize_name(self._storage, name)
+        if not name:
+            raise ValueError("no file name")
+        # Raises ValueError for anything outside of the storage
+        folder = self._file_manager.sanitize_path(self._storage, storage_folder)
+        return folder, name, self._file_manager.join_path(self._storage, storage_folder, name)
+
+    def stop(self, timeout=5.0):
+        """Stops a running download, keeping its part for resuming. Returns False if it didn't exit in time."""
+        self._stopped.set()
+        if self.is_alive():
+            self._thread.join(timeout)
+        return not self.is_alive()
+
+    ##~~ Download
+
+    def _run(self, url, folder, name, storage_path):
+        transfer = self.transfer
+        ids = dict(path=transfer.path, transfer_id=transfer.transfer_id, start_cmd_id=transfer.start_cmd_id)
+        result = "aborted"
+        part = None
+        transfer.start_ts = time.time()
+        try:
+            if not os.path.isdir(folder):
+                self._file_manager.add_folder(self._storage, os.path.dirname(storage_path), ignore_existing=True)
+            part = _PartFile(folder, name, url, self.chunk_size)
+            self._download(part, url)
+            if self._stopped.is_set():
+                result = "interrupted"
+                return
+            if transfer.stop_ts:
+                result = "stopped"
+                part.discard()
+                self._printer.event_cb(const.Event.TRANSFER_STOPPED, const.Source.CONNECT, **ids)
+                return
+
+            if self._printed_path() == os.path.join(folder, name):
+                raise DownloadAborted("Gcode being printed would be overwritten by downloaded file")
+
+            from octoprint.filemanager.util import DiskFileWrapper
+
+            # Moves the part into place, OctoPrint then analyses it and fires FILE_ADDED
+            self._file_manager.add_file(self._storage, storage_path, DiskFileWrapper(name, part.path),
+                                        allow_overwrite=True)
+            part.discard()
+            result = "finished"
+            self._logger.info(f"Downloaded {storage_path} ({part.offset} bytes, sha256 {part.digest.hexdigest()}).")
+            self._printer.event_cb(const.Event.TRANSFER_FINISHED, const.Source.CONNECT, **ids)
+            if self._on_finished is not None:
+                self._on_finished(storage_path, transfer)
+        except Exception as e:
+            if not isinstance(e, DownloadAborted):
+                self._logger.error(f"Download of {storage_path} failed: {e}", exc_info=True)
+            else:
+                self._logger.warning(f"Download of {storage_path} aborted: {e}")
+            if part is not None and isinstance(e, DownloadAborted):
+                part.discard()
+            self._printer.event_cb(const.Event.TRANSFER_ABORTED, const.Source.CONNECT, reason=str(e), **ids)
+        finally:
+            transfer.type = const.TransferType.NO_TRANSFER
+            if self._metrics is not None:
+                self._metrics.inc("prusaconnect_downloads_total", result=result)
+
+    def _download(self, part, url):
+        transfer = self.transfer
+        # The token only goes to Connect itself
+        server = self._printer.server
+        headers = self._printer.make_headers() if server and url.lower().startswith(server.lower()) else {}
+
+        if part.load():
+            self._logger.info(f"Resuming download of {transfer.path} at {part.offset} bytes.")
+            if self._metrics is not None:
+                self._metrics.inc("prusaconnect_download_resumes_total")
+        attempt = 0
+        while True:
+            request_headers = dict(headers)
+            if part.offset:
+                request_headers["Range"] = f"bytes={part.offset}-"
+                if part.validator:
+                    request_headers["If-Range"] = part.validator
+            try:
+                with self._session.get(url, headers=request_headers, stream=True, timeout=self.TIMEOUT) as response:
+                    self._receive(part, response)
+                return
+            except (RequestException, _Retry) as e:
+                if self._stopped.is_set() or transfer.stop_ts:
+                    return
+                attempt += 1
+                if attempt > self.retries:
+                    raise DownloadAborted(f"Giving up after {self.retries} retries: {e}")
+                delay = min(2.0 ** attempt, self.BACKOFF_MAX)
+                self._logger.warning(f"Download of {transfer.path} interrupted at {part.offset} bytes ({e}), "
+                                     f"resuming in {delay:.0f}s.")
+                if self._metrics is not None:
+                    self._metrics.inc("prusaconnect_download_resumes_total")
+                if self._stopped.wait(delay):
+                    return
+
+    def _receive(self, part, response):
+        transfer = self.transfer
+        status = response.status_code
+        if status == 206:
+            match = _CONTENT_RANGE.match(response.headers.get("Content-Range", ""))
+            if match is None or int(match.group(1)) != part.offset:
+                # Can't be appended, start over
+                part.reset()
+                raise _Retry(f"unexpected Content-Range {response.headers.get('Content-Range')!r}")
+            size = int(match.group(3)) if match.group(3) != "*" else None
+        elif status == 200:
+            if part.offset:
+                self._logger.info(f"Server sent {transfer.path} whole instead of resuming, starting over.")
+                part.reset()
+            length = response.headers.get("Content-Length")
+            size = int(length) if length is not None else None
+        elif status == 416:
+            part.reset()
+            raise _Retry("range not satisfiable")
+        elif status >= 500:
+            raise _Retry(f"status code {status}")
+        else:
+            raise DownloadAborted(f"Invalid status code: {status}")
+
+        mime_type = (response.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+        if mime_type and mime_type not in self.VALID_MIME_TYPES:
+            raise DownloadAborted(f"Invalid content type: {mime_type}")
+        if size is not None:
+            if self._storage_monitor is not None:
+                # Fresh, the download is about to take up the space, and the cached figure is updated with it
+                free = self._storage_monitor.sample()[0]
+            else:
+                free = shutil.disk_usage(os.path.dirname(part.path)).free
+            if size - part.offset > free:
+                raise DownloadAborted(f"Not enough free space: {size - part.offset} bytes needed, {free} free")
+
+        part.begin(response, size)
+        transfer.size = size
+        transfer.transferred = part.offset
+        self._printer.event_cb(const.Event.TRANSFER_INFO, const.Source.WUI, **transfer.to_dict())
+
+        with open(part.path, "ab") as f:
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                if transfer.stop_ts or self._stopped.is_set():
+                    return
+                f.write(chunk)
+                part.digest.update(chunk)
+                part.offset += len(chunk)
+                transfer.transferred = part.offset
+                if self._metrics is not None:
+                    self._metrics.inc("prusaconnect_download_bytes_total", len(chunk))
+
+        if size is not None and part.offset != size:
+            raise _Retry(f"connection closed at {part.offset} of {size} bytes")
+        if not part.offset:
+            raise DownloadAborted("Empty response")
+        expected = _announced_sha256(response)
+        if expected is not None and expected != part.digest.digest():
+            part.reset()
+            raise DownloadAborted("Checksum mismatch")
+
+
+def _announced_sha256(response):
+    """The SHA-256 the server announced for the body, None if there is none."""
+    for header in _DIGEST_HEADERS:
+        value = response.headers.get(header)
+        if not value:
+            continue
+        for item in value.split(","):
+            algorithm, _, encoded = item.strip().partition("=")
+            if algorithm.lower() == "sha-256":
+                try:
+                    return base64.b64decode(encoded.strip(":"))
+                except ValueError:
+                    return None
+    return None
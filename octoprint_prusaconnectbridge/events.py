@@ -0,0 +1,140 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import collections
+import logging
+import threading
+import time
+
+
+class EventQueue(object):
+    """Bounded, coalescing queue between OctoPrint's event bus and Prusa Connect.
+
+    :meth:`put` only files the event under its key and returns, so the plugin
+    never holds up OctoPrint's event dispatch. A worker thread hands each key
+    to ``handler(key, event, payload)`` once it has been quiet for ``window``
+    seconds: events for a key already waiting replace the queued one (the
+    latest wins) and push its deadline out, up to ``max_delay`` seconds after
+    the first of them. A storm of state flaps thus ends up as one call with
+    the state it settled on.
+
+    At most ``maxlen`` keys wait at a time, when full the oldest is dropped.
+    """
+
+    WINDOW = 0.5
+    MAX_DELAY = 5.0
+    MAXLEN = 64
+
+    def __init__(self, handler, window=WINDOW, max_delay=MAX_DELAY, maxlen=MAXLEN, logger=None, metrics=None):
+        self._handler = handler
+        self._logger = logger or logging.getLogger("octoprint.plugins.PrusaConnectBridge.events")
+        self._metrics = metrics
+        self.window = float(window)
+        self.max_delay = float(max_delay)
+        self.maxlen = max(int(maxlen), 1)
+
+        self._cond = threading.Condition()
+        # key -> [event, payload, due, deadline], in the order the keys were first queued
+        self._pending = collections.OrderedDict()
+        self._worker = None
+        self._stopped = threading.Event()
+        # Events put, merged into a queued one, dropped because the queue was full, and handled
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.handled = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def configure(self, window=None, maxlen=None):
+        with self._cond:
+            if window is not None:
+                self.window = float(window)
+            if maxlen is not None:
+                self.maxlen = max(int(maxlen), 1)
+            self._cond.notify()
+
+    ##~~ Lifecycle
+
+    def start(self):
+        with self._cond:
+            if self._worker is not None:
+                return
+            # Like the telemetry heartbeat, every worker gets its own stop event
+            self._stopped = threading.Event()
+            self._worker = threading.Thread(target=self._run, args=(self._stopped,),
+                                            daemon=True, name="PrusaConnectEvents")
+            self._worker.start()
+        self._logger.debug(f"Event queue started ({self.window}s window, {self.maxlen} keys).")
+
+    def stop(self):
+        """Stops the worker, events still waiting are dropped."""
+        with self._cond:
+            if self._worker is None:
+                return
+            self._stopped.set()
+            self._pending.clear()
+            self._worker = None
+            self._cond.notify()
+        self._logger.debug("Event queue stopped.")
+
+    ##~~ Producer
+
+    def put(self, key, event, payload=None):
+        """Queues ``event`` under ``key``, replacing an event for the same key that is still waiting."""
+        now = time.monotonic()
+        with self._cond:
+            self.received += 1
+            entry = self._pending.get(key)
+            if entry is not None:
+                entry[0] = event
+                entry[1] = payload
+                entry[2] = min(now + self.window, entry[3])
+                self.coalesced += 1
+                self._count("coalesced")
+                return
+            if len(self._pending) >= self.maxlen:
+                dropped, _ = self._pending.popitem(last=False)
+                self.dropped += 1
+                self._count("dropped")
+                self._logger.warning(f"Event queue full, dropped the pending '{dropped}' event.")
+            self._pending[key] = [event, payload, now + self.window, now + self.max_delay]
+            self._cond.notify()
+
+    def _count(self, result):
+        if self._metrics is not None:
+            self._metrics.inc("prusaconnect_event_queue_total", result=result)
+
+    ##~~ Worker
+
+    def _next_due(self, now):
+        """Pops the first key that is due, or returns the seconds until one is (None if nothing waits)."""
+        wait = None
+        for key, entry in self._pending.items():
+            remaining = entry[2] - now
+            if remaining <= 0:
+                del self._pending[key]
+                return key, entry
+            if wait is None or remaining < wait:
+                wait = remaining
+        return None, wait
+
+    def _run(self, stopped):
+        while True:
+            with self._cond:
+                while True:
+                    if stopped.is_set():
+                        return
+                    key, entry = self._next_due(time.monotonic())
+                    if key is not None:
+                        break
+                    self._cond.wait(entry)
+
+            event, payload = entry[0], entry[1]
+            try:
+                self._handler(key, event, payload)
+            except Exception as e:
+                self._logger.error(f"Error handling OctoPrint event '{event}' for Prusa Connect: {e}", exc_info=True)
+            self.handled += 1
+            self._count("handled")
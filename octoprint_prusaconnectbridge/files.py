@@ -0,0 +1,432 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import os
+import sys
+import threading
+import time
+
+from octoprint.events import Events
+
+
+class FileNode(object):
+    """Compact node of the :class:`FileIndex`.
+
+    Folders have a ``children`` dict keyed by (interned) name, files have
+    ``children`` set to None. Paths are not stored, they are derived while
+    walking the tree.
+    """
+
+    __slots__ = ("name", "size", "m_timestamp", "print_time", "children")
+
+    def __init__(self, name, is_dir=False, size=0, m_timestamp=0, print_time=None):
+        self.name = sys.intern(name)
+        self.size = size
+        self.m_timestamp = int(m_timestamp)
+        self.print_time = int(print_time) if print_time else None
+        self.children = {} if is_dir else None
+
+    @property
+    def is_dir(self):
+        return self.children is not None
+
+
+class AmbiguousFile(Exception):
+    """More than one file matches a name, ``candidates`` are their paths."""
+
+    def __init__(self, name, candidates):
+        Exception.__init__(self, f"'{name}' matches {len(candidates)} files: {', '.join(sorted(candidates))}")
+        self.candidates = candidates
+
+
+class FileIndex(object):
+    """Persistent in-memory index of OctoPrint's machinecode files.
+
+    Built once from ``file_manager.list_files`` and then kept current from
+    OctoPrint's file events, so SEND_INFO doesn't have to walk the whole upload
+    folder on every request. Nodes are kept compact (see :class:`FileNode`) and
+    the SEND_INFO payload is streamed out of them by a generator walker. The
+    serialized payload is cached for small libraries only, for large ones it
+    would double the memory held by the index.
+
+    :meth:`resolve` finds the file to print in constant time, by its path, by
+    the Prusa Connect hash it was downloaded under (see :meth:`remember_hash`)
+    or by its name alone, through a name to paths map kept alongside the tree.
+
+    With a :class:`~octoprint_prusaconnectbridge.metadata.MetadataCache` as
+    ``metadata``, files carry the slicer's print time estimate instead of
+    OctoPrint's analysis where the cache knows it. Files it doesn't know yet
+    are parsed in the background and applied through :meth:`apply_metadata`.
+
+    The paths of files and folders that changed are collected until
+    :meth:`take_changes`, for :class:`~.filesync.FileSync` to send Prusa
+    Connect only those. :attr:`version` counts the changes.
+    """
+
+    # OctoPrint events that keep the index current
+    HANDLED_EVENTS = frozenset([
+        Events.FILE_ADDED,
+        Events.FILE_REMOVED,
+        Events.FOLDER_ADDED,
+        Events.FOLDER_REMOVED,
+        Events.METADATA_ANALYSIS_FINISHED,
+    ])
+
+    # Up to this many nodes the serialized tree is kept around between requests
+    SERIALIZATION_CACHE_LIMIT = 5000
+
+    def __init__(self, file_manager, storage="local", logger=None, metadata=None):
+        self._file_manager = file_manager
+        self._storage = storage
+        self.metadata = metadata
+        self._logger = logger or logging.getLogger("octoprint.plugins.PrusaConnectBridge.files")
+
+        self._lock = threading.RLock()
+        self._root = None # Built lazily on first access
+        self._serialized = None
+        self._basedir = None
+        # File name -> paths of the files with that name, a str for the usual single one, else a set
+        self._by_name = {}
+        # Prusa Connect file hash -> path, for files downloaded from Connect
+        self._by_hash = {}
+        # Paths changed since the last take_changes(), incomplete after a rebuild
+        self.version = 0
+        self._changed = set()
+        self._changes_complete = False
+
+    ##~~ Access
+
+    def tree(self):
+        """Returns the tree in the dict format SEND_INFO expects."""
+        with self._lock:
+            if self._root is None:
+                self.rebuild()
+            if self._serialized is not None:
+                return self._serialized
+            tree, count = self._serialize()
+            if count <= self.SERIALIZATION_CACHE_LIMIT:
+                self._serialized = tree
+            return tree
+
+    def entry(self, path):
+        """The SEND_INFO entry of the file or folder at ``path``, folders with their contents. None if there is none."""
+        with self._lock:
+            if self._root is None:
+                self.rebuild()
+            node = self._find(path)
+            if node is None:
+                return None
+            return self._serialize("/".join(self._split(path)), node)[0]
+
+    def find(self, path):
+        with self._lock:
+            if self._root is None:
+                self.rebuild()
+            return self._find(path)
+
+    def walk(self, path=""):
+        """Generator yielding ``(path, node)`` for every node of the index, parents before children.
+
+        With ``path`` only for what is below that folder. Callers that need a
+        consistent view while consuming it should hold :attr:`lock`.
+        """
+        if self._root is None:
+            self.rebuild()
+        path = "/".join(self._split(path))
+        folder = self._find(path) if path else self._root
+        if folder is None or folder.children is None:
+            return
+        stack = [(path + "/" if path else "", folder)]
+        while stack:
+            prefix, folder = stack.pop()
+            for name, node in folder.children.items():
+                path = prefix + name
+                yield path, node
+                if node.children is not None:
+                    stack.append((path + "/", node))
+
+    @property
+    def lock(self):
+        return self._lock
+
+    def resolve(self, path, hash_=None):
+        """Finds a file for START_PRINT. Returns ``(path, disk path)``, or None if there is no such file.
+
+        ``path`` is tried as a path first, then the Connect ``hash_``, then the
+        name in ``path`` on its own. Of several files with that name, the one
+        whose path ends with ``path`` wins; if that is still more than one,
+        :class:`AmbiguousFile` is raised rather than guessing.
+        """
+        with self._lock:
+            if self._root is None:
+                self.rebuild()
+            parts = self._split(path or "")
+            node = self._find("/".join(parts)) if parts else None
+            if node is not None and not node.is_dir:
+                return self._resolved("/".join(parts))
+
+            if hash_:
+                hashed = self._by_hash.get(hash_)
+                if hashed is not None:
+                    node = self._find(hashed)
+                    if node is not None and not node.is_dir:
+                        return self._resolved(hashed)
+                    del self._by_hash[hash_]
+
+            if not parts:
+                return None
+            candidates = self._by_name.get(parts[-1])
+            if candidates is None:
+                return None
+            if isinstance(candidates, str):
+                candidates = (candidates,)
+            suffix = "/" + "/".join(parts)
+            matching = [candidate for candidate in candidates if ("/" + candidate).endswith(suffix)]
+            if len(matching) > 1 or (not matching and len(candidates) > 1):
+                raise AmbiguousFile(path, matching or list(candidates))
+            return self._resolved(matching[0] if matching else candidates[0])
+
+    def apply_metadata(self, path, metadata):
+        """Takes the print time over from a file's freshly extracted slicer metadata."""
+        print_time = metadata.get("print_time")
+        if not print_time:
+            return
+        with self._lock:
+            node = self._find(path) if self._root is not None else None
+            if node is not None and not node.is_dir and node.print_time != int(print_time):
+                node.print_time = int(print_time)
+                self._serialized = None
+                self._changed_path(path)
+
+    def remember_hash(self, hash_, path):
+        """Records the Prusa Connect hash of a file, so START_PRINT can find it by that."""
+        with self._lock:
+            self._by_hash[hash_] = "/".join(self._split(path))
+
+    def rebuild(self):
+        with self._lock:
+            start = time.monotonic()
+            octoprint_files_data = self._file_manager.list_files(recursive=True, locations=[self._storage])
+            root = FileNode("/", is_dir=True, m_timestamp=time.time())
+            self._by_name = {}
+            self._populate(octoprint_files_data.get(self._storage, {}), root)
+            self._root = root
+            self._basedir = self._file_manager.get_basedir(self._storage)
+            self._serialized = None
+            self._changes_lost()
+            self._logger.info(f"File index rebuilt in {time.monotonic() - start:.3f}s.")
+
+    def invalidate(self):
+        """Drops the index, it is rebuilt on next access."""
+        with self._lock:
+            self._root = None
+            self._serialized = None
+            self._by_name = {}
+            self._changes_lost()
+
+    def take_changes(self):
+        """Returns ``(paths, complete)``: the paths changed since the last call, and False if
+        the index was rebuilt meanwhile, so that changes may be missing."""
+        with self._lock:
+            changed, self._changed = self._changed, set()
+            complete, self._changes_complete = self._changes_complete, True
+            return changed, complete
+
+    ##~~ Event handling
+
+    def on_event(self, event, payload):
+        """Applies an OctoPrint file event to the index. Returns True if the event was handled."""
+        payload = payload or {}
+        if event not in self.HANDLED_EVENTS:
+            return False
+        if payload.get("storage", payload.get("origin", self._storage)) != self._storage:
+            return False
+
+        with self._lock:
+            if self._root is None:
+                # Not built yet, the first access will see the change anyway
+                return True
+
+            try:
+                if event == Events.METADATA_ANALYSIS_FINISHED:
+                    self._update_print_time(payload["path"], (payload.get("result") or {}).get("estimatedPrintTime"))
+                    self._serialized = None
+                    self._changed_path(payload["path"])
+                    return True
+
+                # Moves and copies arrive as a REMOVED/ADDED pair, so those are all we need
+                if event == Events.FILE_ADDED:
+                    if "machinecode" in (payload.get("type") or []):
+                        self._add_file(payload["path"])
+                elif event == Events.FOLDER_ADDED:
+                    # Copied or moved folders come with their contents
+                    self._add_folder(payload["path"])
+                elif event in (Events.FILE_REMOVED, Events.FOLDER_REMOVED):
+                    self._remove(payload["path"])
+                self._changed_path(payload["path"])
+            except Exception as e:
+                self._logger.warning(f"Could not apply {event} to the file index, rebuilding on next access: {e}")
+                self.invalidate()
+                return True
+
+            self._serialized = None
+            return True
+
+    ##~~ Internals
+
+    def _changed_path(self, path):
+        self._changed.add("/".join(self._split(path)))
+        self.version += 1
+
+    def _changes_lost(self):
+        self._changed = set()
+        self._changes_complete = False
+        self.version += 1
+
+    def _populate(self, octo_files_dict, parent, prefix=""):
+        for name, item_data in octo_files_dict.items():
+            if item_data["type"] == "folder":
+                node = FileNode(name, is_dir=True, m_timestamp=item_data.get("date") or time.time())
+                if item_data.get("children"):
+                    self._populate(item_data["children"], node, prefix + node.name + "/")
+            elif item_data["type"] == "machinecode":
+                print_time = None
+                if item_data.get("gcodeAnalysis"):
+                    print_time = item_data["gcodeAnalysis"].get("estimatedPrintTime")
+                node = FileNode(name, size=item_data.get("size", 0), m_timestamp=item_data.get("date") or time.time(),
+                                print_time=print_time)
+                node.print_time = self._slicer_print_time(prefix + node.name, node) or node.print_time
+                self._name_added(node.name, prefix + node.name)
+            else:
+                continue
+            parent.children[node.name] = node
+
+    def _name_added(self, name, path):
+        paths = self._by_name.get(name)
+        if paths is None:
+            self._by_name[name] = path
+        elif isinstance(paths, str):
+            if paths != path:
+                self._by_name[name] = {paths, path}
+        else:
+            paths.add(path)
+
+    def _slicer_print_time(self, path, node):
+        if self.metadata is None:
+            return None
+        print_time = self.metadata.print_time(path, node.m_timestamp, node.size)
+        return int(print_time) if print_time else None
+
+    def _name_removed(self, name, path):
+        if self.metadata is not None:
+            self.metadata.forget(path)
+        paths = self._by_name.get(name)
+        if paths == path:
+            del self._by_name[name]
+        elif isinstance(paths, set):
+            paths.discard(path)
+            if len(paths) == 1:
+                self._by_name[name] = paths.pop()
+
+    def _resolved(self, path):
+        if self._basedir:
+            return path, os.path.join(self._basedir, *path.split("/"))
+        return path, self._file_manager.path_on_disk(self._storage, path)
+
+    def _find(self, path):
+        node = self._root
+        for part in self._split(path):
+            if node.children is None or part not in node.children:
+                return None
+            node = node.children[part]
+        return node
+
+    def _ensure_folder(self, path):
+        node = self._root
+        for part in self._split(path):
+            child = node.children.get(part)
+            if child is None:
+                child = FileNode(part, is_dir=True, m_timestamp=time.time())
+                node.children[child.name] = child
+            node = child
+        return node
+
+    @staticmethod
+    def _split(path):
+        return [part for part in path.strip("/").split("/") if part]
+
+    def _add_file(self, path):
+        disk_path = self._file_manager.path_on_disk(self._storage, path)
+        stat = os.stat(disk_path)
+        metadata = self._file_manager.get_metadata(self._storage, path) or {}
+        print_time = (metadata.get("analysis") or {}).get("estimatedPrintTime")
+
+        folder, name = os.path.split(path.strip("/"))
+        parent = self._ensure_folder(folder)
+        node = FileNode(name, size=stat.st_size, m_timestamp=stat.st_mtime, print_time=print_time)
+        node.print_time = self._slicer_print_time(path.strip("/"), node) or node.print_time
+        parent.children[node.name] = node
+        self._name_added(node.name, path.strip("/"))
+
+    def _add_folder(self, path):
+        folder = self._ensure_folder(path)
+        listing = self._file_manager.list_files(path=path, recursive=True, locations=[self._storage])
+        self._populate(listing.get(self._storage, {}), folder, path.strip("/") + "/")
+
+    def _remove(self, path):
+        folder, name = os.path.split(path.strip("/"))
+        parent = self._find(folder)
+        if parent is None or parent.children is None:
+            return
+        node = parent.children.pop(name, None)
+        if node is None:
+            return
+        if not node.is_dir:
+            self._name_removed(node.name, path.strip("/"))
+            return
+        stack = [(path.strip("/") + "/", node)]
+        while stack:
+            prefix, removed = stack.pop()
+            for child in removed.children.values():
+                if child.is_dir:
+                    stack.append((prefix + child.name + "/", child))
+                else:
+                    self._name_removed(child.name, prefix + child.name)
+
+    def _update_print_time(self, path, print_time):
+        node = self._find(path)
+        if node is not None and not node.is_dir and print_time:
+            # The slicer's estimate, where known, is closer than OctoPrint's analysis
+            node.print_time = self._slicer_print_time(path.strip("/"), node) or int(print_time)
+
+    @staticmethod
+    def _entry(node):
+        # Like the SDK's legacy format, entries carry no path, it is implied by the nesting
+        entry = {
+            "name": node.name,
+            "type": "DIR" if node.is_dir else "FILE",
+            "size": node.size,
+            "m_timestamp": node.m_timestamp,
+        }
+        if node.print_time:
+            entry["print_time"] = node.print_time
+        if node.is_dir:
+            entry["children"] = []
+        return entry
+
+    def _serialize(self, path="", node=None):
+        """Builds the SEND_INFO tree (or the subtree at ``path``) from :meth:`walk`. Returns it and its node count."""
+        top = self._entry(self._root if node is None else node)
+        if node is not None and not node.is_dir:
+            return top, 1
+        # Children lists of the folders seen so far, the walk visits parents before their children
+        folders = {path: top["children"]}
+        count = 0
+        for child_path, child in self.walk(path):
+            entry = self._entry(child)
+            if child.is_dir:
+                folders[child_path] = entry["children"]
+            folders[child_path.rpartition("/")[0]].append(entry)
+            count += 1
+        return top, count
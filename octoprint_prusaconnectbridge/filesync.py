@@ -0,0 +1,190 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import threading
+
+from prusa.connect.printer import const
+
+from .telemetry import link_down
+
+
+def _signature(node):
+    # What Prusa Connect shows of a file, folders only exist or don't
+    if node.is_dir:
+        return None
+    return (node.size, node.m_timestamp, node.print_time)
+
+
+class FileSync(object):
+    """Keeps Prusa Connect's file list current with FILE_CHANGED events instead of full INFO trees.
+
+    Holds a snapshot of what Prusa Connect was last sent: every path of the
+    :class:`~.files.FileIndex` with the size, modification time and print
+    time it had. :meth:`sync` compares the paths the index changed since with
+    the snapshot, and sends one FILE_CHANGED event per file or folder that
+    was added, modified or removed, like the SDK's own filesystem does. An
+    added folder goes out with its contents in one event.
+
+    The whole tree goes out in an INFO (:meth:`resync`) only when the
+    snapshot can't be trusted: before there is one, after the index was
+    rebuilt, after Prusa Connect was unreachable (the SDK drops events it
+    fails to send), or when more than ``max_changes`` events would be needed.
+    :meth:`info` builds the INFO payload for SEND_INFO and takes its tree as
+    the new snapshot.
+
+    ``printer()`` returns the current SDK Printer, ``build_info()`` the INFO
+    payload with the full tree and ``free_space()`` the cached free space.
+    """
+
+    def __init__(self, index, printer, build_info, free_space=None, max_changes=100, logger=None, metrics=None):
+        self._index = index
+        self._printer = printer
+        self._build_info = build_info
+        self._free_space = free_space
+        self.max_changes = max_changes
+        self._logger = logger or logging.getLogger("octoprint.plugins.PrusaConnectBridge.filesync")
+        self._metrics = metrics
+
+        self._lock = threading.RLock()
+        self._snapshot = None # path -> signature of what Prusa Connect was sent, None until the first tree
+        self.version = 0 # Bumped with every change of the snapshot
+        self.stale = False # Set when sent events may have been lost
+
+    ##~~ Full tree
+
+    def info(self):
+        """The INFO payload with the whole tree, which becomes the new snapshot."""
+        with self._lock, self._index.lock:
+            info = self._build_info()
+            # Whatever changed so far is in the tree, including a first build of the index
+            self._index.take_changes()
+            self._snapshot = {path: _signature(node) for path, node in self._index.walk()}
+            self.version += 1
+            self.stale = False
+            return info
+
+    def resync(self):
+        """Sends the whole tree in an INFO. Returns False if there is no registered printer to send it."""
+        printer = self._printer()
+        if printer is None or not printer.token:
+            return False
+        with self._lock:
+            info = self.info()
+            printer.event_cb(info.pop("event"), info.pop("source"), **info)
+        self._count("full")
+        self._logger.info(f"Sent the whole file list to Prusa Connect (version {self.version}).")
+        return True
+
+    def link_lost(self):
+        """Prusa Connect couldn't be reached, events sent since may be lost. The next sync sends the whole tree."""
+        if self._snapshot is not None:
+            self.stale = True
+
+    ##~~ Changes
+
+    def sync(self):
+        """Sends what changed since the snapshot. Returns the number of events sent, None for a full resync."""
+        printer = self._printer()
+        if printer is None or not printer.token:
+            return 0
+        if link_down():
+            # Left in the index until Connect can be reached, it gets the whole tree then
+            self.link_lost()
+            return 0
+        with self._lock:
+            with self._index.lock:
+                changed, complete = self._index.take_changes()
+                if self._snapshot is None or self.stale or not complete:
+                    changes = None
+                else:
+                    changes = self._diff(changed)
+            if changes is None:
+                self.resync()
+                return None
+            if not changes:
+                return 0
+            free_space = self._free_space() if self._free_space is not None else None
+            for kind, data in changes:
+                if free_space is not None:
+                    data["free_space"] = free_space
+                printer.event_cb(const.Event.FILE_CHANGED, const.Source.WUI, **data)
+                self._count(kind)
+            self._apply(changes)
+            self.version += 1
+        self._logger.debug(f"Sent {len(changes)} file changes to Prusa Connect (version {self.version}).")
+        return len(changes)
+
+    def _diff(self, changed):
+        """FILE_CHANGED events for the changed paths as ``(kind, data)``, parents before their children.
+
+        Returns None once more than ``max_changes`` events would be needed.
+        """
+        snapshot = self._snapshot
+        paths = set(changed)
+        for path in changed:
+            # A folder replaced by another (OctoPrint moves them as removed and added) is compared in full
+            node = self._index.find(path)
+            if node is not None and node.is_dir:
+                paths.update(child_path for child_path, _ in self._index.walk(path))
+            if path in snapshot and snapshot[path] is None:
+                prefix = path + "/"
+                paths.update(known for known in snapshot if known.startswith(prefix))
+
+        changes = []
+        # Sorted, so a folder comes before anything inside it
+        for path in sorted(paths):
+            if len(changes) > self.max_changes:
+                return None
+            if self._covered(changes, path):
+                continue
+            node = self._index.find(path)
+            known = path in snapshot
+            if node is None:
+                if known:
+                    changes.append(("removed", dict(old_path="/" + path)))
+                continue
+            # Connect has to know a file's folder, the first folder it doesn't know is sent with its contents
+            top = path
+            parent = path.rpartition("/")[0]
+            while parent and parent not in snapshot:
+                top, parent = parent, parent.rpartition("/")[0]
+            if top != path or not known:
+                changes.append(("added", dict(new_path="/" + top, file=self._index.entry(top))))
+            elif not node.is_dir and snapshot[path] != _signature(node):
+                changes.append(("modified", dict(old_path="/" + path, new_path="/" + path,
+                                                 file=self._index.entry(path))))
+        return changes
+
+    @staticmethod
+    def _covered(changes, path):
+        # Whether a folder added or removed before takes this path along
+        path = "/" + path
+        for kind, data in changes:
+            if kind == "added" and path.startswith(data["new_path"] + "/"):
+                return True
+            if kind == "removed" and path.startswith(data["old_path"] + "/"):
+                return True
+        return False
+
+    def _apply(self, changes):
+        snapshot = self._snapshot
+        for kind, data in changes:
+            if kind == "removed":
+                path = data["old_path"][1:]
+                snapshot.pop(path, None)
+                prefix = path + "/"
+                for known in [known for known in snapshot if known.startswith(prefix)]:
+                    del snapshot[known]
+                continue
+            path = data["new_path"][1:]
+            node = self._index.find(path)
+            if node is None:
+                continue
+            snapshot[path] = _signature(node)
+            for child_path, child in self._index.walk(path):
+                snapshot[child_path] = _signature(child)
+
+    def _count(self, kind):
+        if self._metrics is not None:
+            self._metrics.inc("prusaconnect_file_sync_total", kind=kind)
@@ -0,0 +1,280 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from .connection import attach_session
+
+
+class SdkLifecycle(object):
+    """Owns the Prusa Connect SDK ``Printer`` and the thread running its loop.
+
+    There is at most one active loop: :meth:`create` and :meth:`stop` always
+    stop the current loop (``Printer.stop_loop``) and join its thread before
+    anything new is started. A loop stuck in a request when the join times out
+    has already been told to stop and exits after that request, it is tracked
+    until then so :attr:`thread_count` reports it.
+
+    The printer's ``loop_step`` is wrapped to time every iteration, which is
+    what :meth:`health` and :meth:`loop_lag` report on. With ``metrics`` the
+    iterations and the events raised by the printer are recorded there too.
+    With ``session`` every printer sends through that requests Session, so its
+    keep-alive connections survive the printer. ``on_alive_change(alive)`` is
+    called when the loop is started or stopped.
+
+    With :attr:`async_core` set, :meth:`start` runs the printer on an
+    :class:`~.asynccore.AsyncCore` instead of ``Printer.loop``: one event loop
+    that also drives the command executor given to :meth:`attach_executor`
+    and carries :attr:`upload_session`'s requests. It connects with
+    :attr:`ssl_context`, at most :attr:`connections` connections per host.
+    The core doesn't go through proxies, when the environment sets one for
+    the server the printer runs on ``Printer.loop`` instead.
+
+    The SDK is only imported by the first :meth:`create`, so constructing this
+    costs nothing at plugin load. ``printer_type`` defaults to the MK3.
+    """
+
+    # A loop iteration taking longer than this counts as stalled, three times the SDK's
+    # CONNECTION_TIMEOUT (10s) after which requests time out
+    STALL_TIMEOUT = 30.0
+
+    def __init__(self, printer_type=None, join_timeout=2.0, logger=None, metrics=None, session=None,
+                 on_alive_change=None):
+        self._printer_type = printer_type
+        self.session = session
+        self._on_alive_change = on_alive_change
+        self.join_timeout = join_timeout
+        self._logger = logger or logging.getLogger("octoprint.plugins.PrusaConnectBridge.lifecycle")
+        self._metrics = metrics
+        self.async_core = False
+        self.ssl_context = None
+        self.connections = 2
+
+        self._lock = threading.RLock()
+        self._printer = None
+        self._thread = None
+        self._core = None
+        self._executor = None # Command executor the async core drives
+        # Loop threads that were stopped but didn't exit within join_timeout
+        self._stopping = []
+        # Bumped for every new printer, so a stopping loop can't update the current loop's timings
+        self._generation = 0
+        self._step_started = None
+        self._last_step_at = None
+        # Loop threads started over the lifetime of this object
+        self.starts = 0
+
+    @property
+    def printer(self):
+        return self._printer
+
+    @property
+    def thread(self):
+        return self._thread
+
+    @property
+    def core(self):
+        """The running :class:`~.asynccore.AsyncCore`, None with ``Printer.loop`` or when stopped."""
+        return self._core
+
+    @property
+    def upload_session(self):
+        """requests-like session sending through the async core while it runs, through :attr:`session` otherwise."""
+        from .asynccore import CoreSession
+        return CoreSession(lambda: self._core, self.session)
+
+    @property
+    def thread_count(self):
+        """Number of SDK loop threads that are still alive, including ones still stopping."""
+        with self._lock:
+            self._stopping = [thread for thread in self._stopping if thread.is_alive()]
+            threads = self._stopping + ([self._thread] if self._thread is not None else [])
+            return sum(1 for thread in threads if thread.is_alive())
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    ##~~ Lifecycle
+
+    def create(self, sn, fingerprint, server=None, token=None):
+        """Stops the current loop and replaces the printer with a new one. Doesn't start the loop."""
+        from prusa.connect.printer import Printer, const
+
+        with self._lock:
+            self.stop()
+            printer = Printer(type_=self._printer_type or const.PrinterType.I3MK3, sn=sn, fingerprint=fingerprint)
+            if self.session is not None:
+                attach_session(printer, self.session)
+            if server:
+                printer.set_connection(server, token)
+            self._generation += 1
+            self._executor = None # It belonged to the old printer
+            self._wrap_loop_step(printer, self._generation)
+            if self._metrics is not None:
+                self._wrap_event_cb(printer)
+            self._printer = printer
+            self._step_started = None
+            self._last_step_at = None
+            self._logger.info(f"Prusa SDK Printer object created. SN: {sn}, Fingerprint: {fingerprint[:10]}...")
+            return printer
+
+    def start(self, name="PrusaConnectSDKLoop"):
+        with self._lock:
+            if self._printer is None:
+                raise RuntimeError("No Prusa SDK Printer object to run the loop for")
+            if self.is_alive():
+                self._logger.debug("SDK loop thread already running.")
+                return False
+            if self.async_core and not self._proxied():
+                from .asynccore import AsyncCore
+                generation = self._generation
+                self._core = AsyncCore(self._printer, ssl_context=self.ssl_context, connections=self.connections,
+                                       executor=self._executor, timed_step=lambda: self._timed(generation),
+                                       idle=lambda: self._mark_idle(generation),
+                                       logger=logging.getLogger("octoprint.plugins.PrusaConnectBridge.asynccore"))
+                self._core.start(name=name)
+                self._thread = self._core.thread
+            else:
+                self._thread = threading.Thread(target=self._printer.loop, daemon=True, name=name)
+                self._thread.start()
+                if self._executor is not None:
+                    # Handed over for the async core, runs on its own dispatcher instead
+                    self._executor.start()
+            self.starts += 1
+            self._logger.info(f"SDK loop thread '{name}' started.")
+            self._alive_changed(True)
+            return True
+
+    def stop(self, timeout=None):
+        """Stops the loop and waits up to ``timeout`` seconds for its thread. Returns True if it exited."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            core, self._core = self._core, None
+            if self._printer is not None:
+                self._printer.stop_loop()
+            if core is not None:
+                # Only signals it and releases its command pool, the thread is joined below
+                core.stop(0)
+            if thread is None or not thread.is_alive():
+                return True
+            self._alive_changed(False)
+
+            thread.join(self.join_timeout if timeout is None else timeout)
+            if thread.is_alive():
+                # Most likely waiting for a response, the loop checks its flag right after that
+                self._logger.warning(f"SDK loop thread '{thread.name}' did not stop in time, it will exit after its current request.")
+                self._stopping.append(thread)
+                return False
+            self._logger.info(f"SDK loop thread '{thread.name}' stopped.")
+            return True
+
+    def attach_executor(self, executor):
+        """Hands the command executor to the async core, now if it runs or else when it starts."""
+        with self._lock:
+            self._executor = executor
+            if self._core is not None:
+                self._core.attach(executor)
+            elif self.is_alive() and executor is not None:
+                executor.start()
+
+    def _proxied(self):
+        from .asynccore import proxy_for
+
+        server = self._printer.server
+        if not server or not proxy_for(server):
+            return False
+        self._logger.warning("A proxy is configured for Prusa Connect, which the async core doesn't support, "
+                             "running the SDK loop thread instead.")
+        return True
+
+    def restart(self, sn, fingerprint, server=None, token=None, name="PrusaConnectSDKLoop"):
+        with self._lock:
+            printer = self.create(sn, fingerprint, server=server, token=token)
+            self.start(name=name)
+            return printer
+
+    def discard(self):
+        """Stops the loop and drops the printer."""
+        with self._lock:
+            self.stop()
+            self._printer = None
+
+    def _alive_changed(self, alive):
+        if self._on_alive_change is not None:
+            try:
+                self._on_alive_change(alive)
+            except Exception as e:
+                self._logger.warning(f"Error in SDK loop state listener: {e}")
+
+    ##~~ Health
+
+    def health(self):
+        """Health probe of the loop thread.
+
+        ``healthy`` is False if the loop isn't running or one iteration has been
+        busy for longer than :attr:`STALL_TIMEOUT`.
+        """
+        now = time.monotonic()
+        step_started, last_step_at = self._step_started, self._last_step_at
+        busy_for = now - step_started if step_started is not None else 0.0
+        alive = self.is_alive()
+        return dict(
+            alive=alive,
+            threads=self.thread_count,
+            starts=self.starts,
+            busy_for=busy_for,
+            last_step_age=now - last_step_at if last_step_at is not None else None,
+            healthy=alive and busy_for < self.STALL_TIMEOUT
+        )
+
+    def loop_lag(self):
+        """Seconds since the loop last finished an iteration (about 0.1s when idle, 1s with the async core), None if it never ran."""
+        if not self.is_alive() or self._last_step_at is None:
+            return None
+        return time.monotonic() - self._last_step_at
+
+    @contextmanager
+    def _timed(self, generation):
+        """Times one loop iteration, for :meth:`health` and :meth:`loop_lag`."""
+        start = time.monotonic()
+        if generation == self._generation:
+            self._step_started = start
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            if generation == self._generation:
+                self._last_step_at = end
+                self._step_started = None
+            if self._metrics is not None:
+                self._metrics.observe("prusaconnect_sdk_loop_step_seconds", end - start)
+
+    def _mark_idle(self, generation):
+        # The async core has no idle iterations to time, it reports in when there was nothing to send
+        if generation == self._generation:
+            self._last_step_at = time.monotonic()
+
+    def _wrap_loop_step(self, printer, generation):
+        loop_step = printer.loop_step
+
+        def timed_loop_step():
+            with self._timed(generation):
+                return loop_step()
+
+        # Printer.loop calls self.loop_step, so the instance attribute takes precedence
+        printer.loop_step = timed_loop_step
+
+    def _wrap_event_cb(self, printer):
+        event_cb = printer.event_cb
+        metrics = self._metrics
+
+        def counted_event_cb(event, source, *args, **kwargs):
+            metrics.inc("prusaconnect_events_total", event=event.value)
+            return event_cb(event, source, *args, **kwargs)
+
+        # The command keeps its own reference to the callback, it raises ACCEPTED/REJECTED/FINISHED/FAILED
+        printer.event_cb = counted_event_cb
+        printer.command.event_cb = counted_event_cb
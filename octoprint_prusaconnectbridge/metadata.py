@@ -0,0 +1,292 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import logging
+import mmap
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# Slicers write thumbnails and their header at the start, PrusaSlicer its config and estimates at the end
+HEAD_BYTES = 512 * 1024
+TAIL_BYTES = 64 * 1024
+# A thumbnail that started in the head is read on up to this far, larger ones are skipped
+THUMBNAIL_LIMIT = 2 * 1024 * 1024
+
+# "; key = value" comments, as PrusaSlicer, SuperSlicer and OrcaSlicer write them
+KEY_VALUE = re.compile(rb"^; ?([^=\r\n]+?) = ([^\r\n]*)", re.M)
+# ";KEY:value" comments, as Cura writes them
+CURA_VALUE = re.compile(rb"^;(TIME|Filament used|Layer height|TARGET_MACHINE\.NAME):([^\r\n]*)", re.M)
+THUMBNAIL_BEGIN = re.compile(rb"^; thumbnail(?:_(JPG|QOI))? begin (\d+)x(\d+) (\d+)", re.M)
+THUMBNAIL_END = re.compile(rb"^; thumbnail(?:_(?:JPG|QOI))? end", re.M)
+DURATION = re.compile(r"(\d+)\s*([dhms])")
+
+# Metadata sent to Prusa Connect, under the names PrusaSlicer uses (as the SDK does for FILE_INFO)
+FLOAT_KEYS = frozenset(("layer_height", "nozzle_diameter", "max_layer_z"))
+SUM_KEYS = frozenset(("filament used [mm]", "filament used [g]", "filament used [cm3]", "total filament used [g]"))
+TEXT_KEYS = frozenset(("estimated printing time (normal mode)", "printer_model", "filament_type", "fill_density",
+                       "brim_width", "support_material", "filament_settings_id", "print_settings_id"))
+
+CURA_KEYS = {
+    b"TIME": "print_time",
+    b"Filament used": "filament used [mm]",
+    b"Layer height": "layer_height",
+    b"TARGET_MACHINE.NAME": "printer_model",
+}
+
+
+def duration_seconds(text):
+    """Seconds of a PrusaSlicer duration such as ``1d 2h 3m 4s``, or None."""
+    units = dict(d=86400, h=3600, m=60, s=1)
+    parts = DURATION.findall(text or "")
+    if not parts:
+        return None
+    return sum(int(value) * units[unit] for value, unit in parts)
+
+
+def _number(text):
+    return float(text.strip().rstrip("m").split(",")[0])
+
+
+def _parse_values(data, metadata, start=0, end=None):
+    end = len(data) if end is None else end
+    for match in KEY_VALUE.finditer(data, start, end):
+        key = match.group(1).decode("utf-8", "replace")
+        if key not in FLOAT_KEYS and key not in SUM_KEYS and key not in TEXT_KEYS:
+            continue
+        value = match.group(2).decode("utf-8", "replace").strip()
+        try:
+            if key in FLOAT_KEYS:
+                metadata[key] = _number(value)
+            elif key in SUM_KEYS:
+                # One value per extruder for multi-material prints
+                metadata[key] = round(sum(float(part) for part in value.split(",") if part.strip()), 2)
+            else:
+                metadata[key] = value
+        except ValueError:
+            continue
+    for match in CURA_VALUE.finditer(data, start, end):
+        key = CURA_KEYS[match.group(1)]
+        value = match.group(2).decode("utf-8", "replace").strip()
+        try:
+            if key == "printer_model":
+                metadata.setdefault(key, value)
+            elif key == "filament used [mm]":
+                metadata.setdefault(key, round(_number(value) * 1000.0, 2)) # Cura reports meters
+            elif key == "print_time":
+                metadata.setdefault(key, int(float(value)))
+            else:
+                metadata.setdefault(key, _number(value))
+        except ValueError:
+            continue
+
+
+def _thumbnail(data, limit):
+    """Returns the base64 of the largest thumbnail starting in ``data`` (an mmap or bytes), PNG preferred."""
+    best = None
+    for begin in THUMBNAIL_BEGIN.finditer(data, 0, limit):
+        start = data.find(b"\n", begin.end()) + 1
+        if start <= 0:
+            continue
+        end = THUMBNAIL_END.search(data, start, min(start + THUMBNAIL_LIMIT, len(data)))
+        if end is None:
+            continue
+        rank = (begin.group(1) is None, int(begin.group(2)) * int(begin.group(3)))
+        if best is None or rank > best[0]:
+            best = (rank, start, end.start())
+    if best is None:
+        return None
+    _, start, end = best
+    lines = data[start:end].split(b"\n")
+    return b"".join(line[1:].strip() for line in lines if line.startswith(b";")).decode("ascii", "replace")
+
+
+def extract(disk_path, head=HEAD_BYTES, tail=TAIL_BYTES):
+    """Reads the slicer metadata and the largest thumbnail of a G-code file.
+
+    Only the first ``head`` and the last ``tail`` bytes are looked at, through
+    read-only memory maps of just those windows, so neither the cost nor the
+    address space used depends on the file size.
+    Returns ``(metadata, thumbnail)``, the metadata keyed like PrusaSlicer
+    names them plus ``print_time`` in seconds, the thumbnail as base64 (or None).
+    """
+    metadata = {}
+    with open(disk_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return metadata, None
+        head_end = min(head, size)
+        # A thumbnail that starts in the head may run on past it
+        with mmap.mmap(f.fileno(), min(head + THUMBNAIL_LIMIT, size), access=mmap.ACCESS_READ) as data:
+            _parse_values(data, metadata, 0, head_end)
+            thumbnail = _thumbnail(data, head_end)
+        tail_start = max(size - tail, head_end)
+        if tail_start < size:
+            # Maps start at a multiple of the allocation granularity
+            offset = tail_start - tail_start % mmap.ALLOCATIONGRANULARITY
+            with mmap.mmap(f.fileno(), size - offset, offset=offset, access=mmap.ACCESS_READ) as data:
+                _parse_values(data, metadata, tail_start - offset)
+
+    print_time = duration_seconds(metadata.get("estimated printing time (normal mode)"))
+    if print_time is not None:
+        metadata["print_time"] = print_time
+    return metadata, thumbnail
+
+
+class MetadataCache(object):
+    """Persistent cache of the G-code metadata and thumbnails, keyed by (path, mtime, size).
+
+    Entries are kept in an SQLite database in the plugin's data folder, so every
+    file is parsed once, not on every start. In memory only the print time per
+    path is kept, for the SEND_INFO tree; the full metadata and the thumbnail
+    are read from the database when Prusa Connect asks for a file's info.
+
+    Files seen without a fresh entry are handed to :meth:`request`, which parses
+    them on a worker thread and reports them to ``on_extracted(path, metadata)``.
+    ``resolve(path)`` maps a storage path to the file on disk.
+    """
+
+    # Entries written before a commit, the commit also happens whenever the queue runs dry
+    COMMIT_EVERY = 100
+
+    def __init__(self, db_path, resolve, on_extracted=None, logger=None, metrics=None):
+        self._db_path = db_path
+        self._resolve = resolve
+        self._on_extracted = on_extracted
+        self._logger = logger or logging.getLogger("octoprint.plugins.PrusaConnectBridge.metadata")
+        self._metrics = metrics
+
+        self._lock = threading.RLock()
+        self._db = None
+        # path -> (mtime, size, print_time) of the entries in the database
+        self._entries = {}
+        self._queue = {} # path -> (mtime, size), insertion ordered
+        self._wakeup = threading.Condition(self._lock)
+        self._worker = None
+        self._stopped = threading.Event()
+        self._uncommitted = 0
+
+    ##~~ Lifecycle
+
+    def open(self):
+        with self._lock:
+            if self._db is not None:
+                return
+            self._db = sqlite3.connect(self._db_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS metadata (path TEXT PRIMARY KEY, mtime INTEGER, "
+                             "size INTEGER, print_time INTEGER, metadata TEXT, thumbnail TEXT)")
+            self._entries = {path: (mtime, size, print_time) for path, mtime, size, print_time
+                             in self._db.execute("SELECT path, mtime, size, print_time FROM metadata")}
+            self._stopped = threading.Event()
+            self._worker = threading.Thread(target=self._run, args=(self._stopped,), daemon=True,
+                                            name="PrusaConnectMetadata")
+            self._worker.start()
+        self._logger.info(f"Metadata cache opened with {len(self._entries)} entries.")
+
+    def close(self):
+        with self._lock:
+            if self._db is None:
+                return
+            self._stopped.set()
+            self._queue.clear()
+            self._wakeup.notify_all()
+            self._worker = None
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+    ##~~ Access
+
+    def print_time(self, path, mtime, size):
+        """The slicer's estimate for a file if its entry is fresh, without touching the disk.
+
+        A file without a fresh entry is queued for extraction and None returned.
+        """
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == int(mtime) and entry[1] == size:
+            return entry[2]
+        self.request(path, mtime, size)
+        return None
+
+    def get(self, path):
+        """Returns ``(metadata, thumbnail)`` of a file, parsing it now if its entry isn't fresh."""
+        stat = os.stat(self._resolve(path))
+        key = (int(stat.st_mtime), stat.st_size)
+        with self._lock:
+            if self._db is not None and self._entries.get(path, (None, None))[:2] == key:
+                row = self._db.execute("SELECT metadata, thumbnail FROM metadata WHERE path = ?", (path,)).fetchone()
+                if row is not None:
+                    self._count("hit")
+                    return json.loads(row[0]), row[1]
+        return self._extract(path, *key)
+
+    def request(self, path, mtime, size):
+        with self._lock:
+            if self._db is None or path in self._queue:
+                return
+            self._queue[path] = (int(mtime), size)
+            self._wakeup.notify()
+
+    def forget(self, path):
+        with self._lock:
+            self._queue.pop(path, None)
+            if self._entries.pop(path, None) is not None and self._db is not None:
+                self._db.execute("DELETE FROM metadata WHERE path = ?", (path,))
+                # Committed by the worker, once per burst of removals
+                self._uncommitted += 1
+                self._wakeup.notify()
+
+    ##~~ Worker
+
+    def _run(self, stopped):
+        while True:
+            with self._lock:
+                while not self._queue and not stopped.is_set():
+                    if self._uncommitted and self._db is not None:
+                        self._db.commit()
+                        self._uncommitted = 0
+                    self._wakeup.wait()
+                if stopped.is_set():
+                    return
+                path = next(iter(self._queue))
+                mtime, size = self._queue.pop(path)
+            try:
+                metadata, _ = self._extract(path, mtime, size)
+            except Exception as e:
+                self._logger.debug(f"Could not read the metadata of {path}: {e}")
+                continue
+            if self._on_extracted is not None:
+                try:
+                    self._on_extracted(path, metadata)
+                except Exception as e:
+                    self._logger.error(f"Error applying the metadata of {path}: {e}", exc_info=True)
+
+    def _extract(self, path, mtime, size):
+        start = time.perf_counter()
+        try:
+            metadata, thumbnail = extract(self._resolve(path))
+        except Exception:
+            self._count("error")
+            raise
+        finally:
+            if self._metrics is not None:
+                self._metrics.observe("prusaconnect_metadata_seconds", time.perf_counter() - start)
+        self._count("parsed")
+        print_time = metadata.get("print_time")
+        with self._lock:
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)",
+                                 (path, mtime, size, print_time, json.dumps(metadata), thumbnail))
+                self._entries[path] = (mtime, size, print_time)
+                self._uncommitted += 1
+                if self._uncommitted >= self.COMMIT_EVERY:
+                    self._db.commit()
+                    self._uncommitted = 0
+        return metadata, thumbnail
+
+    def _count(self, result):
+        if self._metrics is not None:
+            self._metrics.inc("prusaconnect_metadata_total", result=result)
@@ -0,0 +1,163 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds in seconds, from a fast telemetry build to a slow first SEND_INFO
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# name -> (type, help) of every metric the bridge exports
+METRICS = {
+    "prusaconnect_telemetry_seconds": ("histogram", "Time spent building and submitting one telemetry snapshot."),
+    "prusaconnect_telemetry_emitted_total": ("counter", "Telemetry snapshots queued for Prusa Connect."),
+    "prusaconnect_telemetry_errors_total": ("counter", "Telemetry snapshots that failed to build or queue."),
+    "prusaconnect_telemetry_buffered": ("gauge", "Telemetry samples buffered while Prusa Connect is unreachable."),
+    "prusaconnect_telemetry_buffer_dropped_total": ("counter", "Buffered telemetry samples overwritten because the buffer was full."),
+    "prusaconnect_telemetry_replayed_total": ("counter", "Buffered telemetry samples replayed to Prusa Connect."),
+    "prusaconnect_send_info_tree_seconds": ("histogram", "Time spent producing the SEND_INFO file tree."),
+    "prusaconnect_command_seconds": ("histogram", "Run time of Prusa Connect command handlers."),
+    "prusaconnect_commands_total": ("counter", "Prusa Connect commands by result."),
+    "prusaconnect_events_total": ("counter", "Events queued for Prusa Connect, by event type."),
+    "prusaconnect_sdk_loop_step_seconds": ("histogram", "Duration of one SDK loop iteration (dequeue and send)."),
+    "prusaconnect_sdk_loop_lag_seconds": ("gauge", "Time since the SDK loop last completed an iteration."),
+    "prusaconnect_sdk_loop_threads": ("gauge", "SDK loop threads alive, including ones still stopping."),
+    "prusaconnect_sdk_queue_depth": ("gauge", "Items waiting in the SDK send queue."),
+    "prusaconnect_command_workers_busy": ("gauge", "Command workers currently running a handler."),
+    "prusaconnect_http_connections_opened_total": ("counter", "HTTP connections opened, each one a TLS handshake for https."),
+    "prusaconnect_http_requests_total": ("counter", "HTTP requests sent over the pooled session."),
+    "prusaconnect_bridged_printers": ("gauge", "Other OctoPrint instances bridged from this process."),
+    "prusaconnect_downloads_total": ("counter", "Downloads from Prusa Connect by result."),
+    "prusaconnect_download_bytes_total": ("counter", "Bytes downloaded from Prusa Connect into the storage."),
+    "prusaconnect_download_resumes_total": ("counter", "Downloads resumed with a Range request."),
+    "prusaconnect_event_queue_total": ("counter", "OctoPrint events in the event queue by result: coalesced, dropped or handled."),
+    "prusaconnect_metadata_total": ("counter", "G-code metadata lookups by result: hit, parsed or error."),
+    "prusaconnect_metadata_seconds": ("histogram", "Time spent reading the metadata and thumbnail of one G-code file."),
+    "prusaconnect_time_index_total": ("counter", "G-code time indexes by result: built, loaded, empty or error."),
+    "prusaconnect_time_index_seconds": ("histogram", "Time spent building or loading the time index of one G-code file."),
+    "prusaconnect_file_sync_total": ("counter", "File list updates sent to Prusa Connect: added, modified, removed or full."),
+    "prusaconnect_storage_free_bytes": ("gauge", "Free space in the upload folder at the last sample."),
+    "prusaconnect_storage_total_bytes": ("gauge", "Size of the file system of the upload folder at the last sample."),
+    "prusaconnect_storage_sample_seconds": ("histogram", "Time spent reading the free space of the upload folder."),
+    "prusaconnect_camera_frames_total": ("counter", "Camera snapshots per stage (grab, encode, upload) by result: ok, skipped, error or unregistered."),
+    "prusaconnect_camera_bytes_total": ("counter", "Bytes of camera snapshots leaving each stage."),
+    "prusaconnect_camera_stage_seconds": ("histogram", "Time spent on one camera snapshot per stage."),
+    "prusaconnect_camera_interval_seconds": ("gauge", "Current seconds between camera snapshots, 0 while they are off."),
+    "prusaconnect_startup_seconds": ("gauge", "Time spent per plugin startup phase, sdk_ready runs in the background."),
+}
+
+
+class _Histogram(object):
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, bucket_count):
+        self.counts = [0] * (bucket_count + 1) # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+
+class Metrics(object):
+    """Counters, histograms and gauges for the bridge, rendered in the Prometheus text format.
+
+    Recording is a dict lookup and a few additions under a lock, cheap enough to
+    stay on in production. Gauges are callbacks evaluated when rendering, so
+    they cost nothing between scrapes. Durations are measured with
+    ``time.perf_counter``, which is monotonic.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # (name, labels) -> value, labels being a sorted tuple of (key, value) pairs
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    ##~~ Recording
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self._buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(len(self._buckets))
+            histogram.counts[index] += 1
+            histogram.sum += seconds
+            histogram.count += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observes the run time of the ``with`` block, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name, callback, **labels):
+        """Registers ``callback()`` as the value of a gauge. It returning None leaves the gauge out."""
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = callback
+
+    ##~~ Export
+
+    def snapshot(self):
+        """Current values as plain dicts, keyed by (name, labels)."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(h.counts), h.sum, h.count) for key, h in self._histograms.items()}
+            gauges = dict(self._gauges)
+        values = {}
+        for key, callback in gauges.items():
+            try:
+                value = callback()
+            except Exception:
+                value = None
+            if value is not None:
+                values[key] = value
+        return counters, histograms, values
+
+    def render(self):
+        """Renders all metrics in the Prometheus text exposition format (0.0.4)."""
+        counters, histograms, gauges = self.snapshot()
+        by_name = {}
+        for source in (counters, histograms, gauges):
+            for name, labels in source:
+                by_name.setdefault(name, []).append(labels)
+
+        lines = []
+        for name in sorted(by_name):
+            metric_type, help_text = METRICS.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels in sorted(by_name[name]):
+                key = (name, labels)
+                if key in histograms:
+                    counts, total, count = histograms[key]
+                    cumulative = 0
+                    for bound, bucket_count in zip(self._buckets + (float("inf"),), counts):
+                        cumulative += bucket_count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {total!r}")
+                    lines.append(f"{name}_count{_labels(labels)} {count}")
+                elif key in counters:
+                    lines.append(f"{name}{_labels(labels)} {counters[key]}")
+                else:
+                    lines.append(f"{name}{_labels(labels)} {gauges[key]!r}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
@@ -200,7 +200,7 @@ $(function() {
         }, self);
 
         self.onDataUpdaterPluginMessage = function(plugin, message) {
-            if (plugin !== "PrusaConnectBridge") {
+            if (plugin !== "prusaconnectbridge") {
                 return;
             }
             // console.log("PrusaConnectBridgeWizardViewModel: Received plugin message:", message);
@@ -0,0 +1,118 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import threading
+
+
+class ConnectStatus(object):
+    """Registration status of the bridge, as shown by the settings page and the wizard.
+
+    The plugin reports transitions through :meth:`update` (identifiers set,
+    registration code issued, token obtained, SDK loop started or stopped,
+    error set or cleared). The UI message is only rebuilt after a transition,
+    so reading :attr:`text` or :attr:`message` costs a dict lookup.
+
+    Pushes to the browsers go through ``send(message)``, debounced: transitions
+    within ``debounce`` seconds of each other are coalesced into one message
+    with the latest state, and a message equal to the last one pushed is not
+    sent at all.
+    """
+
+    DEBOUNCE = 0.25
+
+    def __init__(self, send, debounce=DEBOUNCE, logger=None):
+        self._send = send
+        self.debounce = debounce
+        self._logger = logger or logging.getLogger("octoprint.plugins.PrusaConnectBridge.status")
+
+        self._lock = threading.Lock()
+        self._state = dict(sn=None, token=None, tmp_code=None, sdk_alive=False, error=None)
+        self._message = None
+        self._pushed = None
+        self._timer = None
+        # Transitions and pushes, to tell how much the debounce coalesced
+        self.transitions = 0
+        self.pushes = 0
+
+    def __getitem__(self, key):
+        return self._state[key]
+
+    @property
+    def message(self):
+        with self._lock:
+            if self._message is None:
+                self._message = self._build(self._state)
+            return self._message
+
+    @property
+    def text(self):
+        return self.message["status_text"]
+
+    def update(self, **changes):
+        """Applies a transition. Returns True if anything changed, the push follows after the debounce."""
+        with self._lock:
+            changes = {key: value for key, value in changes.items() if self._state[key] != value}
+            if not changes:
+                return False
+            self._state.update(changes)
+            self._message = None
+            self.transitions += 1
+            if self._timer is None:
+                self._timer = threading.Timer(self.debounce, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        self._logger.debug(f"Prusa Connect status transition: {changes}")
+        return True
+
+    def flush(self):
+        """Pushes the current message now, unless it was already pushed."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        message = self.message
+        with self._lock:
+            if message == self._pushed:
+                return False
+            self._pushed = message
+            self.pushes += 1
+        try:
+            self._send(message)
+        except Exception as e:
+            self._logger.warning(f"Could not push the Prusa Connect status to the UI: {e}")
+        return True
+
+    def cancel(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    @staticmethod
+    def _build(state):
+        token = state["token"]
+        tmp_code = state["tmp_code"]
+        error = state["error"]
+        token_display_partial = None
+
+        if token:
+            token_display_partial = f"{token[:4]}...{token[-4:]}" if len(token) > 8 else "Token Set (Short)"
+            status = f"Registered (Token: {token_display_partial if len(token) > 8 else 'Set'})"
+        elif error:
+            status = "Registration Error" # The specific error is in registration_error_message
+        elif tmp_code:
+            status = f"Awaiting code entry on Prusa Connect: {tmp_code}"
+        elif state["sdk_alive"]:
+            status = "Not Registered. SDK is active. Wizard will guide registration if needed."
+        else:
+            status = "Not Registered. SDK may not be active or initialized. Wizard will guide registration if needed."
+
+        return dict(
+            status_text=status,
+            prusa_connect_sn=state["sn"] or "Not set",
+            tmp_code=None if token else tmp_code,
+            token_available=bool(token),
+            token_display_partial=token_display_partial,
+            registration_error_message=error
+        )
@@ -0,0 +1,139 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import os
+import threading
+import time
+
+
+class StorageMonitor(object):
+    """Free and total space of the upload folder, sampled in the background.
+
+    ``os.statvfs`` runs on a worker thread every ``interval`` seconds, and
+    :attr:`SETTLE` seconds after :meth:`request` (called for file events, so
+    a burst of uploads or deletions is sampled once). Readers get the cached
+    :attr:`free_space` and :attr:`total_space` without touching the disk,
+    which on an SD card can take a while.
+
+    ``on_change(free, total)`` is called after a sample when the free space
+    drops below or climbs back over ``low_percent`` of the total, or moved by
+    more than ``change_percent`` of the total since the last call.
+    """
+
+    SETTLE = 1.0
+
+    def __init__(self, path, interval=60.0, low_percent=10.0, change_percent=5.0, on_change=None, logger=None,
+                 metrics=None):
+        self._path = path # Callable, OctoPrint's upload folder can be changed while running
+        self._on_change = on_change
+        self._logger = logger or logging.getLogger("octoprint.plugins.PrusaConnectBridge.storage")
+        self._metrics = metrics
+        self.configure(interval=interval, low_percent=low_percent, change_percent=change_percent)
+
+        self.free_space = 0
+        self.total_space = 0
+        self.sampled = None # time.monotonic() of the last sample, None before the first
+        self._notified = None # (free, low) last passed to on_change
+        self._sample_lock = threading.Lock() # Downloads sample too, outside of the worker
+        self._cond = threading.Condition()
+        self._due = None # Sample requested for this time.monotonic(), ahead of the interval
+        self._worker = None
+        self._stopped = threading.Event()
+
+    def configure(self, interval=None, low_percent=None, change_percent=None):
+        if interval is not None:
+            self.interval = max(float(interval), 1.0)
+        if low_percent is not None:
+            self.low_percent = max(float(low_percent), 0.0)
+        if change_percent is not None:
+            self.change_percent = max(float(change_percent), 0.0)
+
+    @property
+    def low(self):
+        return bool(self.total_space) and self.free_space * 100.0 < self.total_space * self.low_percent
+
+    def fits(self, size):
+        """Whether ``size`` more bytes fit, going by the last sample."""
+        return size <= self.free_space
+
+    ##~~ Lifecycle
+
+    def start(self):
+        with self._cond:
+            if self._worker is not None:
+                return
+            self._stopped = threading.Event()
+            self._worker = threading.Thread(target=self._run, args=(self._stopped,), daemon=True,
+                                            name="PrusaConnectStorage")
+            self._worker.start()
+
+    def stop(self):
+        with self._cond:
+            if self._worker is None:
+                return
+            self._stopped.set()
+            self._worker = None
+            self._cond.notify()
+
+    ##~~ Sampling
+
+    def request(self, delay=SETTLE):
+        """Samples again ``delay`` seconds from now, unless a sample is due earlier anyway."""
+        due = time.monotonic() + delay
+        with self._cond:
+            if self._due is None or due < self._due:
+                self._due = due
+                self._cond.notify()
+
+    def sample(self):
+        """Reads the free and total space now. Returns ``(free, total)``."""
+        path = self._path()
+        start = time.perf_counter()
+        try:
+            stat = os.statvfs(path)
+        except (OSError, TypeError) as e:
+            self._logger.warning(f"Could not read the free space of '{path}': {e}")
+            free = total = 0
+        else:
+            free = stat.f_bavail * stat.f_frsize
+            total = stat.f_blocks * stat.f_frsize
+        if self._metrics is not None:
+            self._metrics.observe("prusaconnect_storage_sample_seconds", time.perf_counter() - start)
+        with self._sample_lock:
+            self.free_space, self.total_space = free, total
+            self.sampled = time.monotonic()
+            self._check(free, total)
+        return free, total
+
+    def _check(self, free, total):
+        low = self.low
+        notified = self._notified
+        if notified is not None:
+            if notified[1] == low and abs(free - notified[0]) * 100.0 <= total * self.change_percent:
+                return
+            if low and not notified[1]:
+                self._logger.warning(f"Free space in the upload folder is low: {free} of {total} bytes.")
+        self._notified = (free, low)
+        if notified is None or self._on_change is None:
+            return # The first sample is the baseline, Prusa Connect gets it with the next SEND_INFO
+        try:
+            self._on_change(free, total)
+        except Exception as e:
+            self._logger.error(f"Error reporting the free space: {e}", exc_info=True)
+
+    def _run(self, stopped):
+        next_sample = time.monotonic()
+        while True:
+            with self._cond:
+                while True:
+                    if stopped.is_set():
+                        return
+                    now = time.monotonic()
+                    due = next_sample if self._due is None else min(next_sample, self._due)
+                    if due <= now:
+                        self._due = None
+                        break
+                    self._cond.wait(due - now)
+            self.sample()
+            next_sample = time.monotonic() + self.interval
@@ -0,0 +1,672 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import math
+import random
+import threading
+import time
+from array import array
+from operator import itemgetter
+
+from octoprint.printer import PrinterCallback
+from prusa.connect.printer import const
+from prusa.connect.printer.conditions import CondState, HTTP, INTERNET
+from prusa.connect.printer.models import Telemetry
+
+# A heater counts as heating while its actual temperature is more than this below the target
+HEATING_MARGIN = 2.0
+
+
+class CadenceScheduler(object):
+    """Picks the telemetry heartbeat interval from the printer state.
+
+    Fast while heating or right after a layer change, slower while printing,
+    slow while idle and slowest while the printer is offline. Consecutive send
+    failures back the interval off exponentially, up to ``backoff_max``.
+    """
+
+    # Prusa Connect states mapped to a cadence, anything else counts as idle
+    STATE_MODES = {
+        "PRINTING": "printing",
+        "BUSY": "printing",
+        "OFFLINE": "offline",
+        "ERROR": "offline",
+        "ATTENTION": "offline",
+    }
+
+    def __init__(self, heating=1.0, printing=5.0, idle=10.0, offline=60.0, layer_burst=10.0, backoff_max=300.0):
+        self._lock = threading.RLock()
+        self._intervals = {}
+        self.layer_burst = 0.0
+        self.backoff_max = 0.0
+        self.configure(heating=heating, printing=printing, idle=idle, offline=offline,
+                       layer_burst=layer_burst, backoff_max=backoff_max)
+
+        self.mode = "idle"
+        self.failures = 0
+        self._burst_until = 0.0
+
+    def configure(self, heating=None, printing=None, idle=None, offline=None, layer_burst=None, backoff_max=None):
+        with self._lock:
+            for mode, value in (("heating", heating), ("printing", printing), ("idle", idle), ("offline", offline)):
+                if value is not None:
+                    self._intervals[mode] = max(float(value), 0.5)
+            if layer_burst is not None:
+                self.layer_burst = max(float(layer_burst), 0.0)
+            if backoff_max is not None:
+                self.backoff_max = max(float(backoff_max), 1.0)
+
+    def update(self, state, heating=False):
+        """Update the mode from the latest snapshot. Returns True if the interval got shorter."""
+        with self._lock:
+            previous = self.interval()
+            state_name = getattr(state, "value", state)
+            mode = self.STATE_MODES.get(state_name, "idle")
+            if heating and mode != "offline":
+                mode = "heating"
+            self.mode = mode
+            return self.interval() < previous
+
+    def layer_changed(self):
+        with self._lock:
+            previous = self.interval()
+            self._burst_until = time.monotonic() + self.layer_burst
+            return self.interval() < previous
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+    @property
+    def backing_off(self):
+        return self.failures > 0
+
+    def interval(self):
+        with self._lock:
+            mode = self.mode
+            if mode == "printing" and time.monotonic() < self._burst_until:
+                mode = "heating"
+            interval = self._intervals[mode]
+            if self.failures:
+                interval = min(interval * (2 ** self.failures), max(self.backoff_max, interval))
+            return interval
+
+
+class TelemetryEngine(PrinterCallback):
+    """Change-driven telemetry for the bridge.
+
+    Subscribes to OctoPrint's printer callbacks and forwards every push to
+    ``update_cb(printer_data, temperature_data)``. The plugin builds a snapshot
+    from that data and hands it back through :meth:`submit`, which only emits it
+    when it differs meaningfully from the last snapshot sent (outside of the
+    configured deadbands) or when the heartbeat interval, picked by the
+    :class:`CadenceScheduler`, has expired.
+
+    Changes to the ``deferred`` keys alone don't count as meaningful, the
+    owner sends those itself with ``force`` (the plugin does for the printer
+    state once its event queue has coalesced the events). The :attr:`PASSIVE`
+    keys never count either, they change all the time while printing and go
+    out with the next snapshot that is sent anyway.
+    """
+
+    PASSIVE = frozenset(("time_printing", "time_remaining", "axis_z", "layer"))
+
+    def __init__(self, printer, update_cb, cadence=None, temp_deadband=0.5, progress_deadband=1.0, deferred=(),
+                 logger=None):
+        self._printer = printer
+        self._update_cb = update_cb
+        self._logger = logger or logging.getLogger("octoprint.plugins.PrusaConnectBridge.telemetry")
+        self.cadence = cadence or CadenceScheduler()
+
+        self._lock = threading.RLock()
+        self._heartbeat_thread = None
+        self._stopped = threading.Event()
+        self._wakeup = threading.Event()
+        self._registered = False
+
+        # Latest data pushed by OctoPrint, reused by the heartbeat
+        self._current_data = None
+        self._temperatures = None
+
+        self._last_sent = None
+        self._last_sent_at = 0.0
+
+        self._ignored = self.PASSIVE | frozenset(deferred)
+        self._deadbands = {}
+        self._temp_deadband = 0.0
+        # How snapshots are compared to the last one sent, see _compile_plan
+        self._plan = None
+        self.configure(temp_deadband, progress_deadband)
+
+    def configure(self, temp_deadband=None, progress_deadband=None):
+        with self._lock:
+            if temp_deadband is not None:
+                # Applies to every temp_* key, whichever heaters the printer has
+                self._temp_deadband = float(temp_deadband)
+            if progress_deadband is not None:
+                self._deadbands["progress"] = float(progress_deadband)
+            self._plan = None
+        self.reschedule()
+
+    @property
+    def heartbeat_interval(self):
+        return self.cadence.interval()
+
+    ##~~ Lifecycle
+
+    def start(self):
+        with self._lock:
+            if not self._registered:
+                self._printer.register_callback(self)
+                self._registered = True
+            if self._heartbeat_thread is None:
+                # Each heartbeat thread gets its own stop event so a quick stop/start can't revive an old one
+                self._stopped = threading.Event()
+                self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, args=(self._stopped,),
+                                                          daemon=True, name="PrusaConnectTelemetryHeartbeat")
+                self._heartbeat_thread.start()
+        self._logger.info(f"Telemetry engine started (heartbeat: {self.heartbeat_interval}s).")
+
+    def stop(self):
+        with self._lock:
+            if self._registered:
+                try:
+                    self._printer.unregister_callback(self)
+                except Exception as e:
+                    self._logger.debug(f"Error unregistering telemetry printer callback: {e}")
+                self._registered = False
+            if self._heartbeat_thread is not None:
+                self._stopped.set()
+                self._wakeup.set()
+                self._heartbeat_thread = None
+            self._last_sent = None
+            self._last_sent_at = 0.0
+        self._logger.info("Telemetry engine stopped.")
+
+    def is_alive(self):
+        return self._heartbeat_thread is not None and self._heartbeat_thread.is_alive()
+
+    def reschedule(self):
+        """Wake the heartbeat up so it picks up a changed interval."""
+        self._wakeup.set()
+
+    ##~~ Snapshot handling
+
+    def submit(self, snapshot, emit, force=False):
+        """Emit ``snapshot`` through ``emit(snapshot)`` if it is worth sending.
+
+        Returns True if the snapshot was emitted.
+        """
+        with self._lock:
+            now = time.monotonic()
+            heartbeat_due = now - self._last_sent_at >= self.heartbeat_interval
+            if not force and not heartbeat_due:
+                # While backing off after send failures, changes wait for the next heartbeat
+                if self.cadence.backing_off or not self._has_changed(snapshot):
+                    return False
+            emit(snapshot)
+            self._last_sent = snapshot
+            self._last_sent_at = now
+            return True
+
+    def _has_changed(self, snapshot):
+        last = self._last_sent
+        if last is None:
+            return True
+        if len(snapshot) != len(last):
+            return self._differs(last, snapshot)
+        # Snapshots mostly have the keys of the last one, compared through a plan compiled for them
+        plan = self._plan
+        if plan is None or plan[0] != len(snapshot):
+            plan = self._plan = self._compile_plan(snapshot)
+        _, present, exact, banded = plan
+        try:
+            # With as many keys as the plan and all of them present, both have the plan's keys
+            present(snapshot)
+            present(last)
+            if exact(snapshot) != exact(last):
+                return True
+            for key, deadband in banded:
+                old = last[key]
+                new = snapshot[key]
+                if old != new and (old is None or new is None or abs(new - old) >= deadband):
+                    return True
+            return False
+        except KeyError:
+            # Same number of keys, but not the same keys
+            self._plan = None
+            return self._differs(last, snapshot)
+
+    def _compile_plan(self, snapshot):
+        """Returns (key count, getter of the ignored keys, getter of the exactly compared values,
+        (key, deadband) pairs) for the keys of ``snapshot``.
+        """
+        ignored = []
+        exact = []
+        banded = []
+        for key in snapshot:
+            if key in self._ignored:
+                ignored.append(key)
+                continue
+            deadband = self._deadband(key)
+            if deadband:
+                banded.append((key, deadband))
+            else:
+                exact.append(key)
+        # One C call fetches and one tuple comparison checks all the exact values
+        return len(snapshot), self._getter(ignored), self._getter(exact), tuple(banded)
+
+    @staticmethod
+    def _getter(keys):
+        return itemgetter(*keys) if keys else (lambda values: None)
+
+    def _deadband(self, key):
+        if key.startswith("temp_"):
+            return self._temp_deadband
+        return self._deadbands.get(key, 0.0)
+
+    def _differs(self, last, snapshot):
+        for key in last.keys() | snapshot.keys():
+            old = last.get(key)
+            new = snapshot.get(key)
+            if old == new or key in self._ignored:
+                continue
+            deadband = self._deadband(key)
+            if deadband and old is not None and new is not None and abs(new - old) < deadband:
+                continue
+            return True
+        return False
+
+    def _heartbeat_loop(self, stopped):
+        while not stopped.is_set():
+            # Sleep until the heartbeat is due, changes to the cadence wake us up early
+            remaining = self._last_sent_at + self.heartbeat_interval - time.monotonic()
+            if remaining > 0:
+                self._wakeup.wait(remaining)
+                self._wakeup.clear()
+                continue
+
+            try:
+                self._update_cb(self._current_data, self._temperatures)
+            except Exception as e:
+                self._logger.error(f"Error in telemetry heartbeat: {e}", exc_info=True)
+
+            if time.monotonic() - self._last_sent_at >= self.heartbeat_interval:
+                # Nothing was sent (e.g. no token yet), don't spin
+                self._wakeup.wait(self.heartbeat_interval)
+                self._wakeup.clear()
+
+    ##~~ PrinterCallback
+
+    def on_printer_add_temperature(self, data):
+        self._temperatures = data
+        self._update_cb(self._current_data, data)
+
+    def on_printer_send_current_data(self, data):
+        self._current_data = data
+        self._update_cb(data, self._temperatures)
+
+
+class TelemetryBuffer(object):
+    """Ring buffer of the telemetry Prusa Connect missed while the link was down.
+
+    Samples (timestamp, state, temperatures, targets and progress) are kept in
+    preallocated arrays, so the buffer takes the same memory however long the
+    outage lasts. :meth:`record` keeps at most one sample per ``interval``
+    seconds and skips samples equal to the previous one, and once the buffer is
+    full the oldest samples are overwritten.
+
+    After the link is back, :meth:`start_replay` sends the samples to Prusa
+    Connect with their original timestamps, oldest first. It starts after a
+    random delay of up to ``jitter`` seconds, so a fleet that reconnects after
+    the same outage doesn't hit Connect all at once, and it sends at most
+    ``rate`` samples per second. Connect has no batch endpoint, so every sample
+    is its own request over the pooled keep-alive connection.
+    """
+
+    FIELDS = ("temp_nozzle", "target_nozzle", "temp_bed", "target_bed", "progress")
+    STATES = tuple(const.State)
+
+    def __init__(self, capacity=1800, interval=2.0, rate=10.0, jitter=5.0, logger=None):
+        self._logger = logger or logging.getLogger("octoprint.plugins.PrusaConnectBridge.telemetry")
+        self.capacity = max(int(capacity), 1)
+        self.interval = float(interval)
+        self.rate = max(float(rate), 1.0)
+        self.jitter = max(float(jitter), 0.0)
+
+        self._lock = threading.Lock()
+        self._timestamps = array("d", [0.0]) * self.capacity
+        self._states = array("B", [0]) * self.capacity
+        # One column per field, NaN where the snapshot had None
+        self._columns = [array("d", [0.0]) * self.capacity for _ in self.FIELDS]
+        self._start = 0
+        self._count = 0
+        self._last_recorded_at = None
+        self._last_sample = None
+        # Samples overwritten because the buffer was full, and samples replayed
+        self.dropped = 0
+        self.replayed = 0
+
+        self._replay_thread = None
+        self._replay_stopped = threading.Event()
+
+    def __len__(self):
+        return self._count
+
+    def record(self, snapshot, timestamp=None):
+        """Buffers ``snapshot`` unless it equals the last sample or one was recorded less than ``interval`` seconds ago."""
+        now = time.monotonic()
+        sample = (snapshot["state"],) + tuple(snapshot.get(field) for field in self.FIELDS)
+        with self._lock:
+            if self._last_recorded_at is not None and now - self._last_recorded_at < self.interval:
+                return False
+            if sample == self._last_sample:
+                return False
+            self._last_recorded_at = now
+            self._last_sample = sample
+            index = (self._start + self._count) % self.capacity
+            if self._count == self.capacity:
+                self._start = (self._start + 1) % self.capacity
+                self.dropped += 1
+            else:
+                self._count += 1
+            self._timestamps[index] = timestamp if timestamp is not None else time.time()
+            self._states[index] = self.STATES.index(snapshot["state"])
+            for column, field in zip(self._columns, self.FIELDS):
+                value = snapshot.get(field)
+                column[index] = float(value) if value is not None else math.nan
+            return True
+
+    def take(self, limit):
+        """Removes and returns up to ``limit`` of the oldest samples as (timestamp, state, values)."""
+        samples = []
+        with self._lock:
+            for _ in range(min(limit, self._count)):
+                index = self._start
+                values = {}
+                for column, field in zip(self._columns, self.FIELDS):
+                    value = column[index]
+                    if not math.isnan(value):
+                        values[field] = value
+                samples.append((self._timestamps[index], self.STATES[self._states[index]], values))
+                self._start = (self._start + 1) % self.capacity
+                self._count -= 1
+            if not self._count:
+                self._last_recorded_at = None
+                self._last_sample = None
+        return samples
+
+    def clear(self):
+        with self._lock:
+            self._start = self._count = 0
+            self._last_recorded_at = None
+            self._last_sample = None
+
+    ##~~ Replay
+
+    def replaying(self):
+        return self._replay_thread is not None and self._replay_thread.is_alive()
+
+    def start_replay(self, printer):
+        """Starts sending the buffered samples through ``printer``'s queue. Returns False if there's nothing to do."""
+        with self._lock:
+            if not self._count or self.replaying():
+                return False
+            self._replay_stopped = threading.Event()
+            self._replay_thread = threading.Thread(target=self._replay_loop, args=(printer, self._replay_stopped),
+                                                   daemon=True, name="PrusaConnectTelemetryReplay")
+            self._replay_thread.start()
+            return True
+
+    def stop_replay(self):
+        self._replay_stopped.set()
+
+    def _replay_loop(self, printer, stopped):
+        if stopped.wait(random.uniform(0.0, self.jitter)):
+            return
+        self._logger.info(f"Replaying {self._count} buffered telemetry samples to Prusa Connect.")
+        per_second = int(self.rate)
+        sent = 0
+        while not stopped.is_set():
+            if link_down():
+                # Whatever is left waits for the next reconnect
+                self._logger.info(f"Prusa Connect unreachable again, pausing telemetry replay after {sent} samples.")
+                return
+            # Only top the queue up, live telemetry and events must not wait behind a backlog
+            if printer.queue.qsize() < per_second:
+                batch = self.take(per_second)
+                if not batch:
+                    break
+                for timestamp, state, values in batch:
+                    printer.queue.put(Telemetry(state, timestamp, **values))
+                sent += len(batch)
+                self.replayed += len(batch)
+            stopped.wait(1.0)
+        self._logger.info(f"Replayed {sent} buffered telemetry samples.")
+
+
+def link_down():
+    """True while the SDK's last request to Prusa Connect failed at the network or HTTP level."""
+    return INTERNET.state == CondState.NOK or HTTP.state == CondState.NOK
+
+
+class MachineState(object):
+    """What the printer does that OctoPrint's current data doesn't tell: fans, feedrate, flow and layer.
+
+    Fans, feedrate and flow are taken from the G-codes OctoPrint sends
+    (:meth:`on_gcode_sent`, fed from the ``gcode.sent`` hook, which only costs a
+    set lookup for every other command). Fan speeds are in percent of full
+    PWM, OctoPrint doesn't know their RPM. The layer counts the heights the
+    nozzle settled at while printing, going up (:meth:`on_z_change`, fed with the
+    coalesced Z changes), from the start of the print. A height the nozzle
+    comes back down from was a Z hop (or the lift of the start G-code), not a
+    layer, and stops counting once it does.
+    """
+
+    GCODES = frozenset(("M106", "M107", "M220", "M221"))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.fans = {} # fan index -> percent
+        self.speed = None # Feedrate factor in percent (M220)
+        self.flow = None # Flow factor in percent (M221)
+        self.layer = None
+        self._layers = [] # Z of each layer so far, ascending
+        # The snapshot fields, rebuilt on changes only
+        self.fields = {}
+
+    def on_gcode_sent(self, gcode, cmd):
+        params = {}
+        for word in cmd.split()[1:]:
+            try:
+                params[word[0].upper()] = float(word[1:])
+            except (ValueError, IndexError):
+                continue
+        with self._lock:
+            if gcode == "M106":
+                self.fans[int(params.get("P", 0))] = round(min(max(params.get("S", 255.0), 0.0), 255.0) * 100.0 / 255.0)
+            elif gcode == "M107":
+                self.fans[int(params.get("P", 0))] = 0
+            elif gcode == "M220" and "S" in params:
+                self.speed = int(params["S"])
+            elif gcode == "M221" and "S" in params:
+                self.flow = int(params["S"])
+            self._update_fields()
+
+    def on_z_change(self, z):
+        if z is None:
+            return
+        with self._lock:
+            layers = self._layers
+            count = len(layers)
+            # Settled below the heights counted last, those were hops
+            while layers and z < layers[-1] - 0.001:
+                layers.pop()
+            if not layers or z > layers[-1] + 0.001:
+                layers.append(z)
+            if len(layers) != count:
+                self.layer = len(layers)
+                self._update_fields()
+
+    def print_started(self):
+        with self._lock:
+            self.layer = None
+            self._layers = []
+            self._update_fields()
+
+    def _update_fields(self):
+        fields = {}
+        for index, percent in self.fans.items():
+            fields["fan_print" if index == 0 else f"fan_print_{index}"] = percent
+        for key, value in (("speed", self.speed), ("flow", self.flow), ("layer", self.layer)):
+            if value is not None:
+                fields[key] = value
+        # Replaced, never changed in place, so snapshots can read it without the lock
+        self.fields = fields
+
+
+class SnapshotBuilder(object):
+    """Maps OctoPrint's current data and temperatures to Prusa Connect telemetry snapshots.
+
+    Both are expected in the layout of OctoPrint's printer callbacks, which is
+    also what its REST API returns. Every heater OctoPrint reports is sent
+    (``tool0`` as ``temp_nozzle``/``target_nozzle``, ``toolN`` as ``temp_nozzle_N``,
+    ``bed`` and ``chamber`` as ``temp_bed`` and ``temp_chamber``), together with
+    the print times, Z height and what ``machine`` (a :class:`MachineState`)
+    knows. With ``times`` (a :class:`~.timeindex.TimeIndexCache`) the time
+    remaining of a local print comes from the time index of its file at the
+    current file position, instead of OctoPrint's estimate.
+
+    The fields are read through a field map compiled when the set of heaters
+    changes, so a tick is a flat loop over precomputed (snapshot key, key)
+    entries, and more fields don't mean more conditionals per tick.
+    """
+
+    # Heaters by OctoPrint name, toolN beyond these is nozzle_N
+    HEATERS = {"tool0": "nozzle", "bed": "bed", "chamber": "chamber"}
+
+    # Sections of OctoPrint's current data sent while printing or paused, with their (snapshot key, key) fields
+    JOB_FIELDS = (
+        ("progress", (("progress", "completion"), ("time_printing", "printTime"), ("time_remaining", "printTimeLeft"))),
+    )
+
+    # Sent even without a temperature report, as before
+    BASE = dict(temp_nozzle=0.0, target_nozzle=0.0, temp_bed=0.0, target_bed=0.0)
+
+    PRINTING = const.State.PRINTING
+    PAUSED = const.State.PAUSED
+    ERROR = const.State.ERROR
+    ATTENTION = const.State.ATTENTION
+    READY = const.State.READY
+
+    def __init__(self, machine=None, times=None):
+        self.machine = machine
+        self.times = times
+        self._heater_count = -1
+        # (actual key, target key, OctoPrint heater name) per heater
+        self._temperature_fields = ()
+
+    def _compile(self, heaters):
+        fields = []
+        for name in sorted(heaters):
+            suffix = self.HEATERS.get(name)
+            if suffix is None:
+                if not name.startswith("tool") or not name[4:].isdigit():
+                    continue # Not a heater, e.g. OctoPrint's "time" entry in the REST layout
+                suffix = f"nozzle_{name[4:]}"
+            fields.append((f"temp_{suffix}", f"target_{suffix}", name))
+        self._heater_count = len(heaters)
+        self._temperature_fields = tuple(fields)
+
+    def build(self, printer_data, temperature_data):
+        """Returns the snapshot and whether a heater is still heating up to its target."""
+        # State Mapping, the states are looked up once, an enum attribute costs more than a dict lookup
+        octo_state = printer_data["state"]["flags"]
+        active = False
+
+        if octo_state["printing"]:
+            prusa_state = self.PRINTING
+            active = True
+        elif octo_state["paused"]:
+            prusa_state = self.PAUSED
+            active = True
+        elif octo_state["error"] or octo_state["closedOrError"]:
+            prusa_state = self.ERROR
+        elif not octo_state["operational"]:
+            prusa_state = self.ATTENTION
+        else:
+            prusa_state = self.READY
+        # Add other states if necessary, e.g., FINISHING based on OctoPrint events later.
+
+        snapshot = self.BASE.copy()
+        snapshot["state"] = prusa_state
+        snapshot["progress"] = None
+        snapshot["print_file"] = None
+        heating = False
+
+        # Temperature Data, missing or None values count as 0.0
+        if temperature_data:
+            if len(temperature_data) != self._heater_count:
+                self._compile(temperature_data)
+            for actual_key, target_key, name in self._temperature_fields:
+                heater = temperature_data.get(name)
+                if not heater:
+                    if name not in temperature_data:
+                        self._heater_count = -1 # Another heater took its place, compile again next time
+                    continue
+                actual = snapshot[actual_key] = heater["actual"] or 0.0
+                target = snapshot[target_key] = heater["target"] or 0.0
+                if target and actual < target - HEATING_MARGIN:
+                    heating = True
+
+        z = printer_data.get("currentZ")
+        if z is not None:
+            snapshot["axis_z"] = z
+
+        # Print Progress, times and File
+        if active:
+            for section, fields in self.JOB_FIELDS:
+                values = printer_data.get(section)
+                if values:
+                    for key, field in fields:
+                        value = values.get(field)
+                        if value is not None:
+                            snapshot[key] = round(value) # The SDK expects ints, progress 0-100
+            job_file = (printer_data.get("job") or {}).get("file")
+            if job_file:
+                snapshot["print_file"] = job_file.get("name")
+                if self.times is not None and job_file.get("origin") == "local":
+                    self._indexed_times(snapshot, job_file.get("path"), printer_data.get("progress"))
+
+        if self.machine is not None:
+            snapshot.update(self.machine.fields)
+        return snapshot, heating
+
+    def _indexed_times(self, snapshot, path, progress):
+        position = progress.get("filepos") if progress else None
+        if path is None or position is None:
+            return
+        # None until the index is loaded in the background, OctoPrint's estimate stays until then
+        index = self.times.get(path)
+        if index is not None:
+            snapshot["time_remaining"] = round(index.remaining(position))
+            if "time_printing" not in snapshot:
+                snapshot["time_printing"] = round(index.elapsed(position))
+
+
+def send_snapshot(printer, snapshot, source=const.Source.FIRMWARE):
+    """Queues ``snapshot`` on the SDK ``printer``.
+
+    ``Printer.telemetry`` ignores a state argument and reports the printer's
+    own state, so a changed state goes through ``set_state`` first.
+    """
+    snapshot = dict(snapshot)
+    state = snapshot.pop("state", None)
+    if state is not None and state != printer.state:
+        printer.set_state(state, source)
+    printer.telemetry(**snapshot)
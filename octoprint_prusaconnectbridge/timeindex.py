@@ -0,0 +1,396 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from bisect import bisect_right
+
+# Markers kept per file at most, moves are sampled at least this many bytes apart
+MAX_MARKERS = 8192
+MIN_SPACING = 4096
+
+# "M73 P12 R34" as PrusaSlicer writes it, R is the time remaining in minutes. Q/S are the silent mode.
+M73_REMAINING = re.compile(rb"\sR(\d+(?:\.\d*)?)")
+# Cura writes the total in its header and the time elapsed after every layer
+CURA_TOTAL = b";TIME:"
+CURA_ELAPSED = b";TIME_ELAPSED:"
+
+MOVES = frozenset((b"G0", b"G1", b"G2", b"G3"))
+DEFAULT_FEEDRATE = 1500.0 # mm/min, until the file sets one
+
+
+class TimeIndex(object):
+    """Estimated print time elapsed at byte offsets of a G-code file.
+
+    Two parallel arrays, offsets ascending and seconds not descending, looked
+    up with a binary search and interpolated between neighbouring markers, so
+    a lookup is O(log n) and doesn't touch the file. ``source`` tells where the
+    times came from: ``m73``, ``cura`` or ``moves``.
+    """
+
+    __slots__ = ("path", "offsets", "seconds", "total", "source")
+
+    def __init__(self, path, offsets, seconds, source, total=None):
+        self.path = path
+        self.offsets = offsets
+        self.seconds = seconds
+        self.source = source
+        self.total = max(total or 0.0, seconds[-1] if seconds else 0.0)
+
+    def elapsed(self, position):
+        """Seconds of the print done when the printer has read ``position`` bytes of the file."""
+        offsets = self.offsets
+        i = bisect_right(offsets, position)
+        if i == 0:
+            return 0.0
+        if i == len(offsets):
+            return self.total
+        start = offsets[i - 1]
+        before = self.seconds[i - 1]
+        return before + (self.seconds[i] - before) * (position - start) / (offsets[i] - start)
+
+    def remaining(self, position):
+        return max(self.total - self.elapsed(position), 0.0)
+
+
+class _MoveClock(object):
+    """Print time of G-code moves, as distance over feedrate without acceleration.
+
+    Arcs count as their chord, so files without slicer times come out a little short.
+    """
+
+    def __init__(self):
+        self.position = [0.0, 0.0, 0.0, 0.0] # X, Y, Z, E
+        self.feedrate = DEFAULT_FEEDRATE / 60.0 # mm/s
+        self.absolute = True
+        self.absolute_e = True
+        self.seconds = 0.0
+
+    def line(self, line):
+        words = line.split(b";", 1)[0].upper().split()
+        if not words:
+            return
+        command = words[0]
+        if command in MOVES:
+            self._move(words)
+        elif command == b"G4":
+            for word in words[1:]:
+                if word[:1] == b"P":
+                    self.seconds += float(word[1:]) / 1000.0
+                elif word[:1] == b"S":
+                    self.seconds += float(word[1:])
+        elif command == b"G90":
+            self.absolute = self.absolute_e = True
+        elif command == b"G91":
+            # Marlin and Prusa firmware move E relative too
+            self.absolute = self.absolute_e = False
+        elif command == b"M82":
+            self.absolute_e = True
+        elif command == b"M83":
+            self.absolute_e = False
+        elif command in (b"G92", b"G28"):
+            axes = [word for word in words[1:] if word[:1] in b"XYZE"]
+            if not axes and command == b"G28":
+                axes = [b"X0", b"Y0", b"Z0"]
+            for word in axes:
+                self.position[b"XYZE".index(word[:1])] = float(word[1:] or 0.0)
+
+    def _move(self, words):
+        position = self.position
+        x, y, z, e = position
+        absolute = self.absolute
+        for word in words[1:]:
+            letter = word[:1]
+            value = float(word[1:])
+            if letter == b"X":
+                x = value if absolute else x + value
+            elif letter == b"Y":
+                y = value if absolute else y + value
+            elif letter == b"Z":
+                z = value if absolute else z + value
+            elif letter == b"E":
+                e = value if self.absolute_e else e + value
+            elif letter == b"F" and value > 0.0:
+                self.feedrate = value / 60.0
+        dx, dy, dz = x - position[0], y - position[1], z - position[2]
+        distance = math.sqrt(dx * dx + dy * dy + dz * dz) or abs(e - position[3])
+        self.position = [x, y, z, e]
+        self.seconds += distance / self.feedrate
+
+
+def build(disk_path, path=None):
+    """Reads a G-code file once and returns its :class:`TimeIndex`, or None if no time could be told.
+
+    The slicer's own times are used when the file has them: PrusaSlicer's
+    ``M73 ... R`` remaining minutes, or Cura's ``;TIME_ELAPSED`` per layer.
+    Otherwise the time is estimated from the moves. Moves are sampled every
+    few KB, so a file gets at most :data:`MAX_MARKERS` markers whatever its size.
+    """
+    markers = [] # (offset, remaining seconds) for M73, (offset, elapsed seconds) for Cura
+    source = None
+    cura_total = None
+    clock = _MoveClock()
+    moves = [array("q"), array("d")]
+    with open(disk_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        spacing = max(MIN_SPACING, size // MAX_MARKERS)
+        next_sample = 0
+        offset = 0
+        for line in f:
+            start = offset
+            offset += len(line)
+            first = line[:1]
+            if first == b";":
+                try:
+                    if line.startswith(CURA_ELAPSED) and source != "m73":
+                        markers.append((offset, float(line[len(CURA_ELAPSED):])))
+                        source = "cura"
+                    elif line.startswith(CURA_TOTAL):
+                        cura_total = float(line[len(CURA_TOTAL):])
+                except ValueError:
+                    pass
+                continue
+            if line.startswith(b"M73 "):
+                match = M73_REMAINING.search(line)
+                if match is not None and source != "cura":
+                    source = "m73"
+                    markers.append((start, float(match.group(1)) * 60.0))
+                continue
+            if source is not None or first not in b"GMgm" or not first:
+                # The slicer's times win, moves are only estimated until they show up
+                continue
+            try:
+                clock.line(line)
+            except (ValueError, IndexError):
+                continue # A malformed line costs no time
+            if offset >= next_sample:
+                # The time once this line is done
+                moves[0].append(offset)
+                moves[1].append(clock.seconds)
+                next_sample = offset + spacing
+
+    if source == "m73":
+        # Elapsed is what the first marker had left minus what this one has
+        total = markers[0][1]
+        offsets, seconds = array("q"), array("d")
+        elapsed = 0.0
+        for marker_offset, remaining in markers:
+            elapsed = max(elapsed, total - remaining)
+            offsets.append(marker_offset)
+            seconds.append(elapsed)
+        return TimeIndex(path, offsets, seconds, source, total=total)
+    if source == "cura":
+        offsets, seconds = array("q", [0]), array("d", [0.0])
+        for marker_offset, elapsed in markers:
+            offsets.append(marker_offset)
+            seconds.append(max(elapsed, seconds[-1]))
+        return TimeIndex(path, offsets, seconds, source, total=cura_total)
+    if not clock.seconds:
+        return None
+    offsets, seconds = moves
+    offsets.append(size)
+    seconds.append(clock.seconds)
+    return TimeIndex(path, offsets, seconds, "moves")
+
+
+class TimeIndexCache(object):
+    """Time indexes of G-code files, built once per file and kept in SQLite, keyed by (path, mtime, size).
+
+    Indexes are built on a worker thread: for files handed to :meth:`request`
+    (uploads), and for the file :meth:`get` is asked about if it has none yet.
+    The index of the file being printed is kept in memory, :meth:`get` returns
+    it without locking or touching the disk, so it can run on every telemetry
+    tick. ``resolve(path)`` maps a storage path to the file on disk.
+    """
+
+    # Seconds before a file that couldn't be indexed is checked for a new version
+    RETRY_INTERVAL = 10.0
+
+    def __init__(self, db_path, resolve, logger=None, metrics=None):
+        self._db_path = db_path
+        self._resolve = resolve
+        self._logger = logger or logging.getLogger("octoprint.plugins.PrusaConnectBridge.timeindex")
+        self._metrics = metrics
+
+        self._lock = threading.RLock()
+        self._db = None
+        self._entries = {} # path -> (mtime, size) of the indexes in the database
+        # path -> ((mtime, size) or None if missing, time.monotonic() checked) of files without an index,
+        # tried again once the file changed
+        self._failed = {}
+        self._queue = {} # path -> whether to load it as the current index, insertion ordered
+        self._current = None # TimeIndex of the file being printed
+        self._wakeup = threading.Condition(self._lock)
+        self._worker = None
+        self._stopped = threading.Event()
+
+    ##~~ Lifecycle
+
+    def open(self):
+        with self._lock:
+            if self._db is not None:
+                return
+            self._db = sqlite3.connect(self._db_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS time_index (path TEXT PRIMARY KEY, mtime INTEGER, "
+                             "size INTEGER, source TEXT, total REAL, offsets BLOB, seconds BLOB)")
+            self._entries = {path: (mtime, size) for path, mtime, size
+                             in self._db.execute("SELECT path, mtime, size FROM time_index")}
+            self._stopped = threading.Event()
+            self._worker = threading.Thread(target=self._run, args=(self._stopped,), daemon=True,
+                                            name="PrusaConnectTimeIndex")
+            self._worker.start()
+        self._logger.info(f"Time index cache opened with {len(self._entries)} entries.")
+
+    def close(self):
+        with self._lock:
+            if self._db is None:
+                return
+            self._stopped.set()
+            self._queue.clear()
+            self._wakeup.notify_all()
+            self._worker = None
+            self._current = None
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+    ##~~ Access
+
+    def get(self, path):
+        """The index of the file at ``path``, or None while it is loaded or built in the background."""
+        current = self._current
+        if current is not None and current.path == path:
+            return current
+        self.request(path, load=True)
+        return None
+
+    def request(self, path, load=False):
+        """Builds the index of ``path`` in the background unless it has a fresh one, and loads it if ``load``."""
+        with self._lock:
+            if self._db is None or not self._retry(path):
+                return
+            if path in self._queue:
+                self._queue[path] = self._queue[path] or load
+                return
+            if not load and path in self._entries:
+                return # Checked against the file when it is loaded
+            self._queue[path] = load
+            self._wakeup.notify()
+
+    def forget(self, path):
+        """Drops the indexes of the file or folder at ``path``."""
+        prefix = path + "/"
+        with self._lock:
+            for known in [known for known in self._entries if known == path or known.startswith(prefix)]:
+                del self._entries[known]
+            for mapping in (self._failed, self._queue):
+                for known in [known for known in mapping if known == path or known.startswith(prefix)]:
+                    del mapping[known]
+            current = self._current
+            if current is not None and (current.path == path or current.path.startswith(prefix)):
+                self._current = None
+            if self._db is not None:
+                self._db.execute("DELETE FROM time_index WHERE path = ? OR substr(path, 1, ?) = ?",
+                                 (path, len(prefix), prefix))
+                self._db.commit()
+
+    def _retry(self, path):
+        """Whether ``path`` may be indexed, False while it is the version that failed before."""
+        failed = self._failed.get(path)
+        if failed is None:
+            return True
+        key, checked = failed
+        now = time.monotonic()
+        if now - checked < self.RETRY_INTERVAL:
+            return False
+        # Overwriting a file only fires FILE_ADDED, so a new version is told by its modification time and size
+        if self._stat_key(path) == key:
+            self._failed[path] = (key, now)
+            return False
+        del self._failed[path]
+        return True
+
+    def _stat_key(self, path):
+        try:
+            stat = os.stat(self._resolve(path))
+        except (OSError, TypeError, ValueError):
+            return None
+        return (int(stat.st_mtime), stat.st_size)
+
+    def _fail(self, path, key):
+        self._count("error" if key is None else "empty")
+        with self._lock:
+            self._failed[path] = (key, time.monotonic())
+
+    ##~~ Worker
+
+    def _run(self, stopped):
+        while True:
+            with self._lock:
+                while not self._queue and not stopped.is_set():
+                    self._wakeup.wait()
+                if stopped.is_set():
+                    return
+                path = next(iter(self._queue))
+                load = self._queue.pop(path)
+            try:
+                index = self._index(path)
+            except Exception as e:
+                self._logger.debug(f"Could not build the time index of {path}: {e}")
+                continue
+            if load and index is not None:
+                self._current = index
+
+    def _index(self, path):
+        key = self._stat_key(path)
+        if key is None:
+            # Gone or not resolvable, not looked for again on every telemetry tick
+            self._fail(path, None)
+            return None
+        with self._lock:
+            if self._db is None:
+                return None
+            if self._entries.get(path) == key:
+                row = self._db.execute("SELECT source, total, offsets, seconds FROM time_index WHERE path = ?",
+                                       (path,)).fetchone()
+                if row is not None:
+                    self._count("loaded")
+                    offsets, seconds = array("q"), array("d")
+                    offsets.frombytes(row[2])
+                    seconds.frombytes(row[3])
+                    return TimeIndex(path, offsets, seconds, row[0], total=row[1])
+
+        start = time.perf_counter()
+        try:
+            index = build(self._resolve(path), path)
+        except Exception:
+            self._fail(path, key)
+            raise
+        finally:
+            if self._metrics is not None:
+                self._metrics.observe("prusaconnect_time_index_seconds", time.perf_counter() - start)
+        with self._lock:
+            if index is None:
+                self._count("empty")
+                self._failed[path] = (key, time.monotonic())
+                return None
+            self._count("built")
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO time_index VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 (path, key[0], key[1], index.source, index.total,
+                                  index.offsets.tobytes(), index.seconds.tobytes()))
+                self._db.commit()
+                self._entries[path] = key
+        self._logger.debug(f"Built the time index of {path} from {index.source}: {len(index.offsets)} markers, "
+                           f"{index.total:.0f} s in {time.perf_counter() - start:.2f} s.")
+        return index
+
+    def _count(self, result):
+        if self._metrics is not None:
+            self._metrics.inc("prusaconnect_time_index_total", result=result)
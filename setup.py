@@ -54,6 +54,8 @@ def params():
  
 	# Rrequirements:
 	install_requires = ["prusa-connect-sdk-printer>=0.7.1"]
+	# Downscaling of webcam snapshots, they are sent as the webcam delivers them without it
+	extras_require = {"camera": ["Pillow"]}
 
 
 	# Hook the plugin into the "octoprint.plugin" entry point, mapping the plugin_identifier to the plugin_package.
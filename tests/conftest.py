@@ -0,0 +1,56 @@
+# coding=utf-8
+import os
+import sys
+
+import pytest
+
+# The plugin is tested from the checkout, as the benchmarks run it
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+class LocalFileManager(object):
+    """The parts of OctoPrint's file manager the file index uses, over a folder of the test's."""
+
+    def __init__(self, basedir):
+        self.basedir = str(basedir)
+
+    def list_files(self, recursive=True, locations=None, path=None):
+        return {"local": self._listing(os.path.join(self.basedir, *(path or "").strip("/").split("/")))}
+
+    def _listing(self, folder):
+        listing = {}
+        for name in sorted(os.listdir(folder)):
+            disk_path = os.path.join(folder, name)
+            stat = os.stat(disk_path)
+            if os.path.isdir(disk_path):
+                listing[name] = dict(type="folder", date=int(stat.st_mtime), children=self._listing(disk_path))
+            elif name.endswith(".gcode"):
+                listing[name] = dict(type="machinecode", size=stat.st_size, date=int(stat.st_mtime))
+        return listing
+
+    def path_on_disk(self, storage, path):
+        return os.path.join(self.basedir, *path.strip("/").split("/"))
+
+    def get_basedir(self, storage):
+        return self.basedir
+
+    def get_metadata(self, storage, path):
+        return {}
+
+    def write(self, path, content=b"G28\n", mtime=None):
+        """Writes a file into the folder, as an upload would."""
+        disk_path = self.path_on_disk("local", path)
+        os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+        with open(disk_path, "wb") as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(disk_path, (mtime, mtime))
+        return disk_path
+
+
+@pytest.fixture
+def file_manager(tmp_path):
+    uploads = tmp_path / "uploads"
+    uploads.mkdir()
+    return LocalFileManager(uploads)
+
@@ -0,0 +1,173 @@
+# coding=utf-8
+"""The async core's HTTP/1.1 client parses responses and reuses connections, commands are parsed off its loop."""
+from __future__ import absolute_import
+
+import asyncio
+import threading
+
+import pytest
+from prusa.connect.printer import const
+from prusa.connect.printer.models import Telemetry
+
+from octoprint_prusaconnectbridge.asynccore import AsyncCore, AsyncHTTP, ProtocolError, Response, proxy_for
+
+
+class _Server(object):
+    """Answers each request on a connection with the next of ``responses``, a list of byte strings or of chunks."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.connections = 0
+        self.requests = []
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while self.responses:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":")[1])
+                self.requests.append(head + await reader.readexactly(length))
+                response = self.responses.pop(0)
+                for chunk in response if isinstance(response, list) else [response]:
+                    writer.write(chunk)
+                    await writer.drain()
+                    await asyncio.sleep(0.01)
+                if b"Connection: close" in b"".join(response if isinstance(response, list) else [response]):
+                    break
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            writer.close()
+
+
+def _run(responses, requests=1, method="GET"):
+    """Sends ``requests`` requests to a server answering with ``responses``, returns (responses, client, server)."""
+    server = _Server(responses)
+
+    async def main():
+        listening = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+        port = listening.sockets[0].getsockname()[1]
+        http = AsyncHTTP(connections=1, timeout=5.0)
+        try:
+            results = [await http.request(method, f"http://127.0.0.1:{port}/p/telemetry?x=1", body=b"{}")
+                       for _ in range(requests)]
+        finally:
+            await http.close()
+            listening.close()
+            await listening.wait_closed()
+        return results, http
+
+    results, http = asyncio.run(main())
+    return results, http, server
+
+
+##~~ Parsing
+
+def test_status_line_and_headers():
+    (response,), _, server = _run([b"HTTP/1.1 200 OK\r\nCommand-Id: 7\r\ncontent-type: application/json\r\n"
+                                   b"Content-Length: 17\r\n\r\n{\"command\": \"X\"}\n"], method="POST")
+
+    assert response.status_code == 200
+    assert response.reason == "OK"
+    assert response.headers["command-id"] == "7"
+    assert response.headers["Content-Type"] == "application/json"
+    assert response.json() == {"command": "X"}
+    assert server.requests[0].startswith(b"POST /p/telemetry?x=1 HTTP/1.1\r\nHost: 127.0.0.1:")
+    assert server.requests[0].endswith(b"Content-Length: 2\r\n\r\n{}")
+
+
+def test_interim_responses_skipped():
+    (response,), _, _ = _run([b"HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 204 No Content\r\n\r\n"])
+
+    assert response.status_code == 204
+    assert response.content == b""
+
+
+def test_invalid_status_line():
+    with pytest.raises(ProtocolError):
+        _run([b"HTTP/1.1 OK\r\n\r\n"])
+
+
+def test_chunked_body():
+    (response,), _, _ = _run([[b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n",
+                               b"5;ext=1\r\nhello\r\n", b"6\r\n world\r\n", b"0\r\nX-Trailer: 1\r\n\r\n"]])
+
+    assert response.content == b"hello world"
+
+
+def test_body_until_eof():
+    # No Content-Length and not chunked, the body arrives in several writes and ends with the connection
+    (response,), http, _ = _run([[b"HTTP/1.1 200 OK\r\n\r\n", b"first ", b"second ", b"third"]])
+
+    assert response.content == b"first second third"
+    # Not kept for another request
+    assert set(http._open.values()) == {0}
+
+
+##~~ Connections
+
+def test_keep_alive_reuses_the_connection():
+    responses = [b"HTTP/1.1 204 No Content\r\n\r\n"] * 3
+    results, http, server = _run(responses, requests=3)
+
+    assert [r.status_code for r in results] == [204] * 3
+    assert server.connections == 1
+    assert http.connections_opened == 1
+    assert http.requests_sent == 3
+
+
+def test_connection_close_opens_a_new_one():
+    responses = [b"HTTP/1.1 200 OK\r\nConnection: close\r\nContent-Length: 1\r\n\r\na",
+                 b"HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\nb"]
+    results, http, server = _run(responses, requests=2)
+
+    assert [r.content for r in results] == [b"a", b"b"]
+    assert server.connections == 2
+    assert http.connections_opened == 2
+
+
+##~~ Proxies
+
+def test_proxy_for(monkeypatch):
+    for name in ("HTTP_PROXY", "http_proxy", "HTTPS_PROXY", "https_proxy", "NO_PROXY", "no_proxy", "ALL_PROXY",
+                 "all_proxy"):
+        monkeypatch.delenv(name, raising=False)
+    assert proxy_for("https://connect.prusa3d.com") is None
+
+    monkeypatch.setenv("HTTPS_PROXY", "http://proxy.example:3128")
+    assert proxy_for("https://connect.prusa3d.com") == "http://proxy.example:3128"
+
+    monkeypatch.setenv("NO_PROXY", "connect.prusa3d.com")
+    assert proxy_for("https://connect.prusa3d.com") is None
+
+
+##~~ Commands
+
+class _Printer(object):
+    def __init__(self):
+        self.parsed_on = None
+
+    def parse_command(self, response):
+        self.parsed_on = threading.current_thread()
+
+    def deduce_state_from_code(self, status_code):
+        pass
+
+
+def test_commands_parsed_off_the_loop():
+    printer = _Printer()
+    core = AsyncCore(printer)
+
+    async def main():
+        core._loop = asyncio.get_running_loop()
+        core._commands = asyncio.Event()
+        response = Response("http://connect/p/telemetry", 200, "OK", {}, b"")
+        await core._handle_response(Telemetry(const.State.IDLE), response)
+        return core._commands.is_set()
+
+    assert asyncio.run(main())
+    assert printer.parsed_on is not None
+    assert printer.parsed_on is not threading.current_thread()
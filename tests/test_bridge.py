@@ -0,0 +1,73 @@
+# coding=utf-8
+"""PrinterBridge polls its instances concurrently, an instance that is slow to answer holds up no other."""
+from __future__ import absolute_import
+
+import http.server
+import json
+import threading
+import time
+
+import pytest
+
+from octoprint_prusaconnectbridge.bridge import PrinterBridge
+
+FLAGS = dict(operational=True, printing=False, paused=False, pausing=False, cancelling=False, error=False,
+             closedOrError=False, ready=True, sdReady=False, finishing=False, resuming=False)
+
+
+class _OctoPrint(http.server.BaseHTTPRequestHandler):
+    """OctoPrint instances under /fast and /slow, the slow one answers after ``server.delay`` seconds."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        instance = self.path.split("/")[1]
+        self.server.polls[instance] = self.server.polls.get(instance, 0) + 1
+        if instance == "slow":
+            time.sleep(self.server.delay)
+        body = json.dumps(dict(state=dict(text="Operational", flags=FLAGS),
+                               temperature=dict(tool0=dict(actual=25.0, target=0.0)))).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def octoprint():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _OctoPrint)
+    server.daemon_threads = True
+    server.polls = {}
+    server.delay = 2.0
+    thread = threading.Thread(target=server.serve_forever, kwargs=dict(poll_interval=0.05), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _config(octoprint, instance, sn):
+    return dict(name=instance, url=f"http://127.0.0.1:{octoprint.server_address[1]}/{instance}", api_key="key",
+                sn=sn, fingerprint=sn.ljust(64, "0"), token=None)
+
+
+def test_slow_instance_holds_up_no_other(octoprint):
+    bridge = PrinterBridge("http://127.0.0.1:9", poll_interval=0.1)
+    slow = bridge.add(_config(octoprint, "slow", "SLOW"))
+    fast = bridge.add(_config(octoprint, "fast", "FAST"))
+    bridge.start()
+    try:
+        time.sleep(1.0)
+        # The slow instance is still answering its first poll meanwhile
+        assert octoprint.polls.get("slow") == 1
+        assert slow.polling is not None
+        assert octoprint.polls.get("fast", 0) >= 5
+        assert fast.reachable
+    finally:
+        bridge.stop()
+        for bridged in bridge.printers:
+            bridge.remove(bridged.sn)
@@ -0,0 +1,111 @@
+# coding=utf-8
+"""Config snapshots load the plugin settings and write back only what changed, saving once."""
+from __future__ import absolute_import
+
+import pytest
+
+from octoprint_prusaconnectbridge.config import Config, settings_defaults
+
+
+class _Settings(object):
+    """Plugin settings backed by a dict, recording what is set and saved."""
+
+    def __init__(self, **values):
+        self.values = settings_defaults()
+        self.values.update(values)
+        self.sets = []
+        self.saves = []
+
+    def get(self, path, **kwargs):
+        return self.values.get(path[0])
+
+    def get_boolean(self, path, **kwargs):
+        return bool(self.get(path))
+
+    def get_int(self, path, **kwargs):
+        value = self.get(path)
+        return int(value) if value is not None else None
+
+    def get_float(self, path, **kwargs):
+        value = self.get(path)
+        return float(value) if value is not None else None
+
+    def set(self, path, value, **kwargs):
+        self.sets.append(path[0])
+        self.values[path[0]] = value
+
+    def save(self, trigger_event=False, **kwargs):
+        self.saves.append(trigger_event)
+
+
+BRIDGED = dict(name="mk4", url="http://mk4.local", api_key="key", sn="SN1", fingerprint="f" * 64, token=None)
+
+
+@pytest.fixture
+def settings():
+    return _Settings(prusa_connect_token="token", command_workers="3", bridged_printers=[BRIDGED])
+
+
+def test_load(settings):
+    config = Config.load(settings)
+
+    assert config.prusa_connect_token == "token"
+    assert config.command_workers == 3
+    assert config.telemetry_temp_deadband == 0.5
+    assert config.sdk_async_core is False
+    assert config.bridged_printers == (BRIDGED,)
+    # A copy, changing it doesn't reach OctoPrint's config
+    config.bridged_printers[0]["token"] = "changed"
+    assert settings.values["bridged_printers"][0]["token"] is None
+
+
+def test_write_sets_only_changes_and_saves_once(settings):
+    config = Config.load(settings)
+
+    updated = config.write(settings, dict(prusa_connect_token="new", prusa_connect_sn="SN", command_workers=3))
+
+    assert sorted(settings.sets) == ["prusa_connect_sn", "prusa_connect_token"]
+    assert settings.saves == [False]
+    assert (updated.prusa_connect_token, updated.prusa_connect_sn) == ("new", "SN")
+    assert config.prusa_connect_token == "token"
+
+
+def test_unchanged_write_saves_nothing(settings):
+    config = Config.load(settings)
+
+    assert config.write(settings, dict(prusa_connect_token="token", bridged_printers=[BRIDGED])) is config
+    assert config.write(settings, {}) is config
+    assert settings.sets == []
+    assert settings.saves == []
+
+
+def test_lists_written_as_lists(settings):
+    config = Config.load(settings)
+    added = dict(BRIDGED, name="xl", sn="SN2")
+
+    updated = config.write(settings, dict(bridged_printers=config.bridged_printers + (added,)))
+
+    assert settings.values["bridged_printers"] == [BRIDGED, added]
+    assert updated.bridged_printers == (BRIDGED, added)
+
+
+def test_write_passes_the_event_on(settings):
+    Config.load(settings).write(settings, dict(camera_token="camera"), trigger_event=True)
+
+    assert settings.saves == [True]
+
+
+def test_plugin_writes_through_its_snapshot(settings):
+    from octoprint_prusaconnectbridge import PrusaConnectBridgePlugin
+
+    plugin = PrusaConnectBridgePlugin()
+    plugin._settings = settings
+    plugin._config = Config.load(settings)
+
+    plugin._write_settings(prusa_connect_token="token")
+    assert settings.saves == []
+
+    plugin._write_settings(prusa_connect_token=None, prusa_connect_tmp_code=None)
+    assert settings.sets == ["prusa_connect_token"]
+    assert settings.saves == [False]
+    assert plugin._config.prusa_connect_token is None
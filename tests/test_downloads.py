@@ -0,0 +1,211 @@
+# coding=utf-8
+"""Downloads resume with Range and If-Range after an interruption and check the digest the server announces."""
+from __future__ import absolute_import
+
+import base64
+import hashlib
+import http.server
+import os
+import re
+import threading
+
+import pytest
+import requests
+from prusa.connect.printer import const
+from prusa.connect.printer.download import Transfer
+
+from octoprint_prusaconnectbridge.downloads import DownloadAborted, DownloadManager, _announced_sha256, _PartFile
+
+CONTENT = bytes(range(256)) * 400 # 100 KiB
+
+
+class _FileServer(http.server.BaseHTTPRequestHandler):
+    """Serves ``server.content`` with Range and If-Range, like a CDN would.
+
+    The first ``server.drops`` responses are cut off after ``server.drop_at``
+    bytes, ``server.digest`` is sent as Repr-Digest when set.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        content = server.content
+        start = 0
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        if match and self.headers.get("If-Range", server.etag) == server.etag:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start + server.range_skew}-{len(content) - 1}/{len(content)}")
+        else:
+            self.send_response(200)
+        body = content[start:]
+        self.send_header("Content-Type", "text/x.gcode")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", server.etag)
+        if server.digest:
+            self.send_header("Repr-Digest", server.digest)
+        self.end_headers()
+        if server.drops:
+            server.drops -= 1
+            self.wfile.write(body[:server.drop_at])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _sha256_header(content):
+    return "sha-256=:" + base64.b64encode(hashlib.sha256(content).digest()).decode() + ":"
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _FileServer)
+    server.daemon_threads = True
+    server.content = CONTENT
+    server.etag = '"v1"'
+    server.digest = _sha256_header(CONTENT)
+    server.drops = 0
+    server.drop_at = 0
+    server.range_skew = 0
+    server.requests = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/file.gcode"
+    thread = threading.Thread(target=server.serve_forever, kwargs=dict(poll_interval=0.05), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class _Printer(object):
+    server = None
+
+    def __init__(self, url):
+        self.transfer = Transfer()
+        self.transfer.start(const.TransferType.FROM_WEB, "/file.gcode", url)
+        self.events = []
+
+    def make_headers(self, timestamp=None):
+        return {}
+
+    def event_cb(self, event, source, **kwargs):
+        self.events.append(event)
+
+
+def _download(server, folder, retries=3):
+    manager = DownloadManager(_Printer(server.url), None, session=requests.Session(), chunk_size=4096,
+                              retries=retries)
+    manager.BACKOFF_MAX = 0.01
+    part = _PartFile(str(folder), "file.gcode", server.url, manager.chunk_size)
+    manager._download(part, server.url)
+    return part
+
+
+def _on_disk(part):
+    with open(part.path, "rb") as f:
+        return f.read()
+
+
+##~~ Resuming
+
+def test_interrupted_download_resumes_with_range(server, tmp_path):
+    server.drops, server.drop_at = 1, 8192
+
+    part = _download(server, tmp_path)
+
+    assert _on_disk(part) == CONTENT
+    assert part.digest.digest() == hashlib.sha256(CONTENT).digest()
+    first, second = server.requests
+    assert "Range" not in first
+    assert second["Range"] == "bytes=8192-"
+    assert second["If-Range"] == '"v1"'
+
+
+def test_changed_file_starts_over(server, tmp_path):
+    server.drops, server.drop_at = 1, 8192
+    with pytest.raises(DownloadAborted):
+        _download(server, tmp_path, retries=0)
+
+    # The file changed meanwhile, If-Range makes the server send it whole
+    server.content = CONTENT[::-1]
+    server.etag = '"v2"'
+    server.digest = _sha256_header(server.content)
+    part = _download(server, tmp_path)
+
+    assert server.requests[-1]["Range"] == "bytes=8192-"
+    assert _on_disk(part) == server.content
+
+
+def test_part_left_behind_is_resumed(server, tmp_path):
+    server.drops, server.drop_at = 1, 32768
+    with pytest.raises(DownloadAborted):
+        _download(server, tmp_path, retries=0)
+    assert os.path.getsize(tmp_path / ".file.gcode.part") == 32768
+
+    part = _download(server, tmp_path)
+
+    assert len(server.requests) == 2
+    assert server.requests[-1]["Range"] == "bytes=32768-"
+    assert _on_disk(part) == CONTENT
+    # Computed over the part on disk, then the rest as it arrived
+    assert part.digest.digest() == hashlib.sha256(CONTENT).digest()
+
+
+def test_part_of_another_url_not_resumed(server, tmp_path):
+    server.drops, server.drop_at = 1, 32768
+    with pytest.raises(DownloadAborted):
+        _download(server, tmp_path, retries=0)
+    server.url += "?other"
+
+    part = _download(server, tmp_path)
+
+    assert "Range" not in server.requests[-1]
+    assert _on_disk(part) == CONTENT
+
+
+def test_unexpected_content_range_starts_over(server, tmp_path):
+    server.drops, server.drop_at = 1, 8192
+    server.range_skew = 5
+
+    part = _download(server, tmp_path)
+
+    # The 206 from the wrong offset is dropped, the next request asks for the whole file
+    assert "Range" not in server.requests[-1]
+    assert _on_disk(part) == CONTENT
+
+
+##~~ Digests
+
+def test_digest_mismatch(server, tmp_path):
+    server.digest = _sha256_header(b"something else")
+
+    with pytest.raises(DownloadAborted, match="Checksum mismatch"):
+        _download(server, tmp_path)
+    assert os.path.getsize(tmp_path / ".file.gcode.part") == 0
+
+
+def test_without_digest(server, tmp_path):
+    server.digest = None
+
+    assert _on_disk(_download(server, tmp_path)) == CONTENT
+
+
+class _Headers(object):
+    def __init__(self, **headers):
+        self.headers = {name.replace("_", "-"): value for name, value in headers.items()}
+
+
+def test_announced_sha256():
+    digest = hashlib.sha256(b"x").digest()
+    encoded = base64.b64encode(digest).decode()
+
+    assert _announced_sha256(_Headers(Repr_Digest=f"sha-512=:AAAA:, sha-256=:{encoded}:")) == digest
+    # RFC 3230 style, without the colons
+    assert _announced_sha256(_Headers(Digest=f"SHA-256={encoded}")) == digest
+    assert _announced_sha256(_Headers(Digest="md5=AAAA")) is None
+    assert _announced_sha256(_Headers()) is None
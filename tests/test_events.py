@@ -0,0 +1,153 @@
+# coding=utf-8
+"""EventQueue coalesces events per key, the latest winning, within its window and up to its maximum delay."""
+from __future__ import absolute_import
+
+import threading
+import time
+
+import pytest
+
+from octoprint_prusaconnectbridge import events
+from octoprint_prusaconnectbridge.events import EventQueue
+
+
+class _Clock(object):
+    """Stands in for the time module in events, so due times can be stepped through."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(events, "time", clock)
+    return clock
+
+
+class _Handler(object):
+    def __init__(self):
+        self.calls = []
+        self.called = threading.Event()
+
+    def __call__(self, key, event, payload):
+        self.calls.append((key, event, payload))
+        self.called.set()
+
+
+##~~ Coalescing
+
+def test_latest_event_of_a_key_wins(clock):
+    queue = EventQueue(_Handler(), window=0.5)
+    for state in ("OPERATIONAL", "OFFLINE", "OPERATIONAL", "PRINTING"):
+        queue.put("state", "PrinterStateChanged", dict(state_id=state))
+
+    assert len(queue) == 1
+    assert queue.received == 4
+    assert queue.coalesced == 3
+    clock.now += 0.5
+    key, entry = queue._next_due(clock.now)
+    assert key == "state"
+    assert entry[1] == dict(state_id="PRINTING")
+
+
+def test_each_event_pushes_the_deadline_out(clock):
+    queue = EventQueue(_Handler(), window=0.5, max_delay=5.0)
+    queue.put("state", "A")
+    clock.now += 0.4
+    queue.put("state", "B")
+
+    # Quiet for less than the window since B
+    clock.now += 0.4
+    assert queue._next_due(clock.now) == (None, pytest.approx(0.1))
+    clock.now += 0.1
+    assert queue._next_due(clock.now)[0] == "state"
+
+
+def test_max_delay_caps_a_storm(clock):
+    queue = EventQueue(_Handler(), window=0.5, max_delay=2.0)
+    queue.put("state", "first")
+    # A flap every 0.3 s never leaves the key quiet for the window
+    for _ in range(6):
+        clock.now += 0.3
+        queue.put("state", "flap")
+
+    assert queue._next_due(clock.now)[0] is None
+    clock.now = 1002.0
+    key, entry = queue._next_due(clock.now)
+    assert key == "state" and entry[0] == "flap"
+
+
+def test_keys_kept_apart_in_order(clock):
+    queue = EventQueue(_Handler(), window=0.5)
+    queue.put("connect", "Connected")
+    queue.put("state", "PrinterStateChanged")
+    queue.put("connect", "Disconnected")
+
+    clock.now += 0.5
+    first = queue._next_due(clock.now)
+    second = queue._next_due(clock.now)
+    assert (first[0], first[1][0]) == ("connect", "Disconnected")
+    assert (second[0], second[1][0]) == ("state", "PrinterStateChanged")
+    assert queue._next_due(clock.now) == (None, None)
+
+
+def test_full_queue_drops_the_oldest_key(clock):
+    queue = EventQueue(_Handler(), maxlen=2)
+    queue.put("a", "A")
+    queue.put("b", "B")
+    queue.put("b", "B2") # Coalesced, nothing dropped
+    queue.put("c", "C")
+
+    assert queue.dropped == 1
+    assert list(queue._pending) == ["b", "c"]
+
+
+##~~ Worker
+
+def test_worker_hands_one_call_per_storm():
+    handler = _Handler()
+    queue = EventQueue(handler, window=0.05)
+    queue.start()
+    try:
+        for number in range(50):
+            queue.put("state", "PrinterStateChanged", dict(flap=number))
+        assert handler.called.wait(2.0)
+        time.sleep(0.1)
+    finally:
+        queue.stop()
+
+    assert handler.calls == [("state", "PrinterStateChanged", dict(flap=49))]
+    assert queue.handled == 1
+
+
+def test_worker_survives_a_failing_handler():
+    handled = threading.Event()
+
+    def handler(key, event, payload):
+        if key == "bad":
+            raise ValueError("broken")
+        handled.set()
+
+    queue = EventQueue(handler, window=0.01)
+    queue.start()
+    try:
+        queue.put("bad", "A")
+        queue.put("good", "B")
+        assert handled.wait(2.0)
+    finally:
+        queue.stop()
+
+
+def test_stop_drops_what_waits():
+    handler = _Handler()
+    queue = EventQueue(handler, window=10.0)
+    queue.start()
+    queue.put("state", "A")
+    queue.stop()
+
+    assert len(queue) == 0
+    assert not handler.called.wait(0.05)
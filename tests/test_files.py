@@ -0,0 +1,96 @@
+# coding=utf-8
+"""FileIndex.resolve finds the file START_PRINT names by path, Connect hash or name, and refuses to guess."""
+from __future__ import absolute_import
+
+import os
+
+import pytest
+from octoprint.events import Events
+
+from octoprint_prusaconnectbridge.files import AmbiguousFile, FileIndex
+
+
+@pytest.fixture
+def index(file_manager):
+    for path in ("a.gcode", "dir/b.gcode", "dir/same.gcode", "other/same.gcode", "deep/dir/same.gcode"):
+        file_manager.write(path)
+    return FileIndex(file_manager)
+
+
+def _disk(file_manager, path):
+    return os.path.join(file_manager.basedir, *path.split("/"))
+
+
+def test_by_path(index, file_manager):
+    assert index.resolve("/dir/b.gcode") == ("dir/b.gcode", _disk(file_manager, "dir/b.gcode"))
+    assert index.resolve("dir//b.gcode")[0] == "dir/b.gcode"
+
+
+def test_by_name_alone(index):
+    assert index.resolve("b.gcode")[0] == "dir/b.gcode"
+    # The only file of that name, wherever Connect thinks it is
+    assert index.resolve("/usb/b.gcode")[0] == "dir/b.gcode"
+
+
+def test_by_hash(index):
+    index.remember_hash("abc123", "/dir/b.gcode")
+
+    assert index.resolve("renamed.gcode", hash_="abc123")[0] == "dir/b.gcode"
+
+
+def test_stale_hash_forgotten(index, file_manager):
+    index.remember_hash("abc123", "a.gcode")
+    os.unlink(_disk(file_manager, "a.gcode"))
+    index.on_event(Events.FILE_REMOVED, dict(storage="local", path="a.gcode"))
+
+    assert index.resolve("gone.gcode", hash_="abc123") is None
+    assert "abc123" not in index._by_hash
+
+
+def test_path_suffix_picks_one_of_several(index):
+    assert index.resolve("other/same.gcode")[0] == "other/same.gcode"
+    assert index.resolve("deep/dir/same.gcode")[0] == "deep/dir/same.gcode"
+
+
+def test_ambiguous_name(index):
+    with pytest.raises(AmbiguousFile) as raised:
+        index.resolve("same.gcode")
+
+    assert sorted(raised.value.candidates) == ["deep/dir/same.gcode", "dir/same.gcode", "other/same.gcode"]
+
+
+def test_ambiguous_without_matching_suffix(index):
+    # None of the three ends with it, so it could be any of them
+    with pytest.raises(AmbiguousFile) as raised:
+        index.resolve("/sd/dir/same.gcode")
+
+    assert len(raised.value.candidates) == 3
+
+
+def test_name_map_follows_events(index, file_manager):
+    for path in ("other/same.gcode", "deep/dir/same.gcode"):
+        os.unlink(_disk(file_manager, path))
+        index.on_event(Events.FILE_REMOVED, dict(storage="local", path=path))
+
+    assert index.resolve("same.gcode")[0] == "dir/same.gcode"
+
+    file_manager.write("new/c.gcode")
+    index.on_event(Events.FILE_ADDED, dict(storage="local", path="new/c.gcode", type=["machinecode", "gcode"]))
+    assert index.resolve("c.gcode")[0] == "new/c.gcode"
+
+
+def test_unknown_and_folders(index):
+    assert index.resolve("missing.gcode") is None
+    assert index.resolve("") is None
+    assert index.resolve("dir") is None
+
+
+def test_ambiguous_suffix(index, file_manager):
+    for path in ("a/x/same.gcode", "b/x/same.gcode"):
+        file_manager.write(path)
+        index.on_event(Events.FILE_ADDED, dict(storage="local", path=path, type=["machinecode", "gcode"]))
+
+    with pytest.raises(AmbiguousFile) as raised:
+        index.resolve("x/same.gcode")
+
+    assert sorted(raised.value.candidates) == ["a/x/same.gcode", "b/x/same.gcode"]
@@ -0,0 +1,133 @@
+# coding=utf-8
+"""FileSync sends Prusa Connect the file changes since its snapshot as FILE_CHANGED events."""
+from __future__ import absolute_import
+
+import shutil
+
+import pytest
+from octoprint.events import Events
+from prusa.connect.printer import const
+
+from octoprint_prusaconnectbridge import filesync
+from octoprint_prusaconnectbridge.files import FileIndex
+from octoprint_prusaconnectbridge.filesync import FileSync
+
+
+class _Printer(object):
+    token = "token"
+
+    def __init__(self):
+        self.events = []
+
+    def event_cb(self, event, source, **kwargs):
+        self.events.append((event, kwargs))
+
+
+@pytest.fixture
+def index(file_manager):
+    file_manager.write("a.gcode")
+    file_manager.write("dir/b.gcode")
+    return FileIndex(file_manager)
+
+
+@pytest.fixture
+def sync(index):
+    printer = _Printer()
+    sync = FileSync(index, lambda: printer, lambda: dict(event=const.Event.INFO, source=const.Source.WUI,
+                                                          files=index.tree()),
+                    free_space=lambda: 1000, max_changes=5)
+    sync.printer = printer
+    sync.info()
+    return sync
+
+
+def _added(index, file_manager, path, content=b"G28\n"):
+    file_manager.write(path, content)
+    index.on_event(Events.FILE_ADDED, dict(storage="local", path=path, type=["machinecode", "gcode"]))
+
+
+def _diff(sync, index):
+    changed, complete = index.take_changes()
+    assert complete
+    return [(kind, data.get("old_path"), data.get("new_path")) for kind, data in sync._diff(changed)]
+
+
+##~~ _diff
+
+def test_file_added(sync, index, file_manager):
+    _added(index, file_manager, "dir/c.gcode")
+
+    assert _diff(sync, index) == [("added", None, "/dir/c.gcode")]
+
+
+def test_new_folder_sent_with_its_contents(sync, index, file_manager):
+    _added(index, file_manager, "new/sub/c.gcode")
+
+    changes = sync._diff(index.take_changes()[0])
+
+    assert [(kind, data["new_path"]) for kind, data in changes] == [("added", "/new")]
+    new = changes[0][1]["file"]
+    assert new["type"] == "DIR"
+    assert new["children"][0]["name"] == "sub"
+    assert new["children"][0]["children"][0]["name"] == "c.gcode"
+
+
+def test_file_modified(sync, index, file_manager):
+    _added(index, file_manager, "a.gcode", b"G28\nG1 X10\n")
+
+    assert _diff(sync, index) == [("modified", "/a.gcode", "/a.gcode")]
+
+
+def test_file_added_again_unchanged(sync, index, file_manager):
+    index.on_event(Events.FILE_ADDED, dict(storage="local", path="a.gcode", type=["machinecode", "gcode"]))
+
+    assert _diff(sync, index) == []
+
+
+def test_folder_removed_once(sync, index, file_manager):
+    shutil.rmtree(file_manager.path_on_disk("local", "dir"))
+    index.on_event(Events.FOLDER_REMOVED, dict(storage="local", path="dir"))
+
+    assert _diff(sync, index) == [("removed", "/dir", None)]
+
+
+def test_folder_replaced_compared_in_full(sync, index, file_manager):
+    # A folder moved over another arrives as a removal and an addition of the same path
+    shutil.rmtree(file_manager.path_on_disk("local", "dir"))
+    index.on_event(Events.FOLDER_REMOVED, dict(storage="local", path="dir"))
+    file_manager.write("dir/d.gcode")
+    index.on_event(Events.FOLDER_ADDED, dict(storage="local", path="dir"))
+
+    assert _diff(sync, index) == [("removed", "/dir/b.gcode", None), ("added", None, "/dir/d.gcode")]
+
+
+def test_too_many_changes(sync, index, file_manager):
+    for number in range(sync.max_changes + 2):
+        _added(index, file_manager, f"many_{number}.gcode")
+
+    assert sync._diff(index.take_changes()[0]) is None
+
+
+##~~ sync
+
+def test_sync_sends_changes_once(sync, index, file_manager, monkeypatch):
+    monkeypatch.setattr(filesync, "link_down", lambda: False)
+    _added(index, file_manager, "dir/c.gcode")
+
+    assert sync.sync() == 1
+    event, data = sync.printer.events[-1]
+    assert event == const.Event.FILE_CHANGED
+    assert data["new_path"] == "/dir/c.gcode"
+    assert data["free_space"] == 1000
+
+    # The snapshot has it now
+    index.on_event(Events.FILE_ADDED, dict(storage="local", path="dir/c.gcode", type=["machinecode", "gcode"]))
+    assert sync.sync() == 0
+
+
+def test_sync_resends_the_tree_after_a_rebuild(sync, index, monkeypatch):
+    monkeypatch.setattr(filesync, "link_down", lambda: False)
+    index.rebuild()
+
+    assert sync.sync() is None
+    assert sync.printer.events[-1][0] == const.Event.INFO
@@ -0,0 +1,106 @@
+# coding=utf-8
+"""SdkLifecycle keeps at most one SDK loop thread alive across re-initializations."""
+from __future__ import absolute_import
+
+import http.server
+import threading
+import time
+
+import pytest
+
+from octoprint_prusaconnectbridge.lifecycle import SdkLifecycle
+
+FINGERPRINT = "0" * 64
+
+
+class _StubConnect(http.server.BaseHTTPRequestHandler):
+    # Answers everything the SDK sends with an empty 204, Prusa Connect's answer to telemetry without commands
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_PUT = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _StubConnect)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.mark.parametrize("async_core", [False, True], ids=["threaded", "async_core"])
+def test_no_loop_threads_leak_over_reinitializations(server_url, async_core):
+    lifecycle = SdkLifecycle(join_timeout=5.0)
+    lifecycle.async_core = async_core
+
+    for cycle in range(5):
+        sn = f"SN{cycle:05d}"
+        lifecycle.create(sn, FINGERPRINT, server=server_url, token="token")
+        assert lifecycle.thread_count == 0
+        assert lifecycle.start()
+        assert lifecycle.thread_count == 1
+        # The loop is actually sending, not just started
+        lifecycle.printer.telemetry(temp_nozzle=20.0 + cycle)
+        assert _wait_for(lambda: lifecycle.printer.queue.empty())
+
+        lifecycle.restart(sn, FINGERPRINT, server=server_url, token="token")
+        assert lifecycle.thread_count <= 1
+        assert lifecycle.is_alive()
+
+        assert lifecycle.stop()
+        assert lifecycle.thread_count == 0
+
+    assert lifecycle.starts == 10
+    lifecycle.discard()
+    assert lifecycle.printer is None
+    assert lifecycle.thread_count == 0
+
+
+def test_create_stops_the_running_loop(server_url):
+    lifecycle = SdkLifecycle(join_timeout=5.0)
+    lifecycle.create("SN00000", FINGERPRINT, server=server_url, token="token")
+    lifecycle.start()
+    thread = lifecycle.thread
+
+    lifecycle.create("SN00001", FINGERPRINT, server=server_url, token="token")
+
+    assert not thread.is_alive()
+    assert lifecycle.thread_count == 0
+    lifecycle.discard()
+
+
+def test_async_core_not_used_through_a_proxy(server_url, monkeypatch):
+    for name in ("NO_PROXY", "no_proxy"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("HTTP_PROXY", "http://proxy.invalid:3128")
+    lifecycle = SdkLifecycle(join_timeout=5.0)
+    lifecycle.async_core = True
+    lifecycle.create("SN00000", FINGERPRINT, server=server_url, token="token")
+
+    assert lifecycle.start()
+    assert lifecycle.core is None
+    assert lifecycle.is_alive()
+
+    assert lifecycle.stop()
+    lifecycle.discard()
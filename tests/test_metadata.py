@@ -0,0 +1,106 @@
+# coding=utf-8
+"""metadata.extract reads slicer metadata and the largest thumbnail from the head and tail of a G-code file."""
+from __future__ import absolute_import
+
+import base64
+
+from octoprint_prusaconnectbridge.metadata import duration_seconds, extract
+
+
+def _thumbnail(kind, width, height, payload):
+    encoded = base64.b64encode(payload).decode()
+    lines = [encoded[i:i + 78] for i in range(0, len(encoded), 78)]
+    tag = "thumbnail" if kind is None else f"thumbnail_{kind}"
+    return (f"; {tag} begin {width}x{height} {len(encoded)}\n" + "".join(f"; {line}\n" for line in lines)
+            + f"; {tag} end\n").encode()
+
+
+def _write(tmp_path, *parts):
+    path = tmp_path / "print.gcode"
+    path.write_bytes(b"".join(parts))
+    return str(path)
+
+
+PRUSASLICER_HEAD = b"; generated by PrusaSlicer 2.7.1 on 2024-01-01 at 12:00:00 UTC\n\n"
+PRUSASLICER_TAIL = (b"; filament used [mm] = 1200.50, 300.25\n"
+                    b"; filament used [g] = 3.5, 0.75\n"
+                    b"; estimated printing time (normal mode) = 1d 2h 3m 4s\n"
+                    b"; layer_height = 0.2\n"
+                    b"; nozzle_diameter = 0.4,0.4\n"
+                    b"; printer_model = MK4\n"
+                    b"; filament_type = PLA;PETG\n"
+                    b"; some_other_setting = 1\n"
+                    b"; max_layer_z = not a number\n")
+
+
+def test_prusaslicer_file(tmp_path):
+    path = _write(tmp_path, PRUSASLICER_HEAD,
+                  _thumbnail(None, 16, 16, b"small png"), _thumbnail(None, 313, 173, b"large png"),
+                  _thumbnail("QOI", 640, 480, b"larger qoi"),
+                  b"G1 X10 Y10\n" * 100000, PRUSASLICER_TAIL)
+
+    metadata, thumbnail = extract(path)
+
+    assert metadata["filament used [mm]"] == 1500.75
+    assert metadata["filament used [g]"] == 4.25
+    assert metadata["estimated printing time (normal mode)"] == "1d 2h 3m 4s"
+    assert metadata["print_time"] == 93784
+    assert metadata["layer_height"] == 0.2
+    assert metadata["nozzle_diameter"] == 0.4
+    assert metadata["printer_model"] == "MK4"
+    assert metadata["filament_type"] == "PLA;PETG"
+    assert "some_other_setting" not in metadata
+    assert "max_layer_z" not in metadata
+    # PNG is preferred over larger thumbnails in other formats
+    assert base64.b64decode(thumbnail) == b"large png"
+
+
+def test_middle_of_large_files_not_read(tmp_path):
+    path = _write(tmp_path, PRUSASLICER_HEAD, b"G1 X10 Y10\n" * 60000, b"; printer_model = MIDDLE\n",
+                  b"G1 X10 Y10\n" * 60000)
+
+    metadata, thumbnail = extract(path)
+
+    assert "printer_model" not in metadata
+    assert thumbnail is None
+
+
+def test_small_file_read_once(tmp_path):
+    # Head and tail overlap, sums aren't counted twice
+    path = _write(tmp_path, PRUSASLICER_HEAD, PRUSASLICER_TAIL)
+
+    metadata, _ = extract(path)
+
+    assert metadata["filament used [g]"] == 4.25
+
+
+def test_cura_file(tmp_path):
+    path = _write(tmp_path, b";FLAVOR:Marlin\n;TIME:3725\n;Filament used: 1.25m\n;Layer height: 0.15\n"
+                            b";TARGET_MACHINE.NAME:Creality Ender-3\n",
+                  _thumbnail(None, 300, 300, b"cura png"), b"G1 X10\n" * 10)
+
+    metadata, thumbnail = extract(path)
+
+    assert metadata["print_time"] == 3725
+    assert metadata["filament used [mm]"] == 1250.0
+    assert metadata["layer_height"] == 0.15
+    assert metadata["printer_model"] == "Creality Ender-3"
+    assert base64.b64decode(thumbnail) == b"cura png"
+
+
+def test_unterminated_thumbnail_skipped(tmp_path):
+    broken = _thumbnail(None, 400, 400, b"broken")
+    path = _write(tmp_path, _thumbnail(None, 16, 16, b"complete"), broken[:broken.index(b"; thumbnail end")])
+
+    assert base64.b64decode(extract(path)[1]) == b"complete"
+
+
+def test_empty_file(tmp_path):
+    assert extract(_write(tmp_path)) == ({}, None)
+
+
+def test_duration_seconds():
+    assert duration_seconds("2h 5m") == 7500
+    assert duration_seconds("45s") == 45
+    assert duration_seconds("") is None
+    assert duration_seconds(None) is None
@@ -0,0 +1,72 @@
+# coding=utf-8
+"""Requests arriving while the SDK is set up in the background wait a bounded time, settings saved meanwhile follow."""
+from __future__ import absolute_import
+
+import threading
+
+import flask
+import octoprint.plugin
+import pytest
+
+from octoprint_prusaconnectbridge import PrusaConnectBridgePlugin
+from octoprint_prusaconnectbridge.config import Config
+
+from test_config import _Settings
+
+
+@pytest.fixture
+def plugin(monkeypatch):
+    settings = _Settings()
+
+    def save(plugin, data):
+        for key, value in data.items():
+            settings.values[key] = value
+
+    monkeypatch.setattr(octoprint.plugin.SettingsPlugin, "on_settings_save", save)
+    plugin = PrusaConnectBridgePlugin()
+    plugin._settings = settings
+    plugin._config = Config.load(settings)
+    plugin.STARTUP_WAIT = 0.05
+    plugin.applied = []
+    monkeypatch.setattr(plugin, "_apply_settings", lambda old_config: plugin.applied.append(
+        (old_config.prusa_server_url, plugin._config.prusa_server_url)))
+    return plugin
+
+
+@pytest.fixture
+def setup_running(plugin):
+    """Holds the background setup until set."""
+    done = threading.Event()
+    plugin._startup_thread = threading.Thread(target=lambda: (done.wait(5.0),
+                                                              plugin._apply_settings_saved_during_setup()),
+                                              daemon=True)
+    plugin._startup_thread.start()
+    yield done
+    done.set()
+    plugin._startup_thread.join()
+
+
+def test_api_answers_starting(plugin, setup_running):
+    with flask.Flask(__name__).app_context():
+        response = plugin.on_api_command("list_bridged_printers", {})
+
+    assert response.status_code == 503
+    assert response.get_json()["status"] == "starting"
+
+
+def test_settings_saved_during_setup_applied_after(plugin, setup_running):
+    plugin.on_settings_save(dict(prusa_server_url="https://first.example"))
+    plugin.on_settings_save(dict(prusa_server_url="https://second.example"))
+    assert plugin.applied == []
+
+    setup_running.set()
+    plugin._startup_thread.join(5.0)
+
+    # Once, from the config before the first save to the latest
+    assert plugin.applied == [("https://connect.prusa3d.com", "https://second.example")]
+
+
+def test_settings_applied_right_away_once_set_up(plugin):
+    plugin.on_settings_save(dict(prusa_server_url="https://other.example"))
+
+    assert plugin.applied == [("https://connect.prusa3d.com", "https://other.example")]
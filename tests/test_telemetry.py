@@ -0,0 +1,281 @@
+# coding=utf-8
+"""Telemetry is sent on meaningful changes only, at a cadence backing off on failures, and replayed after outages."""
+from __future__ import absolute_import
+
+import queue
+import time
+
+import pytest
+from prusa.connect.printer import const
+from prusa.connect.printer.models import Telemetry
+
+from octoprint_prusaconnectbridge import telemetry
+from octoprint_prusaconnectbridge.telemetry import CadenceScheduler, TelemetryBuffer, TelemetryEngine
+
+
+##~~ TelemetryEngine deadbands
+
+@pytest.fixture
+def engine():
+    # A heartbeat that is never due within a test, only changes send
+    return TelemetryEngine(None, None, cadence=CadenceScheduler(idle=3600.0), temp_deadband=0.5,
+                           progress_deadband=1.0, deferred=("state",))
+
+
+def _snapshot(**values):
+    snapshot = dict(state="IDLE", temp_nozzle=200.0, temp_bed=60.0, progress=10.0, time_remaining=600)
+    snapshot.update(values)
+    return snapshot
+
+
+def _send(engine, snapshot, force=False):
+    sent = []
+    engine.submit(snapshot, sent.append, force=force)
+    return bool(sent)
+
+
+def test_first_snapshot_sent(engine):
+    assert _send(engine, _snapshot())
+    assert not _send(engine, _snapshot())
+
+
+def test_temperature_deadband(engine):
+    _send(engine, _snapshot())
+
+    assert not _send(engine, _snapshot(temp_nozzle=200.4))
+    assert not _send(engine, _snapshot(temp_bed=59.6))
+    assert _send(engine, _snapshot(temp_nozzle=200.5))
+
+
+def test_small_changes_add_up(engine):
+    _send(engine, _snapshot())
+
+    # Compared with what was last sent, not with the previous snapshot
+    assert not _send(engine, _snapshot(temp_nozzle=200.3))
+    assert _send(engine, _snapshot(temp_nozzle=200.6))
+
+
+def test_deadband_covers_every_heater(engine):
+    _send(engine, _snapshot(temp_nozzle_1=210.0, temp_chamber=35.0))
+
+    assert not _send(engine, _snapshot(temp_nozzle_1=210.2, temp_chamber=35.4))
+    assert _send(engine, _snapshot(temp_nozzle_1=210.2, temp_chamber=34.0))
+
+
+def test_progress_deadband(engine):
+    _send(engine, _snapshot())
+
+    assert not _send(engine, _snapshot(progress=10.9))
+    assert _send(engine, _snapshot(progress=11.0))
+
+
+def test_exact_keys(engine):
+    _send(engine, _snapshot(target_nozzle=200))
+
+    assert _send(engine, _snapshot(target_nozzle=205))
+
+
+def test_value_appearing_or_vanishing(engine):
+    _send(engine, _snapshot())
+
+    assert _send(engine, _snapshot(temp_nozzle=None))
+    assert _send(engine, _snapshot(temp_nozzle=200.0))
+
+
+def test_passive_and_deferred_keys_dont_count(engine):
+    _send(engine, _snapshot())
+
+    assert not _send(engine, _snapshot(time_remaining=300, layer=12, axis_z=2.4))
+    assert not _send(engine, _snapshot(state="PRINTING"))
+    # The owner sends deferred changes itself
+    assert _send(engine, _snapshot(state="PRINTING"), force=True)
+
+
+def test_other_keys_of_the_same_count(engine):
+    _send(engine, _snapshot(temp_nozzle_1=210.0))
+
+    assert _send(engine, _snapshot(temp_chamber=210.0))
+    assert not _send(engine, _snapshot(temp_chamber=210.1))
+
+
+def test_deadbands_reconfigured(engine):
+    _send(engine, _snapshot())
+    engine.configure(temp_deadband=5.0)
+
+    assert not _send(engine, _snapshot(temp_nozzle=204.0))
+
+
+def test_heartbeat_sends_unchanged(engine):
+    _send(engine, _snapshot())
+    engine._last_sent_at -= 3600.0
+
+    assert _send(engine, _snapshot())
+
+
+def test_changes_wait_while_backing_off(engine):
+    _send(engine, _snapshot())
+    engine.cadence.record_failure()
+
+    assert not _send(engine, _snapshot(temp_nozzle=180.0))
+    engine.cadence.record_success()
+    assert _send(engine, _snapshot(temp_nozzle=180.0))
+
+
+##~~ CadenceScheduler
+
+@pytest.fixture
+def cadence():
+    return CadenceScheduler(heating=1.0, printing=5.0, idle=10.0, offline=60.0, layer_burst=10.0, backoff_max=300.0)
+
+
+def test_interval_by_state(cadence):
+    assert cadence.interval() == 10.0
+    assert cadence.update("PRINTING")
+    assert cadence.interval() == 5.0
+    assert cadence.update("PRINTING", heating=True)
+    assert cadence.interval() == 1.0
+    assert not cadence.update("OFFLINE", heating=True)
+    assert cadence.interval() == 60.0
+    cadence.update("SOMETHING_NEW")
+    assert cadence.interval() == 10.0
+
+
+def test_layer_change_bursts_while_printing(cadence):
+    cadence.update("PRINTING")
+
+    assert cadence.layer_changed()
+    assert cadence.interval() == 1.0
+    cadence._burst_until = 0.0
+    assert cadence.interval() == 5.0
+
+
+def test_failures_back_off_exponentially(cadence):
+    intervals = []
+    for _ in range(7):
+        cadence.record_failure()
+        intervals.append(cadence.interval())
+
+    assert intervals == [20.0, 40.0, 80.0, 160.0, 300.0, 300.0, 300.0]
+    assert cadence.backing_off
+    cadence.record_success()
+    assert not cadence.backing_off
+    assert cadence.interval() == 10.0
+
+
+def test_backoff_never_shortens_the_interval(cadence):
+    cadence.configure(backoff_max=30.0)
+    cadence.update("OFFLINE")
+    cadence.record_failure()
+
+    assert cadence.interval() == 60.0
+
+
+def test_intervals_have_a_floor():
+    cadence = CadenceScheduler(heating=0.0, backoff_max=0.0)
+    cadence.update("IDLE", heating=True)
+
+    assert cadence.interval() == 0.5
+    cadence.record_failure()
+    assert cadence.interval() == 1.0
+
+
+##~~ TelemetryBuffer
+
+def _sample(temp_nozzle=200.0, state=const.State.PRINTING, progress=10.0):
+    return dict(state=state, temp_nozzle=temp_nozzle, target_nozzle=215.0, temp_bed=60.0, target_bed=60.0,
+                progress=progress)
+
+
+def test_buffer_skips_duplicates_and_throttles():
+    buffer = TelemetryBuffer(capacity=10, interval=0.0)
+
+    assert buffer.record(_sample(), timestamp=1.0)
+    assert not buffer.record(_sample(), timestamp=2.0)
+    assert buffer.record(_sample(201.0), timestamp=3.0)
+
+    throttled = TelemetryBuffer(capacity=10, interval=60.0)
+    assert throttled.record(_sample())
+    assert not throttled.record(_sample(201.0))
+
+
+def test_buffer_keeps_the_latest_samples():
+    buffer = TelemetryBuffer(capacity=3, interval=0.0)
+    for number in range(5):
+        buffer.record(_sample(200.0 + number), timestamp=100.0 + number)
+
+    assert len(buffer) == 3
+    assert buffer.dropped == 2
+    samples = buffer.take(10)
+    assert [timestamp for timestamp, _, _ in samples] == [102.0, 103.0, 104.0]
+    assert samples[0][1] == const.State.PRINTING
+    assert samples[0][2]["temp_nozzle"] == 202.0
+    assert len(buffer) == 0
+
+
+def test_buffer_leaves_out_missing_values():
+    buffer = TelemetryBuffer(capacity=3, interval=0.0)
+    buffer.record(dict(state=const.State.IDLE, temp_nozzle=25.0), timestamp=1.0)
+
+    assert buffer.take(1) == [(1.0, const.State.IDLE, dict(temp_nozzle=25.0))]
+
+
+class _Printer(object):
+    def __init__(self):
+        self.queue = queue.Queue()
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def test_replay_with_original_timestamps_at_the_rate(monkeypatch):
+    monkeypatch.setattr(telemetry, "link_down", lambda: False)
+    buffer = TelemetryBuffer(capacity=100, interval=0.0, rate=10.0, jitter=0.0)
+    for number in range(15):
+        buffer.record(_sample(progress=float(number)), timestamp=1000.0 + number)
+    printer = _Printer()
+
+    assert buffer.start_replay(printer)
+    assert not buffer.start_replay(printer) # Already replaying
+    # A second's worth first, the rest once the queue drained and a second passed
+    assert _wait_for(lambda: printer.queue.qsize() == 10)
+    sent = [printer.queue.get_nowait() for _ in range(10)]
+    assert _wait_for(lambda: printer.queue.qsize() == 5)
+    sent += [printer.queue.get_nowait() for _ in range(5)]
+    assert _wait_for(lambda: not buffer.replaying())
+
+    assert isinstance(sent[0], Telemetry)
+    assert [item.timestamp for item in sent] == [1000.0 + number for number in range(15)]
+    assert [item.to_payload()["progress"] for item in sent] == [float(number) for number in range(15)]
+    assert buffer.replayed == 15
+    assert len(buffer) == 0
+
+
+def test_replay_pauses_while_the_link_is_down(monkeypatch):
+    monkeypatch.setattr(telemetry, "link_down", lambda: True)
+    buffer = TelemetryBuffer(capacity=10, interval=0.0, jitter=0.0)
+    buffer.record(_sample(), timestamp=1.0)
+    printer = _Printer()
+
+    assert buffer.start_replay(printer)
+    assert _wait_for(lambda: not buffer.replaying())
+    # Kept for the next reconnect
+    assert printer.queue.empty()
+    assert len(buffer) == 1
+
+
+def test_replay_stopped_during_the_jitter():
+    buffer = TelemetryBuffer(capacity=10, interval=0.0, jitter=60.0)
+    buffer.record(_sample(), timestamp=1.0)
+    printer = _Printer()
+
+    assert buffer.start_replay(printer)
+    buffer.stop_replay()
+    assert _wait_for(lambda: not buffer.replaying())
+    assert printer.queue.empty()
+    assert len(buffer) == 1
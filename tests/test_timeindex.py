@@ -0,0 +1,132 @@
+# coding=utf-8
+"""Time indexes of G-code files, and their cache retrying files that couldn't be indexed."""
+from __future__ import absolute_import
+
+import os
+import time
+
+import pytest
+
+from octoprint_prusaconnectbridge.timeindex import TimeIndexCache, build
+
+M73 = b"G90\nM73 P0 R10\nG1 X10 F600\nM73 P50 R5\nG1 X20\nM73 P100 R0\n"
+CURA = b";FLAVOR:Marlin\n;TIME:100\nG1 Z0.2\n;TIME_ELAPSED:40\nG1 Z0.4\n;TIME_ELAPSED:100\n"
+MOVES = b"G90\nG1 X60 F600\nG1 X120\n"
+NO_TIME = b"; just a comment\nM104 S200\n"
+
+
+def _write(tmp_path, name, content):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return str(path)
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = condition()
+        if result:
+            return result
+        time.sleep(0.01)
+    return condition()
+
+
+##~~ build and lookup
+
+def test_m73_markers(tmp_path):
+    index = build(_write(tmp_path, "m73.gcode", M73), "m73.gcode")
+
+    assert index.source == "m73"
+    assert index.total == 600.0
+    assert list(index.seconds) == [0.0, 300.0, 600.0]
+    assert index.elapsed(0) == 0.0
+    assert index.remaining(len(M73)) == 0.0
+    # Halfway between the first two markers
+    middle = (index.offsets[0] + index.offsets[1]) / 2.0
+    assert index.elapsed(middle) == pytest.approx(150.0)
+    assert index.remaining(middle) == pytest.approx(450.0)
+
+
+def test_cura_elapsed_per_layer(tmp_path):
+    index = build(_write(tmp_path, "cura.gcode", CURA), "cura.gcode")
+
+    assert index.source == "cura"
+    assert index.total == 100.0
+    assert list(index.seconds) == [0.0, 40.0, 100.0]
+    assert index.elapsed(index.offsets[1]) == 40.0
+    assert index.remaining(len(CURA)) == 0.0
+
+
+def test_moves_without_slicer_times(tmp_path):
+    index = build(_write(tmp_path, "moves.gcode", MOVES), "moves.gcode")
+
+    assert index.source == "moves"
+    # 120 mm at 10 mm/s
+    assert index.total == pytest.approx(12.0)
+    assert index.offsets[-1] == len(MOVES)
+    assert index.remaining(len(MOVES)) == 0.0
+    assert 0.0 < index.elapsed(len(MOVES) // 2) < index.total
+
+
+def test_no_time_told(tmp_path):
+    assert build(_write(tmp_path, "none.gcode", NO_TIME), "none.gcode") is None
+
+
+##~~ TimeIndexCache
+
+@pytest.fixture
+def cache(tmp_path):
+    resolved = []
+
+    def resolve(path):
+        resolved.append(path)
+        return str(tmp_path / path)
+
+    cache = TimeIndexCache(str(tmp_path / "time_index.db"), resolve)
+    cache.resolved = resolved
+    cache.open()
+    yield cache
+    cache.close()
+
+
+def test_get_builds_and_keeps_the_index(tmp_path, cache):
+    _write(tmp_path, "m73.gcode", M73)
+
+    assert cache.get("m73.gcode") is None
+    index = _wait_for(lambda: cache.get("m73.gcode"))
+
+    assert index is not None and index.source == "m73"
+    assert cache.get("m73.gcode") is index
+
+
+def test_failed_file_retried_once_rewritten(tmp_path, cache):
+    disk_path = _write(tmp_path, "upload.gcode", NO_TIME)
+    cache.request("upload.gcode")
+    assert _wait_for(lambda: "upload.gcode" in cache._failed)
+
+    # The same version isn't tried again
+    cache.RETRY_INTERVAL = 0.0
+    cache.get("upload.gcode")
+    assert "upload.gcode" not in cache._queue
+
+    # Uploading it again only fires FILE_ADDED, the new version is indexed
+    _write(tmp_path, "upload.gcode", M73)
+    os.utime(disk_path, (time.time() + 10, time.time() + 10))
+    cache.request("upload.gcode")
+    index = _wait_for(lambda: cache.get("upload.gcode"))
+
+    assert index is not None and index.source == "m73"
+    assert "upload.gcode" not in cache._failed
+
+
+def test_missing_file_not_requeued_every_tick(cache):
+    cache.get("missing.gcode")
+    assert _wait_for(lambda: "missing.gcode" in cache._failed)
+    assert cache._failed["missing.gcode"][0] is None
+    resolved = len(cache.resolved)
+
+    for _ in range(100):
+        assert cache.get("missing.gcode") is None
+
+    assert "missing.gcode" not in cache._queue
+    assert len(cache.resolved) == resolved